@@ -0,0 +1,185 @@
+#
+# asynclog.py
+# Mike Cardillo
+#
+# Logging handler that hands records to a background thread, which formats
+# them and writes them in batches, so the trading loop never waits on the
+# disk. Records below the logger's level are rejected by logging itself
+# before they are formatted or queued.
+
+import os
+import sys
+import time
+import logging
+import threading
+import collections
+import metrics
+
+records_dropped_total = metrics.Counter('gdax_log_records_dropped_total',
+                                        "Log records dropped because the log queue was full")
+
+
+class CompactFormatter(logging.Formatter):
+    """
+    One tab separated line per record: the time in epoch seconds, the tag of
+    messages written as "[TAG] ..." and the raw arguments, e.g.
+
+        1504224000.123456	TRADE	2017-09-01 00:00:00.120000+00:00	4000.0	0.5
+
+    Messages without a tag or arguments are written as formatted text.
+    """
+    def format(self, record):
+        message = record.msg
+        if isinstance(record.args, tuple) and record.args and isinstance(message, str) and \
+           message.startswith('['):
+            tag = message[1:message.find(']')].split(' ')[0]
+            text = '\t'.join(str(arg) for arg in record.args)
+        else:
+            tag = record.levelname
+            text = record.getMessage()
+        line = '%.6f\t%s\t%s' % (record.created, tag, text)
+        if record.exc_info:
+            line += '\n' + self.formatException(record.exc_info)
+        return line
+
+
+class RotatingFileWriter:
+    """
+    Appends to path, moving it to path.1 (path.1 to path.2 and so on, keeping
+    backups files) once it grows past max_bytes or is older than
+    rotate_seconds. Either limit is disabled with 0.
+    """
+    def __init__(self, path, max_bytes=0, rotate_seconds=0, backups=5):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.rotate_seconds = rotate_seconds
+        self.backups = backups
+        self.open()
+
+    def open(self):
+        self.stream = open(self.path, 'a')
+        self.stream.seek(0, os.SEEK_END)
+        self.size = self.stream.tell()
+        self.opened = time.time()
+
+    def should_rotate(self):
+        if self.max_bytes and self.size >= self.max_bytes:
+            return True
+        return bool(self.rotate_seconds) and time.time() - self.opened >= self.rotate_seconds
+
+    def rotate(self):
+        self.stream.close()
+        if self.backups > 0:
+            for idx in range(self.backups - 1, 0, -1):
+                source = '%s.%d' % (self.path, idx)
+                if os.path.exists(source):
+                    os.rename(source, '%s.%d' % (self.path, idx + 1))
+            os.rename(self.path, self.path + '.1')
+        else:
+            os.remove(self.path)
+        self.open()
+
+    def write(self, text):
+        if self.should_rotate():
+            self.rotate()
+        self.stream.write(text)
+        self.size += len(text)
+
+    def flush(self):
+        self.stream.flush()
+
+    def close(self):
+        self.stream.close()
+
+
+class StreamWriter:
+    def __init__(self, stream=None):
+        self.stream = stream if stream is not None else sys.stderr
+
+    def write(self, text):
+        self.stream.write(text)
+
+    def flush(self):
+        self.stream.flush()
+
+    def close(self):
+        pass
+
+
+class AsyncLogHandler(logging.Handler):
+    """
+    emit() only appends the record to a deque, which needs no lock. A
+    writer thread polls it every poll_interval seconds, formats up to
+    batch_size records at a time and writes them with a single write,
+    flushing once it has caught up. When queue_size records are waiting new
+    ones are dropped rather than blocking, and the number dropped is logged
+    once there is room again.
+    """
+    def __init__(self, writer, queue_size=100000, batch_size=1000, poll_interval=0.05):
+        logging.Handler.__init__(self)
+        self.writer = writer
+        self.records = collections.deque()
+        self.queue_size = queue_size
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.dropped = 0
+        self.closing = threading.Event()
+        self.thread = threading.Thread(target=self.run, name='log_writer')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def handle(self, record):
+        # Neither filters nor the handler lock are needed to queue a record
+        self.emit(record)
+
+    def emit(self, record):
+        if len(self.records) >= self.queue_size:
+            self.dropped += 1
+            records_dropped_total.inc()
+            return
+        self.records.append(record)
+
+    def next_batch(self):
+        batch = []
+        while self.records and len(batch) < self.batch_size:
+            batch.append(self.records.popleft())
+        return batch
+
+    def format_batch(self, batch):
+        lines = []
+        for record in batch:
+            try:
+                lines.append(self.format(record))
+            except Exception:
+                self.handleError(record)
+        if self.dropped:
+            lines.append('[LOG] Dropped %d records, the log queue was full' % self.dropped)
+            self.dropped = 0
+        return '\n'.join(lines) + '\n' if lines else ''
+
+    def write_pending(self):
+        written = False
+        while self.records or self.dropped:
+            text = self.format_batch(self.next_batch())
+            if text:
+                self.writer.write(text)
+                written = True
+        if written:
+            self.writer.flush()
+
+    def run(self):
+        while not self.closing.wait(self.poll_interval):
+            try:
+                self.write_pending()
+            except Exception:
+                # Nothing sensible to log a logging failure to
+                pass
+        self.write_pending()
+
+    def close(self):
+        if self.thread.is_alive():
+            # Wait for what is queued to be written
+            self.closing.set()
+            self.thread.join()
+            self.writer.close()
+        logging.Handler.close(self)
@@ -0,0 +1,175 @@
+#
+# backfill.py
+# Mike Cardillo
+#
+# Bulk download of historic candlesticks into a CandleStore, and resampling
+# of stored candlesticks into higher timeframes.
+#
+# A date range is split into one request per page of candlesticks. Pages
+# are fetched by a bounded pool of threads under the shared public rate
+# limit, retried with backoff, and merged into the store in chunks so an
+# interrupted run keeps what it fetched. Pages that already have stored
+# candlesticks are skipped, so running it again resumes where it stopped.
+#
+#   python backfill.py candles/ BTC-USD --start 2017-01-01 --end 2018-01-01 --resample 300,3600
+
+import sys
+import time
+import logging
+import argparse
+import multiprocessing.pool
+import dateutil.parser
+import numpy as np
+import pytz
+import rest
+import period
+import candlestore
+
+# GDAX returns at most 300 candlesticks per request
+PAGE = 300
+RETRIES = 5
+# Pages fetched between writes to the store
+CHUNK = 100
+
+
+def parse_date(value):
+    # Epoch seconds, or a date/time string taken as UTC unless it has a zone
+    try:
+        return float(value)
+    except ValueError:
+        date = dateutil.parser.parse(value)
+        if date.tzinfo is None:
+            date = date.replace(tzinfo=pytz.utc)
+        return period.to_epoch(date)
+
+
+def pages(start, end, granularity, page=PAGE):
+    # [start, end) split into (first, last) candlestick times of each request
+    first = start - start % granularity
+    windows = []
+    while first < end:
+        last = min(first + (page - 1) * granularity, end - granularity)
+        windows.append((first, last))
+        first = last + granularity
+    return windows
+
+
+class Backfiller:
+    def __init__(self, store, api_url=period.API_URL, workers=4, retries=RETRIES):
+        self.logger = logging.getLogger('trader-logger')
+        self.store = store
+        self.api_url = api_url.rstrip('/')
+        self.workers = workers
+        self.retries = retries
+        self.requests = 0
+        self.failed = []
+
+    def fetch_page(self, product_id, granularity, first, last):
+        # Rows of one page, oldest first. Retried with exponential backoff on
+        # errors, including the error messages GDAX returns instead of rows
+        delay = 1.0
+        for attempt in range(self.retries + 1):
+            try:
+                self.requests += 1
+                page = rest.public_get(self.api_url + '/products/%s/candles' % product_id,
+                                       params={'start': period.from_epoch(first).isoformat(),
+                                               'end': period.from_epoch(last).isoformat(),
+                                               'granularity': granularity},
+                                       endpoint='get_product_historic_rates')
+                if not isinstance(page, list):
+                    raise ValueError(page)
+                rows = np.array(page, dtype='f8').reshape(-1, 6)
+                return rows[(rows[:, 0] >= first) & (rows[:, 0] <= last)][::-1]
+            except Exception as e:
+                if attempt == self.retries:
+                    self.logger.debug("[BACKFILL] %s %d - %d failed: %r", product_id, first, last, e)
+                    self.failed.append((product_id, granularity, first, last))
+                    return np.zeros((0, 6))
+                time.sleep(delay)
+                delay = min(delay * 2, 30.0)
+
+    def missing_pages(self, product_id, granularity, start, end):
+        # Pages without a single stored candlestick
+        windows = pages(start, end, granularity)
+        if not windows:
+            return windows
+        times = self.store.load_range(product_id, granularity, windows[0][0], windows[-1][1] + 1)[:, 0]
+        counts = np.searchsorted(times, [last + 1 for first, last in windows]) - \
+            np.searchsorted(times, [first for first, last in windows])
+        return [window for window, count in zip(windows, counts) if count == 0]
+
+    def backfill(self, product_id, granularity, start, end, refetch=False):
+        """
+        Stores the candlesticks of [start, end). Returns the number of rows
+        fetched.
+        """
+        if refetch:
+            windows = pages(start, end, granularity)
+        else:
+            windows = self.missing_pages(product_id, granularity, start, end)
+        self.logger.debug("[BACKFILL] %s %d s: %d pages to fetch", product_id, granularity, len(windows))
+        pool = multiprocessing.pool.ThreadPool(self.workers)
+        fetched = 0
+        try:
+            for idx in range(0, len(windows), CHUNK):
+                chunk = windows[idx:idx + CHUNK]
+                results = pool.map(lambda window: self.fetch_page(product_id, granularity, *window), chunk)
+                rows = np.concatenate(results)
+                self.store.merge(product_id, granularity, rows)
+                fetched += len(rows)
+                self.logger.debug("[BACKFILL] %s %d s: %d of %d pages, %d candlesticks",
+                                  product_id, granularity, idx + len(chunk), len(windows), fetched)
+        finally:
+            pool.close()
+            pool.join()
+        return fetched
+
+
+def resample(store, product_id, granularity, base_granularity=60, start=None, end=None):
+    """
+    Builds granularity candlesticks from the stored base_granularity ones
+    with period.resample_candlesticks() and stores them. Returns the rows.
+    """
+    if start is not None:
+        start -= start % granularity
+    candles = store.load_range(product_id, base_granularity, start, end)
+    rows = period.resample_candlesticks(candles, granularity)
+    store.merge(product_id, granularity, rows)
+    return rows
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Download historic candlesticks into a candle store")
+    parser.add_argument('directory', help="candle store directory, as CANDLE_DIR in config.py")
+    parser.add_argument('products', nargs='+', help="products to backfill, e.g. BTC-USD")
+    parser.add_argument('--start', required=True, help="first day or time (UTC), or epoch seconds")
+    parser.add_argument('--end', default=None, help="end of the range, now by default")
+    parser.add_argument('--granularity', type=int, default=60, help="candlestick size in seconds to download")
+    parser.add_argument('--resample', default='',
+                        help="comma separated larger sizes in seconds to build from the downloaded ones")
+    parser.add_argument('--workers', type=int, default=4, help="requests in flight at once")
+    parser.add_argument('--retries', type=int, default=RETRIES, help="retries of a failed page")
+    parser.add_argument('--refetch', action='store_true', help="also fetch pages that are already stored")
+    parser.add_argument('--api-url', default=period.API_URL)
+    args = parser.parse_args()
+
+    logger = logging.getLogger('trader-logger')
+    logger.setLevel(logging.DEBUG)
+    logger.addHandler(logging.StreamHandler())
+
+    start = parse_date(args.start)
+    end = parse_date(args.end) if args.end else time.time()
+    store = candlestore.CandleStore(args.directory)
+    backfiller = Backfiller(store, api_url=args.api_url, workers=args.workers, retries=args.retries)
+    for product_id in args.products:
+        began = time.time()
+        fetched = backfiller.backfill(product_id, args.granularity, start, end, refetch=args.refetch)
+        sys.stdout.write("%s %d s: %d candlesticks in %.1f s\n" %
+                         (product_id, args.granularity, fetched, time.time() - began))
+        for granularity in [int(size) for size in args.resample.split(',') if size]:
+            began = time.time()
+            rows = resample(store, product_id, granularity, args.granularity, start, end)
+            sys.stdout.write("%s %d s: %d candlesticks resampled in %.2f s\n" %
+                             (product_id, granularity, len(rows), time.time() - began))
+    if backfiller.failed:
+        sys.stdout.write("%d pages failed, run again to retry them\n" % len(backfiller.failed))
@@ -0,0 +1,330 @@
+#
+# backtest.py
+# Mike Cardillo
+#
+# Event-driven backtester replaying recorded match/heartbeat messages through
+# Period, IndicatorSubsystem and TradeEngine against a simulated exchange
+
+import os
+import sys
+import json
+import math
+import time
+import argparse
+import itertools
+import period
+import indicators
+import microstructure
+import engine
+import tickstore
+from decimal import Decimal
+
+
+def load_messages(path):
+    # One websocket message (as received from GDAX) per line
+    with open(path) as message_file:
+        for line in message_file:
+            line = line.strip()
+            if line:
+                yield json.loads(line)
+
+
+class SimulatedOrderBook:
+    """
+    Stand-in for OrderBookCustom that tracks top of book from the replayed
+    matches. The maker side of each match tells us which side it printed on.
+    """
+    def __init__(self):
+        self.bid = None
+        self.ask = None
+
+    def start(self):
+        pass
+
+    def close(self):
+        pass
+
+    def is_ready(self):
+        return self.bid is not None and self.ask is not None
+
+    def get_bid(self):
+        return self.bid
+
+    def get_ask(self):
+        return self.ask
+
+    def get_mid(self):
+        return (self.bid + self.ask) / Decimal('2')
+
+    def process_match(self, msg):
+        price = Decimal(msg.get('price'))
+        if msg.get('side') == 'sell':
+            self.ask = price
+            if self.bid is None or self.bid >= price:
+                self.bid = price - Decimal('0.01')
+        else:
+            self.bid = price
+            if self.ask is None or self.ask <= price:
+                self.ask = price + Decimal('0.01')
+
+
+class SimulatedExchange:
+    """
+    Stand-in for gdax.AuthenticatedClient. Limit orders rest until a replayed
+    match trades at or through their price, and post-only orders that would
+    cross the simulated book are rejected.
+    """
+    def __init__(self, order_book, usd='1000.00', btc='0.0', fee_rate='0.0'):
+        self.order_book = order_book
+        self.balances = {'USD': Decimal(usd), 'BTC': Decimal(btc)}
+        self.holds = {'USD': Decimal('0'), 'BTC': Decimal('0')}
+        self.fee_rate = Decimal(fee_rate)
+        self.orders = {}
+        self.fills = []
+        self.order_ids = itertools.count(1)
+        self.reference_price = None
+        self.last_time = None
+
+    def get_accounts(self):
+        return [{'currency': currency,
+                 'balance': str(self.balances[currency]),
+                 'hold': str(self.holds[currency]),
+                 'available': str(self.balances[currency] - self.holds[currency])}
+                for currency in ('USD', 'BTC')]
+
+    def place_order(self, side, price, size, post_only=False, product_id='BTC-USD', **kwargs):
+        price = Decimal(price)
+        size = Decimal(size)
+        if side == 'buy':
+            currency, hold = 'USD', price * size
+        else:
+            currency, hold = 'BTC', size
+        if hold > self.balances[currency] - self.holds[currency]:
+            return {'message': 'Insufficient funds'}
+
+        order = {'id': str(next(self.order_ids)), 'side': side, 'price': str(price),
+                 'size': str(size), 'filled_size': '0', 'product_id': product_id,
+                 'post_only': post_only, 'created_at': self.last_time, 'status': 'pending'}
+        if post_only and ((side == 'buy' and price >= self.order_book.get_ask()) or
+                          (side == 'sell' and price <= self.order_book.get_bid())):
+            order['status'] = 'rejected'
+            order['reject_reason'] = 'post only'
+            return dict(order)
+        order['status'] = 'open'
+        self.holds[currency] += hold
+        self.orders[order['id']] = order
+        return dict(order)
+
+    def buy(self, **kwargs):
+        return self.place_order('buy', **kwargs)
+
+    def sell(self, **kwargs):
+        return self.place_order('sell', **kwargs)
+
+    def release_hold(self, order):
+        remaining = Decimal(order['size']) - Decimal(order['filled_size'])
+        if order['side'] == 'buy':
+            self.holds['USD'] -= remaining * Decimal(order['price'])
+        else:
+            self.holds['BTC'] -= remaining
+
+    def get_order(self, order_id):
+        order = self.orders.get(order_id)
+        if order is None:
+            return {'message': 'NotFound'}
+        return dict(order)
+
+    def get_orders(self):
+        return [[dict(order) for order in self.orders.values() if order['status'] == 'open']]
+
+    def get_fills(self, limit=100):
+        return [self.fills[:-limit - 1:-1]]
+
+    def cancel_order(self, order_id):
+        order = self.orders.get(order_id)
+        if order is None or order['status'] != 'open':
+            return {'message': 'NotFound'}
+        self.release_hold(order)
+        # GDAX forgets canceled orders, so a later lookup returns NotFound
+        del self.orders[order_id]
+        return [order_id]
+
+    def cancel_all(self, product_id='BTC-USD'):
+        return [order_id for order_id in list(self.orders)
+                if self.orders[order_id]['product_id'] == product_id and
+                self.cancel_order(order_id) == [order_id]]
+
+    def process_match(self, msg):
+        self.last_time = msg.get('time')
+        trade_price = Decimal(msg.get('price'))
+        trade_size = Decimal(msg.get('size'))
+        for order in list(self.orders.values()):
+            if order['status'] != 'open' or trade_size <= 0:
+                continue
+            price = Decimal(order['price'])
+            if (order['side'] == 'buy' and trade_price > price) or \
+               (order['side'] == 'sell' and trade_price < price):
+                continue
+            filled = Decimal(order['filled_size'])
+            size = min(Decimal(order['size']) - filled, trade_size)
+            trade_size -= size
+            self.fill(order, price, size)
+
+    def fill(self, order, price, size):
+        value = price * size
+        fee = value * self.fee_rate
+        if order['side'] == 'buy':
+            self.holds['USD'] -= value
+            self.balances['USD'] -= value + fee
+            self.balances['BTC'] += size
+        else:
+            self.holds['BTC'] -= size
+            self.balances['BTC'] -= size
+            self.balances['USD'] += value - fee
+        order['filled_size'] = str(Decimal(order['filled_size']) + size)
+        if Decimal(order['filled_size']) >= Decimal(order['size']):
+            order['status'] = 'done'
+            order['done_reason'] = 'filled'
+
+        slippage = None
+        if self.reference_price is not None:
+            slippage = price - self.reference_price
+            if order['side'] == 'sell':
+                slippage = -slippage
+        self.fills.append({'order_id': order['id'], 'side': order['side'], 'price': str(price),
+                           'size': str(size), 'fee': str(fee), 'created_at': self.last_time,
+                           'slippage': slippage})
+
+    def equity(self, price):
+        return self.balances['USD'] + self.balances['BTC'] * price
+
+
+class BacktestTradeEngine(engine.TradeEngine):
+    """
+    TradeEngine that drives the buy/sell order loops one step per replayed
+    message instead of in a background thread, so runs are deterministic.
+    """
+    def __init__(self, auth_client, order_book):
+        engine.TradeEngine.__init__(self, auth_client, is_live=True, order_book=order_book)
+        self.active_order = None
+
+    def start_order(self, side):
+        if self.active_order is not None:
+            if self.active_order[0] != side:
+                # Let the opposite order notice its flag was cleared
+                self.step_orders()
+            return
+        self.auth_client.reference_price = self.order_book.get_mid()
+        self.active_order = [side, getattr(self, 'place_' + side)('0.5')]
+
+    def determine_trades(self, indicators):
+        # Balances are refreshed by the order thread when live
+        self.update_amounts()
+        engine.TradeEngine.determine_trades(self, indicators)
+
+    def step_orders(self):
+        if self.active_order is None:
+            return
+        side, ret = self.active_order
+        if ret.get('status') != 'done' and getattr(self, side + '_flag'):
+            self.active_order[1] = getattr(self, 'update_' + side)(ret)
+        else:
+            getattr(self, 'finish_' + side)(ret)
+            self.active_order = None
+
+
+class Backtester:
+    def __init__(self, usd='1000.00', btc='0.0', fee_rate='0.0', period_size=60, history=None):
+        self.order_book = SimulatedOrderBook()
+        self.exchange = SimulatedExchange(self.order_book, usd=usd, btc=btc, fee_rate=fee_rate)
+        self.trade_engine = BacktestTradeEngine(self.exchange, self.order_book)
+        self.period = period.Period(period_size=period_size, name='1', initialize=False)
+        if history is not None:
+            self.period.candlesticks.extend(history)
+        self.period_list = [self.period]
+        self.indicator_subsys = indicators.IndicatorSubsystem(self.period_list)
+        self.microstructure = microstructure.MicrostructureFeatures(self.order_book)
+        self.message_count = 0
+        self.last_price = None
+
+    def indicators_ready(self):
+        cur_indicators = self.indicator_subsys.current_indicators[self.period.name]
+        return 'macd_hist_diff' in cur_indicators and not (cur_indicators['macd_hist_diff'].is_nan() or
+                                                           math.isnan(cur_indicators['mfi']))
+
+    def process_message(self, msg):
+        # Mirrors the main loop in gdax-trader.py
+        self.message_count += 1
+        if msg.get('type') == "match":
+            self.last_price = Decimal(msg.get('price'))
+            self.order_book.process_match(msg)
+            self.exchange.process_match(msg)
+            for cur_period in self.period_list:
+                cur_period.process_trade(msg)
+                self.indicator_subsys.recalculate_indicators(cur_period, self.order_book)
+            self.microstructure.process_trade(msg)
+            self.indicator_subsys.current_indicators['micro'] = self.microstructure.features()
+            if self.indicators_ready():
+                self.trade_engine.determine_trades(self.indicator_subsys.current_indicators)
+            self.trade_engine.step_orders()
+        elif msg.get('type') == "heartbeat":
+            for cur_period in self.period_list:
+                cur_period.process_heartbeat(msg)
+            self.microstructure.process_heartbeat(msg)
+            self.indicator_subsys.current_indicators['micro'] = self.microstructure.features()
+            if self.indicators_ready():
+                self.trade_engine.determine_trades(self.indicator_subsys.current_indicators)
+            self.trade_engine.step_orders()
+
+    def run(self, messages):
+        start_equity = None
+        start_time = time.time()
+        for msg in messages:
+            self.process_message(msg)
+            if start_equity is None and self.last_price is not None:
+                start_equity = self.exchange.equity(self.last_price)
+        elapsed = time.time() - start_time
+        return self.report(start_equity, elapsed)
+
+    def report(self, start_equity, elapsed):
+        fills = self.exchange.fills
+        slippage = [fill['slippage'] for fill in fills if fill['slippage'] is not None]
+        end_equity = self.exchange.equity(self.last_price) if self.last_price is not None else None
+        return {
+            'messages': self.message_count,
+            'seconds': elapsed,
+            'messages_per_second': self.message_count / elapsed if elapsed > 0 else float('inf'),
+            'fills': len(fills),
+            'buys': len([fill for fill in fills if fill['side'] == 'buy']),
+            'sells': len([fill for fill in fills if fill['side'] == 'sell']),
+            'avg_slippage': sum(slippage) / len(slippage) if slippage else Decimal('0'),
+            'usd': self.exchange.balances['USD'],
+            'btc': self.exchange.balances['BTC'],
+            'start_equity': start_equity,
+            'end_equity': end_equity,
+            'pnl': end_equity - start_equity if start_equity is not None else Decimal('0'),
+        }
+
+
+def print_report(report, out=sys.stdout):
+    for key in ('messages', 'seconds', 'messages_per_second', 'fills', 'buys', 'sells',
+                'avg_slippage', 'usd', 'btc', 'start_equity', 'end_equity', 'pnl'):
+        out.write("%-20s %s\n" % (key, report[key]))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Replay recorded GDAX messages through the trading logic")
+    parser.add_argument('messages', help="file with one match/heartbeat message (JSON) per line, "
+                                         "or a tick capture directory")
+    parser.add_argument('--usd', default='1000.00', help="starting USD balance")
+    parser.add_argument('--btc', default='0.0', help="starting BTC balance")
+    parser.add_argument('--fee-rate', default='0.0', help="fee charged on each fill, as a fraction")
+    parser.add_argument('--period-size', type=int, default=60, help="candlestick size in seconds")
+    args = parser.parse_args()
+
+    backtester = Backtester(usd=args.usd, btc=args.btc, fee_rate=args.fee_rate, period_size=args.period_size)
+    if os.path.isdir(args.messages):
+        messages = tickstore.TickReader(args.messages).messages()
+    else:
+        messages = load_messages(args.messages)
+    print_report(backtester.run(messages))
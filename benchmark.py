@@ -0,0 +1,474 @@
+#
+# benchmark.py
+# Mike Cardillo
+#
+# Microbenchmarks of the hot paths between the websocket and the trading
+# logic, run against synthetic or recorded GDAX messages. The exchange is the
+# simulated one from backtest.py, so no network is needed.
+
+import os
+import sys
+import json
+import time
+import random
+import logging
+import platform
+import argparse
+import datetime
+import subprocess
+from timeit import default_timer
+from decimal import Decimal
+import numpy as np
+import period
+import trade
+import orderbook
+import indicators
+import backtest
+import tickstore
+
+
+def synthetic_matches(count, start=datetime.datetime(2017, 9, 1), trades_per_second=20.0, seed=0):
+    # Match messages in the format of the GDAX websocket feed
+    rng = random.Random(seed)
+    price = 4000.0
+    messages = []
+    for idx in range(count):
+        isotime = start + datetime.timedelta(seconds=idx / trades_per_second)
+        price = max(0.01, price + rng.gauss(0.0, 0.5))
+        messages.append({'type': 'match', 'product_id': 'BTC-USD', 'sequence': idx + 1, 'trade_id': idx + 1,
+                         'time': isotime.strftime('%Y-%m-%dT%H:%M:%S.%fZ'), 'price': '%.2f' % price,
+                         'size': '%.8f' % rng.uniform(0.001, 2.0), 'side': rng.choice(('buy', 'sell'))})
+    return messages
+
+
+def timed(func, messages, repeat=3):
+    # Best of repeat runs, in messages per second
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        func(messages)
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return len(messages) / best
+
+
+def bench_parse_time(messages, repeat=3):
+    timestamps = [msg['time'] for msg in messages]
+
+    def run(timestamps):
+        for isotime in timestamps:
+            trade.parse_time(isotime)
+    return timed(run, timestamps, repeat)
+
+
+def bench_process_trade(messages, repeat=3):
+    def run(messages):
+        cur_period = period.Period(period_size=60, name='1', initialize=False)
+        for msg in messages:
+            cur_period.process_trade(msg)
+    return timed(run, messages, repeat)
+
+
+def synthetic_history(count, end, period_size=60, seed=0):
+    # Closed candlesticks (GDAX historic rates layout, oldest first) up to end
+    rng = np.random.RandomState(seed)
+    closes = 4000.0 + np.cumsum(rng.normal(0.0, 2.0, count))
+    opens = np.concatenate(([closes[0]], closes[:-1]))
+    spread = rng.uniform(0.0, 3.0, (2, count))
+    times = end - end % period_size - period_size * np.arange(count, 0, -1)
+    return np.column_stack((times, np.minimum(opens, closes) - spread[0], np.maximum(opens, closes) + spread[1],
+                            opens, closes, rng.uniform(1.0, 50.0, count)))
+
+
+def percentiles(samples, points=(50, 90, 99)):
+    # Latency percentiles in microseconds, from samples in seconds
+    samples = np.asarray(samples, dtype='f8') * 1e6
+    result = dict(('p%d' % point, float(np.percentile(samples, point))) for point in points)
+    result['max'] = float(samples.max())
+    result['samples'] = len(samples)
+    return result
+
+
+def bench_close_candlestick(count=100000, trades_per_candle=20):
+    """
+    Percentiles of Candlestick.close_candlestick(), for candlesticks that
+    saw trades and for empty ones that copy the previous close.
+    """
+    start = trade.parse_time('2017-09-01T00:00:00.000000Z')
+    cur_trade = trade.Trade({'time': '2017-09-01T00:00:00.000000Z', 'sequence': 1, 'trade_id': 1, 'price': '4000.00',
+                             'size': '0.5', 'side': 'buy'})
+    prev_stick = np.array([period.to_epoch(start) - 60, 3999.0, 4001.0, 4000.0, 4000.0, 1.0])
+    results = {}
+    for name, trades in (('traded', trades_per_candle), ('empty', 0)):
+        samples = []
+        for idx in range(count):
+            stick = period.Candlestick(isotime=start)
+            for _ in range(trades):
+                stick.add_trade(cur_trade)
+            before = default_timer()
+            stick.close_candlestick('1', prev_stick=prev_stick)
+            samples.append(default_timer() - before)
+        results[name] = percentiles(samples)
+    return results
+
+
+def bench_recalculate_indicators(history_lengths, calls=2000, seed=0):
+    """
+    IndicatorSubsystem.recalculate_indicators() latency for periods holding
+    each number of closed candlesticks. The first call warms the streaming
+    indicators up from the whole history and is reported separately.
+    """
+    order_book = backtest.SimulatedOrderBook()
+    order_book.bid, order_book.ask = Decimal('3999.99'), Decimal('4000.01')
+    results = {}
+    for length in history_lengths:
+        history = synthetic_history(length + 1, time.time(), seed=seed)
+        cur_period = period.Period(period_size=60, name='1', initialize=False, max_candlesticks=max(length, 1))
+        cur_period.candlesticks.extend(history[:-1])
+        cur_period.cur_candlestick = period.Candlestick(existing_candlestick=history[-1])
+        indicator_subsys = indicators.IndicatorSubsystem([cur_period])
+        before = default_timer()
+        indicator_subsys.recalculate_indicators(cur_period, order_book)
+        warmup = default_timer() - before
+        samples = []
+        for _ in range(calls):
+            before = default_timer()
+            indicator_subsys.recalculate_indicators(cur_period, order_book)
+            samples.append(default_timer() - before)
+        result = percentiles(samples)
+        result['warmup'] = warmup * 1e6
+        results[str(length)] = result
+    return results
+
+
+class LatencyBacktester(backtest.Backtester):
+    """
+    Backtester that times every match from the moment it is handed to
+    process_message() until determine_trades() returns for it.
+    """
+    def __init__(self, **kwargs):
+        backtest.Backtester.__init__(self, **kwargs)
+        self.received = None
+        self.samples = []
+        determine_trades = self.trade_engine.determine_trades
+
+        def timed_determine_trades(current_indicators):
+            determine_trades(current_indicators)
+            if self.received is not None:
+                self.samples.append(default_timer() - self.received)
+        self.trade_engine.determine_trades = timed_determine_trades
+
+    def process_message(self, msg):
+        self.received = default_timer() if msg.get('type') == "match" else None
+        backtest.Backtester.process_message(self, msg)
+
+
+def bench_end_to_end(messages, history_length=500):
+    """
+    Match to determine_trades() latency through Period, IndicatorSubsystem
+    and TradeEngine, trading against the simulated exchange.
+    """
+    first = trade.parse_time(next(msg['time'] for msg in messages if msg.get('time')))
+    history = synthetic_history(history_length, period.to_epoch(first))
+    backtester = LatencyBacktester(history=history)
+    report = backtester.run(messages)
+    result = percentiles(backtester.samples) if backtester.samples else {'samples': 0}
+    result['messages_per_second'] = report['messages_per_second']
+    result['fills'] = report['fills']
+    return result
+
+
+def format_fixed(units, places):
+    return '%d.%0*d' % (units // 10 ** places, places, units % 10 ** places)
+
+
+def synthetic_full_channel(count, levels=1000, seed=0):
+    """
+    Level 3 snapshot and full channel messages (received, open, done, match,
+    change) around a fixed mid price. Matches always take the oldest order of
+    a level, as on the exchange.
+    """
+    rng = random.Random(seed)
+    mid = 400000
+    queues = {}
+    orders = {}
+    # Resting order ids in a list with their positions, for O(1) random picks
+    order_ids = []
+    positions = {}
+    snapshot = {'sequence': 1000, 'bids': [], 'asks': []}
+    next_id = [0]
+
+    def new_order(side, tick, size):
+        next_id[0] += 1
+        order_id = 'order-%d' % next_id[0]
+        orders[order_id] = [side, tick, size]
+        queues.setdefault(tick, []).append(order_id)
+        positions[order_id] = len(order_ids)
+        order_ids.append(order_id)
+        return order_id
+
+    def remove_order(order_id):
+        tick = orders.pop(order_id)[1]
+        queues[tick].remove(order_id)
+        if not queues[tick]:
+            del queues[tick]
+        last = order_ids.pop()
+        if last != order_id:
+            order_ids[positions[order_id]] = last
+            positions[last] = positions[order_id]
+        del positions[order_id]
+
+    for level in range(levels):
+        for _ in range(rng.randint(1, 3)):
+            for side, tick in (('buy', mid - 1 - level), ('sell', mid + 1 + level)):
+                size = rng.randint(1, 200) * 1000000
+                order_id = new_order(side, tick, size)
+                snapshot['bids' if side == 'buy' else 'asks'].append(
+                    [format_fixed(tick, 2), format_fixed(size, 8), order_id])
+
+    messages = []
+    sequence = snapshot['sequence']
+    while len(messages) < count:
+        choice = rng.random()
+        if choice < 0.45:
+            side = rng.choice(('buy', 'sell'))
+            tick = mid - 1 - rng.randint(0, 50) if side == 'buy' else mid + 1 + rng.randint(0, 50)
+            size = rng.randint(1, 200) * 1000000
+            order_id = new_order(side, tick, size)
+            for msg_type in ('received', 'open'):
+                sequence += 1
+                msg = {'type': msg_type, 'sequence': sequence, 'order_id': order_id, 'side': side,
+                       'price': format_fixed(tick, 2)}
+                msg['size' if msg_type == 'received' else 'remaining_size'] = format_fixed(size, 8)
+                messages.append(msg)
+            continue
+        if choice < 0.7:
+            order_id = rng.choice(order_ids)
+            side, tick, size = orders[order_id]
+            reason = 'canceled'
+        elif choice < 0.99:
+            side = rng.choice(('buy', 'sell'))
+            # Best level of the side, searching outwards from the mid
+            step = -1 if side == 'buy' else 1
+            tick = mid + step
+            while tick not in queues and abs(tick - mid) <= levels + 50:
+                tick += step
+            if tick not in queues:
+                continue
+            order_id = queues[tick][0]
+            size = orders[order_id][2]
+            fill = min(size, rng.randint(1, 200) * 1000000)
+            sequence += 1
+            messages.append({'type': 'match', 'sequence': sequence, 'maker_order_id': order_id,
+                             'taker_order_id': 'taker', 'side': side, 'price': format_fixed(tick, 2),
+                             'size': format_fixed(fill, 8)})
+            orders[order_id][2] -= fill
+            if orders[order_id][2] > 0:
+                continue
+            size = 0
+            reason = 'filled'
+        else:
+            order_id = rng.choice(order_ids)
+            side, tick, size = orders[order_id]
+            if size <= 1000000:
+                continue
+            new_size = size // 2
+            sequence += 1
+            messages.append({'type': 'change', 'sequence': sequence, 'order_id': order_id, 'side': side,
+                             'price': format_fixed(tick, 2), 'old_size': format_fixed(size, 8),
+                             'new_size': format_fixed(new_size, 8)})
+            orders[order_id][2] = new_size
+            continue
+        sequence += 1
+        messages.append({'type': 'done', 'sequence': sequence, 'order_id': order_id, 'side': side,
+                         'price': format_fixed(tick, 2), 'remaining_size': format_fixed(size, 8),
+                         'reason': reason})
+        remove_order(order_id)
+    return snapshot, messages
+
+
+def deep_sizeof(obj, seen=None):
+    # Rough memory footprint of obj and everything it references
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(deep_sizeof(key, seen) + deep_sizeof(value, seen) for key, value in obj.items())
+    elif isinstance(obj, (list, tuple, set)):
+        size += sum(deep_sizeof(item, seen) for item in obj)
+    else:
+        if hasattr(obj, '__dict__'):
+            size += deep_sizeof(obj.__dict__, seen)
+        for slot in getattr(type(obj), '__slots__', ()):
+            if hasattr(obj, slot):
+                size += deep_sizeof(getattr(obj, slot), seen)
+    return size
+
+
+def bench_order_book(snapshot, messages, repeat=3):
+    """
+    Replays messages through orderbook.OrderBook. Returns messages per
+    second, bytes per price level and per order, and the snapshot load time.
+    """
+    book = orderbook.OrderBook()
+
+    def run(messages):
+        book.load_snapshot(snapshot, time.time())
+        for msg in messages:
+            book.process(msg)
+    rate = timed(run, messages, repeat)
+    levels = len(book.bids) + len(book.asks)
+    memory = float(deep_sizeof([book.bids, book.asks, book.orders]))
+    return rate, memory / max(levels, 1), memory / max(len(book.orders), 1), book.last_resync_seconds
+
+
+def gdax_order_book():
+    # gdax.OrderBook.__init__ in gdax 1.0.6 fails on an undefined log_to, and
+    # would set up a websocket and REST client, so only its book is set up here
+    import gdax
+    from bintrees import RBTree
+    book = gdax.OrderBook.__new__(gdax.OrderBook)
+    book._asks = RBTree()
+    book._bids = RBTree()
+    book._sequence = -1
+    book._log_to = None
+    book._current_ticker = None
+    return book
+
+
+def bench_gdax_order_book(snapshot, messages, repeat=3):
+    # The same replay through gdax.OrderBook (bintrees), for comparison
+    holder = {}
+
+    def run(messages):
+        book = holder['book'] = gdax_order_book()
+        for price, size, order_id in snapshot['bids']:
+            book.add({'id': order_id, 'side': 'buy', 'price': Decimal(price), 'size': Decimal(size)})
+        for price, size, order_id in snapshot['asks']:
+            book.add({'id': order_id, 'side': 'sell', 'price': Decimal(price), 'size': Decimal(size)})
+        book._sequence = snapshot['sequence']
+        for msg in messages:
+            book.on_message(msg)
+    rate = timed(run, messages, repeat)
+    book = holder['book']
+    levels = len(book._bids) + len(book._asks)
+    orders = sum(len(level) for tree in (book._bids, book._asks) for level in tree.values())
+    memory = float(deep_sizeof([book._bids, book._asks]))
+    return rate, memory / max(levels, 1), memory / max(orders, 1)
+
+
+def git_revision():
+    try:
+        with open(os.devnull, 'w') as devnull:
+            return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=devnull,
+                                           cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def load_stream(path):
+    # Recorded match/heartbeat messages, from JSON lines or a tick capture
+    if os.path.isdir(path):
+        return list(tickstore.TickReader(path).messages())
+    return list(backtest.load_messages(path))
+
+
+def compare(results, baseline, prefix='', out=sys.stdout):
+    # Relative change of every number also present in a previous run
+    for key in sorted(results):
+        if key == 'samples':
+            continue
+        value, old = results[key], baseline.get(key)
+        if isinstance(value, dict) and isinstance(old, dict):
+            compare(value, old, prefix + key + '.', out)
+        elif isinstance(value, (int, float)) and isinstance(old, (int, float)) and old:
+            out.write("%-48s %14.1f %14.1f %+8.1f%%\n" % (prefix + key, old, value, 100.0 * (value - old) / old))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark message processing hot paths")
+    parser.add_argument('--messages', type=int, default=100000, help="synthetic match messages per run")
+    parser.add_argument('--stream', default=None,
+                        help="recorded match/heartbeat messages (JSON lines or a tick capture directory) "
+                             "to use instead of synthetic matches")
+    parser.add_argument('--repeat', type=int, default=3, help="runs per benchmark, the best one is reported")
+    parser.add_argument('--history', default='100,1000,10000',
+                        help="comma separated candlestick counts for the indicator benchmark")
+    parser.add_argument('--indicator-calls', type=int, default=2000,
+                        help="recalculate_indicators calls timed per history length")
+    parser.add_argument('--candles', type=int, default=100000, help="close_candlestick calls timed")
+    parser.add_argument('--book-messages', type=int, default=200000,
+                        help="synthetic full channel messages for the order book benchmark")
+    parser.add_argument('--book-stream', default=None,
+                        help="recorded full channel messages (JSON lines) to replay instead, "
+                             "the first line being a level 3 snapshot")
+    parser.add_argument('--compare-gdax', action='store_true', help="also replay through gdax.OrderBook")
+    parser.add_argument('--debug-log', action='store_true',
+                        help="log at DEBUG to a null handler, as gdax-trader.py logs to debug.log")
+    parser.add_argument('--json', default=None, help="write the results to this file as JSON")
+    parser.add_argument('--baseline', default=None, help="JSON results of an earlier run to compare against")
+    args = parser.parse_args()
+
+    if args.debug_log:
+        logger = logging.getLogger('trader-logger')
+        logger.setLevel(logging.DEBUG)
+        logger.addHandler(logging.NullHandler())
+
+    results = {}
+    if args.stream:
+        messages = load_stream(args.stream)
+    else:
+        messages = synthetic_matches(args.messages)
+    matches = [msg for msg in messages if msg.get('type') == "match"]
+    results['parse_time'] = {'messages_per_second': bench_parse_time(matches, args.repeat)}
+    sys.stdout.write("%-16s %12.0f msg/s\n" % ('parse_time', results['parse_time']['messages_per_second']))
+    results['process_trade'] = {'messages_per_second': bench_process_trade(matches, args.repeat)}
+    sys.stdout.write("%-16s %12.0f msg/s\n" % ('process_trade', results['process_trade']['messages_per_second']))
+
+    results['close_candlestick'] = bench_close_candlestick(args.candles)
+    for name, result in sorted(results['close_candlestick'].items()):
+        sys.stdout.write("%-16s %12.2f us p50 %10.2f us p99  (%s)\n" %
+                         ('close_candle', result['p50'], result['p99'], name))
+
+    results['recalculate_indicators'] = bench_recalculate_indicators(
+        [int(length) for length in args.history.split(',')], args.indicator_calls)
+    for length, result in sorted(results['recalculate_indicators'].items(), key=lambda item: int(item[0])):
+        sys.stdout.write("%-16s %12.2f us p50 %10.2f us p99 %10.0f us warmup  (%s candles)\n" %
+                         ('indicators', result['p50'], result['p99'], result['warmup'], length))
+
+    results['end_to_end'] = bench_end_to_end(messages)
+    result = results['end_to_end']
+    if result['samples']:
+        sys.stdout.write("%-16s %12.2f us p50 %10.2f us p90 %10.2f us p99 %10.2f us max\n" %
+                         ('match_to_trade', result['p50'], result['p90'], result['p99'], result['max']))
+
+    if args.book_stream:
+        with open(args.book_stream) as stream:
+            book_messages = [json.loads(line) for line in stream if line.strip()]
+        snapshot, book_messages = book_messages[0], book_messages[1:]
+    else:
+        snapshot, book_messages = synthetic_full_channel(args.book_messages)
+    rate, level_bytes, order_bytes, resync = bench_order_book(snapshot, book_messages, args.repeat)
+    results['orderbook'] = {'messages_per_second': rate, 'bytes_per_level': level_bytes,
+                            'bytes_per_order': order_bytes, 'snapshot_seconds': resync}
+    sys.stdout.write("%-16s %12.0f msg/s %8.0f bytes/level %6.0f bytes/order  snapshot %.3f s\n" %
+                     ('orderbook', rate, level_bytes, order_bytes, resync))
+    if args.compare_gdax:
+        rate, level_bytes, order_bytes = bench_gdax_order_book(snapshot, book_messages, args.repeat)
+        results['gdax_orderbook'] = {'messages_per_second': rate, 'bytes_per_level': level_bytes,
+                                     'bytes_per_order': order_bytes}
+        sys.stdout.write("%-16s %12.0f msg/s %8.0f bytes/level %6.0f bytes/order\n" %
+                         ('gdax.OrderBook', rate, level_bytes, order_bytes))
+
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+        sys.stdout.write("\n%-48s %14s %14s %9s\n" % ('', baseline.get('revision'), git_revision(), 'change'))
+        compare(results, baseline['results'])
+    if args.json:
+        with open(args.json, 'w') as json_file:
+            json.dump({'revision': git_revision(), 'time': time.time(), 'python': platform.python_version(),
+                       'arguments': vars(args), 'results': results}, json_file, indent=2, sort_keys=True)
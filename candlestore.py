@@ -0,0 +1,123 @@
+#
+# candlestore.py
+# Mike Cardillo
+#
+# On-disk checkpoints of closed candlesticks, so a restart only has to fetch
+# the candles it missed instead of reloading history over REST.
+#
+# Each product and granularity gets one append-only file of float64 rows in
+# the GDAX historic rates layout (time, low, high, open, close, volume),
+# oldest first.
+
+import os
+import logging
+import numpy as np
+
+ROW_BYTES = 6 * 8
+SUFFIX = '.candles'
+
+
+def unique_rows(rows):
+    # Sorted by time, keeping the last of the rows that share a time
+    reverse = rows[::-1]
+    times, first = np.unique(reverse[:, 0], return_index=True)
+    return reverse[first]
+
+
+class CandleStore:
+    def __init__(self, root):
+        self.logger = logging.getLogger('trader-logger')
+        self.root = root
+
+    def path(self, product_id, granularity):
+        directory = os.path.join(self.root, product_id)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        return os.path.join(directory, '%d%s' % (granularity, SUFFIX))
+
+    def count(self, product_id, granularity):
+        path = self.path(product_id, granularity)
+        return os.path.getsize(path) // ROW_BYTES if os.path.exists(path) else 0
+
+    def load(self, product_id, granularity, limit=None):
+        # The most recent limit rows, ignoring a partially written last row
+        count = self.count(product_id, granularity)
+        if count == 0:
+            return np.zeros((0, 6))
+        rows = np.memmap(self.path(product_id, granularity), dtype='f8', mode='r', shape=(count, 6))
+        if limit is not None:
+            rows = rows[-limit:]
+        return np.array(rows)
+
+    def load_range(self, product_id, granularity, start=None, end=None):
+        # Rows with start <= time < end, found by binary search on the times
+        count = self.count(product_id, granularity)
+        if count == 0:
+            return np.zeros((0, 6))
+        rows = np.memmap(self.path(product_id, granularity), dtype='f8', mode='r', shape=(count, 6))
+        first = np.searchsorted(rows[:, 0], start) if start is not None else 0
+        last = np.searchsorted(rows[:, 0], end) if end is not None else count
+        return np.array(rows[first:last])
+
+    def last_time(self, product_id, granularity):
+        count = self.count(product_id, granularity)
+        if count == 0:
+            return None
+        with open(self.path(product_id, granularity), 'rb') as candle_file:
+            candle_file.seek((count - 1) * ROW_BYTES)
+            return np.frombuffer(candle_file.read(ROW_BYTES), dtype='f8')[0]
+
+    def append(self, product_id, granularity, rows):
+        rows = np.ascontiguousarray(rows, dtype='f8').reshape(-1, 6)
+        if len(rows) == 0:
+            return
+        path = self.path(product_id, granularity)
+        with open(path, 'ab') as candle_file:
+            # Drop the tail of a row cut short by a crash
+            size = candle_file.tell()
+            if size % ROW_BYTES:
+                candle_file.truncate(size - size % ROW_BYTES)
+            candle_file.write(rows.tobytes())
+
+    def merge(self, product_id, granularity, rows):
+        """
+        Stores rows from any time range, replacing stored rows with the same
+        time. Rows newer than everything stored are appended, otherwise the
+        file is rewritten in time order.
+        """
+        rows = np.asarray(rows, dtype='f8').reshape(-1, 6)
+        if len(rows) == 0:
+            return
+        last = self.last_time(product_id, granularity)
+        rows = unique_rows(rows)
+        if last is None or rows[0, 0] > last:
+            self.append(product_id, granularity, rows)
+            return
+        rows = unique_rows(np.concatenate((self.load(product_id, granularity), rows)))
+        path = self.path(product_id, granularity)
+        with open(path + '.tmp', 'wb') as candle_file:
+            candle_file.write(rows.tobytes())
+        os.rename(path + '.tmp', path)
+
+    def amend_last(self, product_id, granularity, row):
+        count = self.count(product_id, granularity)
+        if count == 0:
+            return
+        with open(self.path(product_id, granularity), 'r+b') as candle_file:
+            candle_file.seek((count - 1) * ROW_BYTES)
+            candle_file.write(np.asarray(row, dtype='f8').tobytes())
+
+    def checkpoint(self, product_id, granularity, row, amended=False):
+        """
+        Persists a closed (or amended) candlestick. A row that is not newer
+        than the last stored one replaces it instead of being appended.
+        """
+        last = self.last_time(product_id, granularity)
+        if last is not None and row[0] <= last:
+            if row[0] == last:
+                self.amend_last(product_id, granularity, row)
+            return
+        if amended:
+            # Amendment of a candle that was never stored
+            return
+        self.append(product_id, granularity, row)
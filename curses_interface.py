@@ -1,11 +1,33 @@
 import curses
+import logging
+import threading
+import period as period_module
+
+# Columns a full-width line is padded to, clipped to the terminal
+WIDTH = 120
 
 
 class cursesDisplay:
-    def __init__(self, enable=True):
+    """
+    The update_* methods only publish an immutable snapshot (tuples of
+    plain values) of what they are given for their region of the screen.
+    A renderer thread draws the latest snapshots at most fps times a second,
+    redrawing only the regions whose snapshot changed since the last frame,
+    so the trading loop never waits on the terminal.
+    """
+    def __init__(self, enable=True, fps=4.0):
         self.enable = enable
         if not self.enable:
             return
+        self.logger = logging.getLogger('trader-logger')
+        self.fps = fps
+        # region -> latest snapshot, replaced whole so no lock is needed
+        self.snapshots = {}
+        self.drawn = {}
+        self.closed_total = None
+        self.closed_rows = ()
+        self.stop = False
+        self.stopped = threading.Event()
         self.stdscr = curses.initscr()
         curses.start_color()
         curses.noecho()
@@ -14,72 +36,130 @@ class cursesDisplay:
         curses.init_pair(2, curses.COLOR_BLACK, curses.COLOR_RED)
         self.stdscr.keypad(1)
         self.stdscr.addstr(1, 0, "Waiting for a trade...")
+        self.stdscr.refresh()
+        self.thread = threading.Thread(target=self.run, name='curses_renderer')
+        self.thread.daemon = True
+        self.thread.start()
 
     def update_balances(self, btc, usd):
         if not self.enable:
             return
-        self.stdscr.addstr(0, 0, "USD: %.2f BTC: %.8f" % (usd, btc))
-        self.stdscr.refresh()
+        self.snapshots['balances'] = (float(usd), float(btc))
 
     def update_candlesticks(self, period):
         if not self.enable:
             return
         cur_stick = period.cur_candlestick
-
-        self.stdscr.addstr(4, 0, "%s O: %f H: %f L: %f C: %f V: %f" %
-                           (cur_stick.time, cur_stick.open, cur_stick.high,
-                            cur_stick.low, cur_stick.close, cur_stick.volume),
-                           self.print_color(cur_stick.open, cur_stick.close))
-        starty = 5
-        for cur_stick in period.candlesticks[:-6:-1]:
-            self.stdscr.addstr(starty, 0, "%s O: %f H: %f L: %f C: %f V: %f" %
-                               (cur_stick[0], cur_stick[3], cur_stick[2],
-                                cur_stick[1], cur_stick[4], cur_stick[5]),
-                               self.print_color(cur_stick[3], cur_stick[4]))
-            starty += 1
-        self.stdscr.refresh()
+        if cur_stick is None or cur_stick.open is None:
+            # No trade in the current candlestick yet
+            return
+        # Closed candlesticks only change when one closes or is amended
+        last_row = tuple(period.candlesticks[-1]) if len(period.candlesticks) else None
+        if period.candlesticks.total != self.closed_total or \
+           (self.closed_rows and self.closed_rows[0] != last_row):
+            self.closed_total = period.candlesticks.total
+            self.closed_rows = tuple(tuple(row) for row in period.candlesticks[:-6:-1])
+        self.snapshots['candlesticks'] = ((cur_stick.time, cur_stick.open, cur_stick.high, cur_stick.low,
+                                           cur_stick.close, cur_stick.volume), self.closed_rows)
 
     def update_heartbeat(self, msg):
         if not self.enable:
             return
-        self.stdscr.addstr(0, 35, msg.get('time'))
-        self.stdscr.refresh()
+        self.snapshots['heartbeat'] = msg.get('time')
 
     def update_indicators(self, indicators):
         if not self.enable:
             return
-        self.stdscr.addstr(1, 0, "1 - MACD_DIFF: %f MACD_HIST: %f MFI: %f" %
-                           (indicators['1']['macd_hist_diff'], indicators['1']['macd_hist'], indicators['1']['mfi']))
-        self.stdscr.refresh()
+        values = indicators.get('1', {})
+        if not all(key in values for key in ('macd_hist_diff', 'macd_hist', 'mfi')):
+            # Not calculated yet
+            return
+        self.snapshots['indicators'] = (values['macd_hist_diff'], values['macd_hist'], values['mfi'])
 
     def update_orders(self, trade_engine):
+        # Only reads what the REST client already has cached
         if not self.enable:
             return
+        fills = tuple((fill.get('side'), fill.get('price'), fill.get('size'), fill.get('created_at'))
+                      for fill in trade_engine.get_cached('get_fills', [[]], limit=5)[0][:5])
+        orders = None
+        # The order thread lives on, an order is worked while active_side is set
+        if trade_engine.active_side is not None:
+            if trade_engine.tracking():
+                open_orders = trade_engine.get_open_orders()
+            else:
+                open_orders = trade_engine.get_cached('get_orders', [[]])[0]
+            orders = tuple((order.get('side'), order.get('price'), order.get('size'), order.get('status'))
+                           for order in open_orders[:5])
+        self.snapshots['orders'] = (fills, orders)
+
+    def draw_balances(self, snapshot):
+        usd, btc = snapshot
+        return [(0, 0, "USD: %.2f BTC: %.8f" % (usd, btc), 0, 35)]
+
+    def draw_heartbeat(self, snapshot):
+        return [(0, 35, snapshot, 0, WIDTH - 35)]
+
+    def draw_indicators(self, snapshot):
+        return [(1, 0, "1 - MACD_DIFF: %f MACD_HIST: %f MFI: %f" % snapshot, 0, WIDTH)]
 
-        self.stdscr.addstr(11, 0, "Recent Fills")
-        starty = 12
-        for fill in trade_engine.auth_client.get_fills(limit=5)[0]:
-            self.stdscr.addstr(starty, 0, "%s Price: %s Size: %s Time: %s" %
-                               (fill.get('side').upper(), fill.get('price'),
-                                fill.get('size'), fill.get('created_at')))
-            starty += 1
-
-        self.stdscr.addstr(18, 0, "Open Orders")
-
-        # Clear the next 5 rows
-        for idx in xrange(19, 24):
-            self.stdscr.addstr(idx, 0, " " * 70)
-
-        starty = 19
-        if trade_engine.order_thread.is_alive():
-            for order in trade_engine.auth_client.get_orders()[0]:
-                self.stdscr.addstr(starty, 0, "%s Price: %s Size: %s Status: %s" %
-                                   (order.get('side').upper(), order.get('price'),
-                                    order.get('size'), order.get('status')))
-                starty += 1
+    def draw_candlesticks(self, snapshot):
+        cur_stick, closed_rows = snapshot
+        lines = [(4, 0, "%s O: %f H: %f L: %f C: %f V: %f" % cur_stick,
+                  self.print_color(cur_stick[1], cur_stick[4]), WIDTH)]
+        for starty, row in enumerate(closed_rows, 5):
+            lines.append((starty, 0, "%s O: %f H: %f L: %f C: %f V: %f" %
+                          (period_module.from_epoch(row[0]), row[3], row[2], row[1], row[4], row[5]),
+                          self.print_color(row[3], row[4]), WIDTH))
+        return lines
+
+    def draw_orders(self, snapshot):
+        fills, orders = snapshot
+        lines = [(11, 0, "Recent Fills", 0, WIDTH)]
+        for starty in xrange(12, 17):
+            lines.append((starty, 0, "", 0, WIDTH))
+        for starty, fill in enumerate(fills, 12):
+            lines[starty - 11] = (starty, 0, "%s Price: %s Size: %s Time: %s" %
+                                  (((fill[0] or '').upper(),) + fill[1:]), 0, WIDTH)
+        lines.append((18, 0, "Open Orders", 0, WIDTH))
+        if orders is None:
+            lines.append((19, 0, "None", 0, WIDTH))
+            starty = 20
         else:
-            self.stdscr.addstr(19, 0, "None")
-        self.stdscr.refresh()
+            for starty, order in enumerate(orders, 19):
+                lines.append((starty, 0, "%s Price: %s Size: %s Status: %s" %
+                              (((order[0] or '').upper(),) + order[1:]), 0, WIDTH))
+            starty = 19 + len(orders)
+        # Clear what is left of the open order rows
+        for idx in xrange(starty, 24):
+            lines.append((idx, 0, "", 0, WIDTH))
+        return lines
+
+    def draw(self):
+        changed = False
+        columns = self.stdscr.getmaxyx()[1]
+        for region, snapshot in list(self.snapshots.items()):
+            if self.drawn.get(region) == snapshot:
+                continue
+            for y, x, text, attr, width in getattr(self, 'draw_' + region)(snapshot):
+                try:
+                    # Padding to the region's width overwrites what was there
+                    self.stdscr.addstr(y, x, text.ljust(width)[:max(min(width, columns - x - 1), 0)], attr)
+                except curses.error:
+                    # Terminal too small for this line
+                    pass
+            # Only now, a snapshot that failed to draw is tried again
+            self.drawn[region] = snapshot
+            changed = True
+        if changed:
+            self.stdscr.refresh()
+
+    def run(self):
+        while not self.stopped.wait(1.0 / self.fps):
+            try:
+                self.draw()
+            except Exception:
+                self.logger.debug("[INTERFACE] Drawing failed", exc_info=True)
 
     def print_color(self, a, b):
         if a < b:
@@ -91,6 +171,8 @@ class cursesDisplay:
         if not self.enable:
             return
         self.stop = True
+        self.stopped.set()
+        self.thread.join()
         curses.nocbreak()
         self.stdscr.keypad(0)
         curses.echo()
@@ -5,55 +5,137 @@
 # Subsystem containing all trading logic and execution
 import time
 import gdax
+import Queue
 import threading
 import logging
+import orderbook
+import feed
+import rest
+import metrics
+import strategies
 from decimal import *
 
 
-class OrderBookCustom(gdax.OrderBook):
-    def __init__(self):
+class OrderBookCustom(feed.ReconnectingWebsocket):
+    def __init__(self, product_id='BTC-USD', url="wss://ws-feed.gdax.com", api_url="https://api.gdax.com"):
         self.logger = logging.getLogger('trader-logger')
-        super(OrderBookCustom, self).__init__()
+        self.product_id = product_id
+        self.book = orderbook.OrderBook()
+        self._client = gdax.PublicClient(api_url)
+        # (best bid, best ask), replaced as a whole so readers never need a lock
+        self.top_of_book = None
+        self.top_ticks = None
+        self.ready = threading.Event()
+        # Called with (bid, ask) whenever the top of book changes
+        self.listeners = []
+        super(OrderBookCustom, self).__init__(url=url, products=[product_id])
 
     def is_ready(self):
-        try:
-            super(OrderBookCustom, self).get_ask()
-        except ValueError:
-            return False
-        return True
+        return self.ready.is_set()
+
+    def wait_until_ready(self, timeout=None):
+        if not self.ready.wait(timeout):
+            raise ValueError("Order book not ready after %s seconds" % timeout)
+
+    def get_ask(self, timeout=None):
+        if not self.ready.is_set():
+            self.wait_until_ready(timeout)
+        return self.top_of_book[1]
+
+    def get_bid(self, timeout=None):
+        if not self.ready.is_set():
+            self.wait_until_ready(timeout)
+        return self.top_of_book[0]
 
-    def get_ask(self):
-        while not self.is_ready():
-            time.sleep(0.01)
-        return super(OrderBookCustom, self).get_ask()
+    def get_depth(self, levels=10):
+        return self.book.depth(levels)
 
-    def get_bid(self):
-        while not self.is_ready():
-            time.sleep(0.01)
-        return super(OrderBookCustom, self).get_bid()
+    def resync(self):
+        started = time.time()
+        rest.public_limiter.acquire()
+        request_started = metrics.clock()
+        snapshot = self._client.get_product_order_book(self.product_id, level=3)
+        metrics.rest_seconds.observe_since(request_started, 'get_product_order_book')
+        self.book.load_snapshot(snapshot, started)
+        self.logger.debug("[BOOK] Loaded snapshot at sequence %d in %.3f s",
+                          self.book.sequence, self.book.last_resync_seconds)
+
+    def on_message(self, message):
+        if self.book.sequence == -1:
+            self.resync()
+        if not self.book.process(message):
+            self.logger.debug("[BOOK] Messages missing (%d - %d), resyncing",
+                              self.book.sequence, message.get('sequence'))
+            self.resync()
+            if not self.book.process(message):
+                # Snapshot is still behind, try again on the next message
+                self.book.sequence = -1
+                return
+        self.update_top_of_book()
+
+    def update_top_of_book(self):
+        ticks = self.book.best_ticks()
+        if ticks == self.top_ticks:
+            return
+        if ticks[0] is None or ticks[1] is None:
+            # One side of the book is empty
+            return
+        self.top_ticks = ticks
+        self.top_of_book = (orderbook.to_price(ticks[0]), orderbook.to_price(ticks[1]))
+        self.ready.set()
+        for listener in self.listeners:
+            listener(*self.top_of_book)
 
     def on_open(self):
         self.stop = False
-        self._sequence = -1
+        self.book.sequence = -1
+        self.ready.clear()
+        self.top_of_book = None
+        self.top_ticks = None
         self.logger.debug("-- Order Book Opened ---")
 
+    def on_reconnect(self):
+        # Keep serving the last top of book until the new snapshot is in
+        self.book.sequence = -1
+
     def on_close(self):
         self.logger.debug("-- Order Book Closed ---")
 
-    def on_error(self, e):
-        raise e
-
 
 class TradeEngine():
-    def __init__(self, auth_client, is_live=False):
+    def __init__(self, auth_client, is_live=False, order_book=None, mfi_buy='20.0', order_tracker=None,
+                 strategy=None):
         self.auth_client = auth_client
         self.is_live = is_live
-        self.order_book = OrderBookCustom()
+        self.mfi_buy = Decimal(mfi_buy)
+        # Makes the decisions of determine_trades()
+        if strategy is None:
+            strategy = strategies.MacdMfiStrategy(mfi_buy=mfi_buy)
+        self.strategy = strategy
+        if order_book is None:
+            order_book = OrderBookCustom()
+        self.order_book = order_book
+        # With an orders.OrderTracker, order state and balances come from the
+        # user feed and order loops wake up on book or order changes
+        self.order_tracker = order_tracker
+        self.order_wakeup = threading.Event()
+        if order_tracker is not None:
+            order_tracker.listeners.append(self.wake_orders)
+            order_book.listeners.append(self.wake_orders)
+        # The feeds fetch their snapshots in their own threads, start them
+        # before blocking on the balances
+        self.order_book.start()
+        if self.order_tracker is not None:
+            self.order_tracker.start()
         self.usd = self.get_usd()
         self.btc = self.get_btc()
         self.last_balance_update = time.time()
-        self.order_book.start()
+        # Orders are worked by one long-lived thread fed through this queue,
+        # so the market data loop never waits on REST calls. It only holds
+        # the latest request, see start_order()
+        self.order_requests = Queue.Queue(maxsize=1)
         self.order_thread = threading.Thread()
+        self.active_side = None
         self.last_balance_update = time.time()
         self.logger = logging.getLogger('trader-logger')
 
@@ -67,11 +149,40 @@ class TradeEngine():
         # Cancel any orders that may still be remaining
         self.auth_client.cancel_all(product_id='BTC-USD')
         self.order_book.close()
+        if self.order_tracker is not None:
+            self.order_tracker.close()
 
     def start(self):
         self.order_book.start()
+        if self.order_tracker is not None:
+            self.order_tracker.start()
+
+    def tracking(self):
+        return self.order_tracker is not None and self.order_tracker.is_ready()
+
+    def get_order(self, order_id):
+        if self.tracking():
+            return self.order_tracker.get_order(order_id)
+        return self.auth_client.get_order(order_id)
+
+    def get_open_orders(self):
+        if self.tracking():
+            return self.order_tracker.get_open_orders()
+        return self.auth_client.get_orders()[0]
+
+    def wake_orders(self, *args):
+        self.order_wakeup.set()
+
+    def wait_for_update(self):
+        # Without a tracker the REST round trips pace the order loops
+        if self.tracking():
+            self.order_wakeup.wait(1.0)
+            self.order_wakeup.clear()
+        self.update_amounts()
 
     def get_usd(self):
+        if self.tracking():
+            return self.round_usd(self.order_tracker.get_available('USD'))
         try:
             for account in self.auth_client.get_accounts():
                 if account.get('currency') == 'USD':
@@ -80,14 +191,33 @@ class TradeEngine():
             return self.round_usd('0.0')
 
     def get_btc(self):
+        if self.tracking():
+            return self.round_btc(self.order_tracker.get_available('BTC'))
         try:
-            for account in self.auth_client.get_accounts():
+            accounts = self.auth_client.get_accounts()
+            for account in accounts:
                 if account.get('currency') == 'BTC':
                     return self.round_btc(account.get('available'))
-            return self.round_btc(self.auth_client.get_accounts()[0]['available'])
+            return self.round_btc(accounts[0]['available'])
         except AttributeError:
             return self.round_btc('0.0')
 
+    def get_cached(self, method, default, *args, **kwargs):
+        # Last known result of a read, for display. Never waits on the
+        # network when the client caches (rest.CachedClient).
+        peek = getattr(self.auth_client, 'peek', None)
+        if peek is None:
+            return getattr(self.auth_client, method)(*args, **kwargs)
+        result = peek(method, *args, **kwargs)
+        return default if result is None else result
+
+    def track(self, ret):
+        if ret.get('status') == 'rejected':
+            metrics.rejects_total.inc(ret.get('side'))
+        if self.order_tracker is not None:
+            self.order_tracker.track(ret)
+        return ret
+
     def round_usd(self, money):
         return Decimal(money).quantize(Decimal('.01'), rounding=ROUND_DOWN)
 
@@ -95,13 +225,15 @@ class TradeEngine():
         return Decimal(money).quantize(Decimal('.00000001'), rounding=ROUND_DOWN)
 
     def update_amounts(self):
+        if self.order_tracker is not None and not self.order_tracker.stop and self.order_tracker.needs_reconcile():
+            self.order_tracker.reconcile()
         if time.time() - self.last_balance_update > 10.0:
             self.btc = self.get_btc()
             self.usd = self.get_usd()
             self.last_balance_update = time.time()
 
     def print_amounts(self):
-        self.logger.debug("[BALANCES] USD: %.2f BTC: %.8f" % (self.usd, self.btc))
+        self.logger.debug("[BALANCES] USD: %.2f BTC: %.8f", self.usd, self.btc)
 
     def place_buy(self, partial='1.0'):
         amount = self.get_usd() * Decimal(partial)
@@ -115,32 +247,40 @@ class TradeEngine():
 
         if amount >= Decimal('0.01'):
             self.logger.debug("BUYING BTC!")
-            return self.auth_client.buy(type='limit', size=str(amount),
-                                        price=str(bid), post_only=True,
-                                        product_id='BTC-USD')
+            return self.track(self.auth_client.buy(type='limit', size=str(amount),
+                                                   price=str(bid), post_only=True,
+                                                   product_id='BTC-USD'))
         else:
             ret = {'status': 'done'}
             return ret
 
     def buy(self, amount=None):
         ret = self.place_buy('0.5')
-        bid = ret.get('price')
         while ret.get('status') != 'done' and self.buy_flag:
-            if ret.get('status') == 'rejected' or ret.get('message') == 'NotFound':
+            ret = self.update_buy(ret)
+            self.wait_for_update()
+        self.finish_buy(ret)
+
+    def update_buy(self, ret):
+        bid = ret.get('price')
+        if ret.get('status') == 'rejected' or ret.get('message') == 'NotFound':
+            ret = self.place_buy('0.5')
+        elif not bid or Decimal(bid) < self.order_book.get_ask() - Decimal('0.01'):
+            started = metrics.clock()
+            if len(self.get_open_orders()) > 0:
+                ret = self.place_buy('1.0')
+            else:
                 ret = self.place_buy('0.5')
-                bid = ret.get('price')
-            elif not bid or Decimal(bid) < self.order_book.get_ask() - Decimal('0.01'):
-                if len(self.auth_client.get_orders()[0]) > 0:
-                    ret = self.place_buy('1.0')
-                else:
-                    ret = self.place_buy('0.5')
-                for order in self.auth_client.get_orders()[0]:
-                    if order.get('id') != ret.get('id'):
-                        self.auth_client.cancel_order(order.get('id'))
-                bid = ret.get('price')
-            if ret.get('id'):
-                ret = self.auth_client.get_order(ret.get('id'))
-            self.usd = self.get_usd()
+            for order in self.get_open_orders():
+                if order.get('id') != ret.get('id'):
+                    self.auth_client.cancel_order(order.get('id'))
+            metrics.reprice_seconds.observe_since(started, 'buy')
+        if ret.get('id'):
+            ret = self.get_order(ret.get('id'))
+        self.usd = self.get_usd()
+        return ret
+
+    def finish_buy(self, ret):
         if not self.buy_flag and ret.get('id'):
             self.auth_client.cancel_all(product_id='BTC-USD')
         self.usd = self.get_usd()
@@ -153,67 +293,97 @@ class TradeEngine():
 
         if amount >= Decimal('0.01'):
             self.logger.debug("SELLING BTC!")
-            return self.auth_client.sell(type='limit', size=str(amount),
-                                         price=str(ask), post_only=True,
-                                         product_id='BTC-USD')
+            return self.track(self.auth_client.sell(type='limit', size=str(amount),
+                                                    price=str(ask), post_only=True,
+                                                    product_id='BTC-USD'))
         else:
             ret = {'status': 'done'}
             return ret
 
     def sell(self, amount=None):
         ret = self.place_sell('0.5')
-        ask = ret.get('price')
         while ret.get('status') != 'done' and self.sell_flag:
-            if ret.get('status') == 'rejected' or ret.get('message') == 'NotFound':
+            ret = self.update_sell(ret)
+            self.wait_for_update()
+        self.finish_sell(ret)
+
+    def update_sell(self, ret):
+        ask = ret.get('price')
+        if ret.get('status') == 'rejected' or ret.get('message') == 'NotFound':
+            ret = self.place_sell('0.5')
+        elif not ask or Decimal(ask) > self.order_book.get_bid() + Decimal('0.01'):
+            started = metrics.clock()
+            if len(self.get_open_orders()) > 0:
+                ret = self.place_sell('1.0')
+            else:
                 ret = self.place_sell('0.5')
-                ask = ret.get('price')
-            elif not ask or Decimal(ask) > self.order_book.get_bid() + Decimal('0.01'):
-                if len(self.auth_client.get_orders()[0]) > 0:
-                    ret = self.place_sell('1.0')
-                else:
-                    ret = self.place_sell('0.5')
-                for order in self.auth_client.get_orders()[0]:
-                    if order.get('id') != ret.get('id'):
-                        self.auth_client.cancel_order(order.get('id'))
-                ask = ret.get('price')
-            if ret.get('id'):
-                ret = self.auth_client.get_order(ret.get('id'))
-            self.btc = self.get_btc()
+            for order in self.get_open_orders():
+                if order.get('id') != ret.get('id'):
+                    self.auth_client.cancel_order(order.get('id'))
+            metrics.reprice_seconds.observe_since(started, 'sell')
+        if ret.get('id'):
+            ret = self.get_order(ret.get('id'))
+        self.btc = self.get_btc()
+        return ret
+
+    def finish_sell(self, ret):
         if not self.sell_flag:
             self.auth_client.cancel_all(product_id='BTC-USD')
         self.btc = self.get_btc()
 
-    def determine_trades(self, indicators):
+    def start_order(self, side):
+        # Never blocks: an order of the opposite side sees its flag cleared,
+        # cancels and returns before the order thread starts this one
+        if side == self.active_side:
+            return
+        # Only the most recent request matters, it replaces a waiting one
+        while True:
+            try:
+                self.order_requests.put_nowait(side)
+                break
+            except Queue.Full:
+                try:
+                    self.order_requests.get_nowait()
+                except Queue.Empty:
+                    pass
+        if not self.order_thread.is_alive():
+            self.order_thread = threading.Thread(target=self.run_orders, name='order_thread')
+            self.order_thread.daemon = True
+            self.order_thread.start()
+
+    def run_orders(self):
+        while True:
+            self.update_amounts()
+            try:
+                side = self.order_requests.get(timeout=10.0)
+            except Queue.Empty:
+                continue
+            if not getattr(self, side + '_flag'):
+                continue
+            self.active_side = side
+            try:
+                getattr(self, side)()
+            except Exception:
+                self.logger.debug("[ORDERS] %s order failed", side, exc_info=True)
+            finally:
+                self.active_side = None
+
+    def execute(self, decision):
+        # A 'buy' or 'sell' decision of a strategy
         if not self.is_live:
             return
-        self.update_amounts()
-        if Decimal(indicators['1']['macd_hist_diff']) > Decimal('0.0') \
-           and Decimal(indicators['1']['mfi']) < Decimal('20.0'):
+        if decision == 'buy':
             self.sell_flag = False
             # buy btc
             self.buy_flag = True
-            if self.order_thread.is_alive():
-                if self.order_thread.name == 'sell_thread':
-                    # Wait for thread to close
-                    while self.order_thread.is_alive():
-                        time.sleep(0.1)
-                else:
-                    pass
-            else:
-                self.order_thread = threading.Thread(target=self.buy, name='buy_thread')
-                self.order_thread.start()
-        elif Decimal(indicators['1']['macd_hist_diff']) < Decimal('0.0') \
-             and Decimal(indicators['1']['macd_hist']) < Decimal('0.0'):
+            self.start_order('buy')
+        elif decision == 'sell':
             self.buy_flag = False
             # sell btc
             self.sell_flag = True
-            if self.order_thread.is_alive():
-                if self.order_thread.name == 'buy_thread':
-                    # Wait for thread to close
-                    while self.order_thread.is_alive():
-                        time.sleep(0.1)
-                else:
-                    pass
-            else:
-                self.order_thread = threading.Thread(target=self.sell, name='sell_thread')
-                self.order_thread.start()
+            self.start_order('sell')
+
+    def determine_trades(self, indicators):
+        if not self.is_live:
+            return
+        self.execute(self.strategy.decide(indicators))
@@ -0,0 +1,235 @@
+#
+# feed.py
+# Mike Cardillo
+#
+# Websocket ingest: reconnecting GDAX websocket clients, and tracking of
+# sequence numbers and trade ids so trades missed while disconnected are
+# backfilled over REST instead of rebuilding every period.
+
+import time
+import Queue
+import logging
+import threading
+import gdax
+import rest
+import metrics
+from websocket import WebSocketConnectionClosedException
+
+INITIAL_BACKOFF = 1.0
+MAX_BACKOFF = 60.0
+# A connection that stayed up this long starts over at INITIAL_BACKOFF
+STABLE_CONNECTION = 60.0
+# Trades per REST page, and the most trades backfilled for one gap
+TRADES_PAGE = 100
+MAX_BACKFILL = 1000
+
+
+class FeedQueue(Queue.Queue):
+    """
+    Bounded queue between the websocket thread and the market data loop.
+    When it is full, heartbeats are dropped (the next one carries the same
+    information) and matches block the websocket thread, so a backlog pushes
+    back on the connection instead of growing without limit.
+    """
+    def __init__(self, maxsize=10000, name='feed'):
+        Queue.Queue.__init__(self, maxsize)
+        self.logger = logging.getLogger('trader-logger')
+        self.name = name
+        self.dropped = 0
+
+    # Items are queued with the time they were put, for the queue wait metric
+    def _put(self, item):
+        Queue.Queue._put(self, (metrics.clock(), item))
+
+    def _get(self):
+        started, item = Queue.Queue._get(self)
+        metrics.queue_wait_seconds.observe_since(started, self.name)
+        return item
+
+    def put_message(self, msg):
+        try:
+            self.put_nowait(msg)
+        except Queue.Full:
+            if msg.get('type') == "heartbeat":
+                self.dropped += 1
+                return
+            self.logger.debug("[FEED] Queue full (%d messages), blocking the websocket", self.maxsize)
+            self.put(msg)
+
+
+class ReconnectingWebsocket(gdax.WebsocketClient):
+    """
+    WebsocketClient that reconnects in its own thread with exponential
+    backoff when the connection fails, instead of raising. Subclasses can
+    override on_reconnect() to reset state that depends on the connection.
+    """
+    def __init__(self, url="wss://ws-feed.gdax.com", products=None, message_type="subscribe"):
+        self.backoff = INITIAL_BACKOFF
+        self.connected_at = None
+        self.reconnects = 0
+        self.closing = threading.Event()
+        super(ReconnectingWebsocket, self).__init__(url=url, products=products, message_type=message_type)
+
+    def start(self):
+        self.closing.clear()
+        self.connected_at = time.time()
+        super(ReconnectingWebsocket, self).start()
+
+    def close(self):
+        self.closing.set()
+        super(ReconnectingWebsocket, self).close()
+
+    def on_reconnect(self):
+        pass
+
+    def on_error(self, e):
+        if self.stop or self.closing.is_set():
+            return
+        if self.connected_at is not None and time.time() - self.connected_at > STABLE_CONNECTION:
+            self.backoff = INITIAL_BACKOFF
+        logging.getLogger('trader-logger').debug("[WEBSOCKET] %r, reconnecting in %.0f s", e, self.backoff)
+        while not self.closing.is_set():
+            try:
+                if self.ws:
+                    self.ws.close()
+            except Exception:
+                pass
+            if self.closing.wait(self.backoff):
+                break
+            self.backoff = min(self.backoff * 2, MAX_BACKOFF)
+            self.on_reconnect()
+            try:
+                self._connect()
+            except Exception as e:
+                logging.getLogger('trader-logger').debug("[WEBSOCKET] Reconnect failed: %r", e)
+                continue
+            self.connected_at = time.time()
+            self.reconnects += 1
+            metrics.reconnects_total.inc(type(self).__name__)
+            return
+
+
+def rest_trade_to_match(trade, product_id, sequence):
+    # GDAX trades, like matches, carry the maker side
+    return {'type': 'match', 'product_id': product_id, 'trade_id': int(trade['trade_id']),
+            'sequence': sequence, 'time': trade['time'], 'price': trade['price'], 'size': trade['size'],
+            'side': trade['side'], 'backfilled': True}
+
+
+class TradeGapTracker:
+    """
+    Follows the sequence and trade id of every product on the feed. check()
+    returns the messages to process in place of msg: nothing for a duplicate
+    trade (e.g. replayed after a reconnect), or the missing trades fetched
+    from REST followed by msg when trade ids were skipped.
+    """
+    def __init__(self, api_url="https://api.gdax.com", max_backfill=MAX_BACKFILL):
+        self.logger = logging.getLogger('trader-logger')
+        self.api_url = api_url.rstrip('/')
+        self.max_backfill = max_backfill
+        self.last_sequence = {}
+        self.last_trade_id = {}
+        self.sequence_gaps = 0
+        self.trade_gaps = 0
+        self.backfilled = 0
+        # Set when a gap was too large to backfill; the periods need reloading
+        self.overflowed = False
+
+    def check(self, msg):
+        product_id = msg.get('product_id')
+        sequence = msg.get('sequence')
+        msg_type = msg.get('type')
+        if sequence is not None:
+            last = self.last_sequence.get(product_id)
+            # A heartbeat carries the sequence of the last message sent
+            if last is not None and sequence > last + (0 if msg_type == "heartbeat" else 1):
+                self.sequence_gaps += 1
+            if last is None or sequence > last:
+                self.last_sequence[product_id] = sequence
+
+        if msg_type == "match":
+            trade_id = int(msg.get('trade_id'))
+            last = self.last_trade_id.get(product_id)
+            if last is not None and trade_id <= last:
+                return []
+            self.last_trade_id[product_id] = trade_id
+            if last is not None and trade_id > last + 1:
+                return self.backfill(product_id, last + 1, trade_id - 1, sequence) + [msg]
+        elif msg_type == "heartbeat" and msg.get('last_trade_id') is not None:
+            trade_id = int(msg.get('last_trade_id'))
+            last = self.last_trade_id.get(product_id)
+            if last is None or trade_id > last:
+                self.last_trade_id[product_id] = trade_id
+            if last is not None and trade_id > last:
+                return self.backfill(product_id, last + 1, trade_id, sequence) + [msg]
+        return [msg]
+
+    def backfill(self, product_id, first, last, sequence):
+        self.trade_gaps += 1
+        if last - first + 1 > self.max_backfill:
+            self.logger.debug("[FEED] %s missed %d trades, too many to backfill", product_id, last - first + 1)
+            self.overflowed = True
+            return []
+        trades = self.get_trades(product_id, first, last)
+        self.backfilled += len(trades)
+        self.logger.debug("[FEED] %s backfilled %d of trades %d - %d", product_id, len(trades), first, last)
+        return [rest_trade_to_match(trade, product_id, sequence) for trade in trades]
+
+    def get_trades(self, product_id, first, last):
+        # Pages go backwards from the newest trade: after=N returns trade ids below N
+        trades = []
+        cursor = last + 1
+        while cursor > first:
+            page = rest.public_get(self.api_url + '/products/%s/trades' % product_id,
+                                   params={'after': cursor, 'limit': TRADES_PAGE}, endpoint='get_trades')
+            if not isinstance(page, list) or len(page) == 0:
+                break
+            trades.extend(trade for trade in page if first <= int(trade['trade_id']) <= last)
+            cursor = min(int(trade['trade_id']) for trade in page)
+        return sorted(trades, key=lambda trade: int(trade['trade_id']))
+
+
+class TradeAndHeartbeatWebsocket(ReconnectingWebsocket):
+    def __init__(self, url="wss://ws-feed.gdax.com", products=None, tick_writer=None, queue_size=10000,
+                 gap_tracker=None):
+        self.logger = logging.getLogger('trader-logger')
+        self.tick_writer = tick_writer
+        self.queue_size = queue_size
+        self.gap_tracker = gap_tracker
+        super(TradeAndHeartbeatWebsocket, self).__init__(url=url, products=products)
+
+    def on_open(self):
+        self.type = "heartbeat"
+        self.websocket_queue = FeedQueue(self.queue_size)
+        self.stop = False
+        self.logger.debug("-- GDAX Websocket Opened ---")
+
+    def on_close(self):
+        if self.tick_writer:
+            self.tick_writer.flush()
+        self.logger.debug("-- GDAX Websocket Closed ---")
+
+    def close(self):
+        if not self.stop:
+            self.closing.set()
+            self.on_close()
+            self.stop = True
+            self.thread.join()
+            try:
+                if self.ws:
+                    self.ws.close()
+            except WebSocketConnectionClosedException as e:
+                pass
+
+    def on_message(self, msg):
+        metrics.messages_total.inc(msg.get('type'))
+        messages = self.gap_tracker.check(msg) if self.gap_tracker else [msg]
+        for msg in messages:
+            if msg.get('type') == "heartbeat" or msg.get('type') == "match":
+                self.websocket_queue.put_message(msg)
+                if self.tick_writer:
+                    self.tick_writer.write(msg)
+        if self.gap_tracker and self.gap_tracker.overflowed:
+            # Let the main loop reload the periods
+            self.gap_tracker.overflowed = False
+            self.websocket_queue.put({'type': "reinitialize"})
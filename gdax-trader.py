@@ -4,109 +4,203 @@
 #
 # Main program for interacting with GDAX websocket and managing trade data
 
+import time
+# Startup is timed from here, imports included
+started = time.time()
 import gdax
-import period
-import indicators
+import feed
+import market
 import engine
 import config
 import Queue
-import time
-import traceback
 import curses_interface
+import rest
+import metrics
+import strategies
+import asynclog
 import logging
-from websocket import WebSocketConnectionClosedException
+import multiprocessing.pool
 
+timer = metrics.StartupTimer(started)
+timer.record('imports', started)
 
-class TradeAndHeartbeatWebsocket(gdax.WebsocketClient):
-    def __init__(self):
-        self.logger = logging.getLogger('trader-logger')
-        super(TradeAndHeartbeatWebsocket, self).__init__()
+# Records are formatted and written by a background thread, see asynclog.py
+logger = logging.getLogger('trader-logger')
+logger.setLevel(getattr(logging, getattr(config, 'LOG_LEVEL', "DEBUG")))
+log_handlers = [asynclog.AsyncLogHandler(asynclog.RotatingFileWriter(getattr(config, 'LOG_FILE', "debug.log"),
+                                                                     getattr(config, 'LOG_MAX_BYTES', 0),
+                                                                     getattr(config, 'LOG_ROTATE_SECONDS', 0),
+                                                                     getattr(config, 'LOG_BACKUPS', 5)))]
+if config.FRONTEND == 'debug':
+    log_handlers.append(asynclog.AsyncLogHandler(asynclog.StreamWriter()))
+for handler in log_handlers:
+    if getattr(config, 'LOG_FORMAT', "text") == "compact":
+        handler.setFormatter(asynclog.CompactFormatter())
+    logger.addHandler(handler)
 
-    def on_open(self):
-        self.products = ["BTC-USD"]
-        self.type = "heartbeat"
-        self.websocket_queue = Queue.Queue()
-        self.stop = False
-        self.logger.debug("-- GDAX Websocket Opened ---")
+# BTC-USD is always tracked, it is the product TradeEngine trades
+products = sorted(set(getattr(config, 'PRODUCTS', []) + ["BTC-USD"]))
+granularities = getattr(config, 'GRANULARITIES', [60])
+api_url = getattr(config, 'API_URL', "https://api.gdax.com")
+websocket_url = getattr(config, 'WEBSOCKET_URL', "wss://ws-feed.gdax.com")
+queue_size = getattr(config, 'QUEUE_SIZE', 10000)
 
-    def on_close(self):
-        self.logger.debug("-- GDAX Websocket Closed ---")
+# With MARKET_STATE_DIR the market data comes from marketdata.py
+market_state_dir = getattr(config, 'MARKET_STATE_DIR', '')
 
-    def on_error(self, e):
-        raise e
+# Optional parts are only imported when configured
+if getattr(config, 'CANDLE_DIR', ''):
+    import candlestore
+    candle_store = candlestore.CandleStore(config.CANDLE_DIR)
+else:
+    candle_store = None
+if getattr(config, 'CAPTURE_DIR', ''):
+    import tickstore
+    tick_writer = tickstore.TickCapture(config.CAPTURE_DIR)
+else:
+    tick_writer = None
+if market_state_dir:
+    import marketstate
+    order_book = marketstate.SharedOrderBook()
+    pipelines = [marketstate.SharedPipeline(market_state_dir, product_id,
+                                            order_book=order_book if product_id == "BTC-USD" else None)
+                 for product_id in products]
+    gdax_websocket = marketstate.SharedFeed(pipelines, queue_size=queue_size)
+else:
+    order_book = engine.OrderBookCustom(url=websocket_url, api_url=api_url)
+    gap_tracker = feed.TradeGapTracker(api_url)
+    gdax_websocket = feed.TradeAndHeartbeatWebsocket(url=websocket_url, products=products, tick_writer=tick_writer,
+                                                     queue_size=queue_size, gap_tracker=gap_tracker)
+    # History is loaded below, concurrently with everything else
+    pipelines = [market.ProductPipeline(product_id, granularities,
+                                        order_book=order_book if product_id == "BTC-USD" else None,
+                                        initialize=False, api_url=api_url, store=candle_store)
+                 for product_id in products]
+# Messages are buffered from here on, nothing is missed while history loads
+gdax_websocket.start()
+auth_client = gdax.AuthenticatedClient(config.KEY, config.SECRET, config.PASSPHRASE, api_url=api_url)
+# Instrumentation is only switched on when it is exported somewhere
+metrics_port = getattr(config, 'METRICS_PORT', 0)
+metrics_file = getattr(config, 'METRICS_FILE', '')
+metrics_exporters = []
+if metrics_port or metrics_file:
+    metrics.enable()
+    auth_client = metrics.TimedClient(auth_client)
+    if metrics_port:
+        metrics_exporters.append(metrics.MetricsServer(metrics_port))
+    if metrics_file:
+        metrics_exporters.append(metrics.SnapshotWriter(metrics_file, getattr(config, 'METRICS_INTERVAL', 10.0)))
+# Live order state comes from the authenticated user feed. Its reconciliation
+# needs uncached reads, everything else shares the cached, rate limited client
+if config.LIVE:
+    import orders
+    order_tracker = orders.OrderTracker(auth_client, url=websocket_url)
+else:
+    order_tracker = None
+auth_client = rest.CachedClient(auth_client)
+dispatcher = market.MarketDataDispatcher(pipelines, workers=getattr(config, 'INDICATOR_WORKERS', 0),
+                                         queue_size=queue_size)
+# The balances, the order book snapshot and the history of every product
+# are fetched at the same time, startup waits for the slowest of them
+startup_pool = multiprocessing.pool.ThreadPool(2)
+pending_engine = startup_pool.apply_async(timer.time, ('balances', engine.TradeEngine, auth_client),
+                                          dict(is_live=config.LIVE, order_book=order_book,
+                                               order_tracker=order_tracker))
+pending_book = startup_pool.apply_async(timer.time, ('order book', order_book.wait_until_ready, 60))
+if not market_state_dir:
+    dispatcher.initialize(timer)
+trade_engine = pending_engine.get()
+# Raises the ValueError of an order book that was not ready in time
+pending_book.get()
+startup_pool.close()
+btc_pipeline = dispatcher.pipelines["BTC-USD"]
+metrics.queue_depth.set_function('feed', lambda: gdax_websocket.websocket_queue.qsize())
+metrics.queue_depth.set_function('workers', lambda: sum(queue.qsize() for queue in dispatcher.queues))
+for exporter in metrics_exporters:
+    exporter.start()
+one_min = btc_pipeline.get_period(60)
+one_min.verbose_heartbeat = True
+indicator_subsys = btc_pipeline.indicator_subsys
+# TradeEngine's strategy trades, the PAPER_STRATEGIES are paper traded on the
+# same indicator calculations
+router = strategies.OrderRouter(trade_engine)
+strategy_runner = strategies.StrategyRunner(dispatcher.pipelines, router)
+strategy_runner.add(trade_engine.strategy, live=True)
+for kwargs in getattr(config, 'PAPER_STRATEGIES', []):
+    strategy_runner.add(strategies.MacdMfiStrategy(**kwargs))
+timer.record('ready')
+first_message = True
+decided = False
 
-    def close(self):
-        if not self.stop:
-            self.on_close()
-            self.stop = True
-            self.thread.join()
-            try:
-                if self.ws:
-                    self.ws.close()
-            except WebSocketConnectionClosedException as e:
-                pass
 
-    def on_message(self, msg):
-        if msg.get('type') == "heartbeat" or msg.get('type') == "match":
-            self.websocket_queue.put(msg)
+def record_first_decision(pipeline, msg):
+    # Startup ends with the first message the strategy can decide on
+    global decided
+    if not decided and msg.get('type') == "match" and \
+       trade_engine.strategy.ready(pipeline.indicator_subsys.current_indicators):
+        decided = True
+        timer.record('first decision')
+        logger.debug("[STARTUP] %s", timer.report())
 
 
-logger = logging.getLogger('trader-logger')
-logger.setLevel(logging.DEBUG)
-logger.addHandler(logging.FileHandler("debug.log"))
-if config.FRONTEND == 'debug':
-    logger.addHandler(logging.StreamHandler())
-
-gdax_websocket = TradeAndHeartbeatWebsocket()
-auth_client = gdax.AuthenticatedClient(config.KEY, config.SECRET, config.PASSPHRASE)
-trade_engine = engine.TradeEngine(auth_client, is_live=config.LIVE)
-one_min = period.Period(period_size=(60 * 1), name='1')
-period_list = [one_min]
-gdax_websocket.start()
-period_list[0].verbose_heartbeat = True
-indicator_subsys = indicators.IndicatorSubsystem(period_list)
-last_indicator_update = time.time()
+btc_pipeline.listeners.append(record_first_decision)
+last_interface_update = time.time()
 
 if config.FRONTEND == 'curses':
     curses_enable = True
 else:
     curses_enable = False
-interface = curses_interface.cursesDisplay(enable=curses_enable)
+interface = curses_interface.cursesDisplay(enable=curses_enable, fps=getattr(config, 'UI_FPS', 4.0))
+
+
+def update_interface(pipeline, msg):
+    # Runs once the pipeline has processed msg, on its worker with INDICATOR_WORKERS
+    global last_interface_update
+    if msg.get('type') == "match":
+        interface.update_candlesticks(one_min)
+        if time.time() - last_interface_update >= 1.0:
+            interface.update_indicators(indicator_subsys.current_indicators)
+            interface.update_orders(trade_engine)
+            last_interface_update = time.time()
+
+
+btc_pipeline.listeners.append(update_interface)
 
 while(True):
     try:
         msg = gdax_websocket.websocket_queue.get(timeout=15)
-        if msg.get('type') == "match":
-            for cur_period in period_list:
-                cur_period.process_trade(msg)
-            interface.update_candlesticks(one_min)
-            if time.time() - last_indicator_update >= 1.0:
-                for cur_period in period_list:
-                    indicator_subsys.recalculate_indicators(cur_period, trade_engine.order_book)
-                trade_engine.determine_trades(indicator_subsys.current_indicators)
-                interface.update_indicators(indicator_subsys.current_indicators)
-                interface.update_orders(trade_engine)
-                last_indicator_update = time.time()
-        elif msg.get('type') == "heartbeat":
-            for cur_period in period_list:
-                cur_period.process_heartbeat(msg)
-                if len(indicator_subsys.current_indicators[cur_period.name]['bid']) > 0:
-                    trade_engine.determine_trades(indicator_subsys.current_indicators)
+        if first_message:
+            first_message = False
+            timer.record('first message')
+        if msg.get('type') == "reinitialize":
+            # A gap too large to backfill, reload the periods
+            dispatcher.initialize()
+            continue
+        pipeline = dispatcher.dispatch(msg)
+        if pipeline is not btc_pipeline:
+            continue
+        if msg.get('type') == "heartbeat":
             trade_engine.print_amounts()
             interface.update_heartbeat(msg)
-            interface.update_balances(trade_engine.get_btc(), trade_engine.get_usd())
+            # Cached balances, refreshed by the order thread
+            interface.update_balances(trade_engine.btc, trade_engine.usd)
     except KeyboardInterrupt:
+        for name, trades, pnl in router.report():
+            logger.debug("[PAPER %s] %d trades, PnL %s USD", name, trades, pnl)
         trade_engine.close()
         gdax_websocket.close()
+        dispatcher.close()
+        for exporter in metrics_exporters:
+            exporter.close()
         interface.close()
         break
+    except Queue.Empty:
+        # The feeds reconnect by themselves and backfill what they missed
+        logger.debug("No market data for 15 seconds, %d websocket reconnects so far",
+                     gdax_websocket.reconnects)
     except Exception as e:
-        logger.debug(traceback.format_exc())
-        trade_engine.close()
-        gdax_websocket.close()
+        logger.debug("Error processing market data", exc_info=True)
         # Period data cannot be trusted. Re-initialize
-        for cur_period in period_list:
-            cur_period.initialize()
-        time.sleep(10)
-        gdax_websocket.start()
-        trade_engine.start()
+        reinitialize_started = time.time()
+        dispatcher.initialize()
+        logger.debug("[STARTUP] Reinitialized in %.3f s", time.time() - reinitialize_started)
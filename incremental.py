@@ -0,0 +1,307 @@
+#
+# incremental.py
+# Mike Cardillo
+#
+# Streaming versions of the technical indicators used by IndicatorSubsystem.
+#
+# Every indicator keeps only the state it needs to advance by one candle.
+# update() commits a closed candle, peek() evaluates a candidate candle (the
+# still-open one, or a bid/ask "what-if" close) without touching that state.
+# Results follow the TA-Lib definitions so they line up with talib output.
+
+import copy
+import math
+from collections import deque
+
+NAN = float('nan')
+
+
+class EMA:
+    def __init__(self, period):
+        self.period = period
+        self.k = 2.0 / (period + 1)
+        self.seed_total = 0.0
+        self.count = 0
+        self.value = NAN
+
+    def peek(self, value):
+        if self.count >= self.period:
+            return (value - self.value) * self.k + self.value
+        if self.count == self.period - 1:
+            # TA-Lib seeds the EMA with a simple average of the first values
+            return (self.seed_total + value) / self.period
+        return NAN
+
+    def update(self, value):
+        self.value = self.peek(value)
+        if self.count < self.period:
+            self.seed_total += value
+        self.count += 1
+        return self.value
+
+
+class MACD:
+    def __init__(self, fastperiod=12, slowperiod=26, signalperiod=9):
+        if slowperiod < fastperiod:
+            fastperiod, slowperiod = slowperiod, fastperiod
+        self.fast = EMA(fastperiod)
+        self.slow = EMA(slowperiod)
+        self.signal = EMA(signalperiod)
+        # TA-Lib starts the fast EMA late so both averages begin on the same candle
+        self.fast_skip = slowperiod - fastperiod
+        self.count = 0
+        self.macd = NAN
+        self.macd_sig = NAN
+        self.macd_hist = NAN
+
+    def _evaluate(self, fast_value, slow_value, signal_func):
+        macd = fast_value - slow_value
+        if math.isnan(macd):
+            return NAN, NAN, NAN
+        macd_sig = signal_func(macd)
+        if math.isnan(macd_sig):
+            return NAN, NAN, NAN
+        return macd, macd_sig, macd - macd_sig
+
+    def peek(self, close):
+        fast_value = self.fast.peek(close) if self.count >= self.fast_skip else NAN
+        return self._evaluate(fast_value, self.slow.peek(close), self.signal.peek)
+
+    def update(self, close):
+        fast_value = self.fast.update(close) if self.count >= self.fast_skip else NAN
+        self.count += 1
+        self.macd, self.macd_sig, self.macd_hist = self._evaluate(fast_value, self.slow.update(close),
+                                                                  self.signal.update)
+        return self.macd, self.macd_sig, self.macd_hist
+
+
+class OBV:
+    def __init__(self, ema_period=21, skip=1):
+        # cryptowat.ch does not include the first value in their OBV
+        # calculation, so by default the first candle is skipped
+        self.skip = skip
+        self.ema = EMA(ema_period)
+        self.obv = None
+        self.prev_close = None
+
+    def _next(self, close, volume):
+        if self.obv is None:
+            return volume
+        if close > self.prev_close:
+            return self.obv + volume
+        if close < self.prev_close:
+            return self.obv - volume
+        return self.obv
+
+    def peek(self, close, volume):
+        if self.skip > 0:
+            return NAN, NAN
+        obv = self._next(close, volume)
+        return obv, self.ema.peek(obv)
+
+    def update(self, close, volume):
+        if self.skip > 0:
+            self.skip -= 1
+            return NAN, NAN
+        self.obv = self._next(close, volume)
+        self.prev_close = close
+        return self.obv, self.ema.update(self.obv)
+
+
+class BollingerBands:
+    def __init__(self, timeperiod=20, nbdevup=2, nbdevdn=2):
+        self.timeperiod = timeperiod
+        self.nbdevup = nbdevup
+        self.nbdevdn = nbdevdn
+        self.window = deque(maxlen=timeperiod - 1)
+        self.total = 0.0
+        self.total_sq = 0.0
+        self.updates = 0
+
+    def peek(self, close):
+        if len(self.window) < self.timeperiod - 1:
+            return NAN, NAN, NAN
+        mean = (self.total + close) / self.timeperiod
+        variance = (self.total_sq + close * close) / self.timeperiod - mean * mean
+        stddev = math.sqrt(variance) if variance > 0.0 else 0.0
+        return mean + self.nbdevup * stddev, mean, mean - self.nbdevdn * stddev
+
+    def update(self, close):
+        bands = self.peek(close)
+        if len(self.window) == self.window.maxlen:
+            self.total -= self.window[0]
+            self.total_sq -= self.window[0] * self.window[0]
+        self.window.append(close)
+        self.total += close
+        self.total_sq += close * close
+        self.updates += 1
+        if self.updates >= self.timeperiod:
+            # Re-summing now and then keeps running subtraction from drifting
+            self.updates = 0
+            self.total = math.fsum(self.window)
+            self.total_sq = math.fsum(x * x for x in self.window)
+        return bands
+
+
+class SAR:
+    def __init__(self, acceleration=0.02, maximum=0.2):
+        self.acceleration = min(acceleration, maximum)
+        self.maximum = maximum
+        self.first_bar = None
+        # (is_long, sar, ep, af, prev_high, prev_low)
+        self.state = None
+        self.sar = NAN
+
+    def _start(self, high, low):
+        first_high, first_low = self.first_bar
+        # TA-Lib picks the initial direction from the -DM of the first two bars
+        up = high - first_high
+        down = first_low - low
+        is_long = not (down > 0 and up < down)
+        if is_long:
+            return (True, first_low, high, self.acceleration, high, low)
+        return (False, first_high, low, self.acceleration, high, low)
+
+    def _step(self, state, high, low):
+        is_long, sar, ep, af, prev_high, prev_low = state
+        if is_long:
+            if low <= sar:
+                is_long = False
+                sar = max(ep, prev_high, high)
+                out = sar
+                af = self.acceleration
+                ep = low
+                sar = max(sar + af * (ep - sar), prev_high, high)
+            else:
+                out = sar
+                if high > ep:
+                    ep = high
+                    af = min(af + self.acceleration, self.maximum)
+                sar = min(sar + af * (ep - sar), prev_low, low)
+        else:
+            if high >= sar:
+                is_long = True
+                sar = min(ep, prev_low, low)
+                out = sar
+                af = self.acceleration
+                ep = high
+                sar = min(sar + af * (ep - sar), prev_low, low)
+            else:
+                out = sar
+                if low < ep:
+                    ep = low
+                    af = min(af + self.acceleration, self.maximum)
+                sar = max(sar + af * (ep - sar), prev_high, high)
+        return out, (is_long, sar, ep, af, high, low)
+
+    def peek(self, high, low):
+        if self.first_bar is None:
+            return NAN
+        state = self.state if self.state is not None else self._start(high, low)
+        return self._step(state, high, low)[0]
+
+    def update(self, high, low):
+        if self.first_bar is None:
+            self.first_bar = (high, low)
+            return NAN
+        if self.state is None:
+            self.state = self._start(high, low)
+        self.sar, self.state = self._step(self.state, high, low)
+        return self.sar
+
+
+class MFI:
+    def __init__(self, timeperiod=14):
+        self.timeperiod = timeperiod
+        self.flows = deque(maxlen=timeperiod - 1)
+        self.positive = 0.0
+        self.negative = 0.0
+        self.updates = 0
+        self.prev_typical = None
+
+    def _flow(self, high, low, close, volume):
+        typical = (high + low + close) / 3.0
+        money_flow = typical * volume
+        if typical > self.prev_typical:
+            return typical, (money_flow, 0.0)
+        if typical < self.prev_typical:
+            return typical, (0.0, money_flow)
+        return typical, (0.0, 0.0)
+
+    def peek(self, high, low, close, volume):
+        if self.prev_typical is None or len(self.flows) < self.timeperiod - 1:
+            return NAN
+        positive, negative = self._flow(high, low, close, volume)[1]
+        positive += self.positive
+        negative += self.negative
+        if positive + negative < 1.0:
+            return 0.0
+        return 100.0 * (positive / (positive + negative))
+
+    def update(self, high, low, close, volume):
+        mfi = self.peek(high, low, close, volume)
+        if self.prev_typical is None:
+            self.prev_typical = (high + low + close) / 3.0
+        else:
+            self.prev_typical, flow = self._flow(high, low, close, volume)
+            if len(self.flows) == self.flows.maxlen:
+                self.positive -= self.flows[0][0]
+                self.negative -= self.flows[0][1]
+            self.flows.append(flow)
+            self.positive += flow[0]
+            self.negative += flow[1]
+            self.updates += 1
+            if self.updates >= self.timeperiod:
+                # Re-summing now and then keeps running subtraction from drifting
+                self.updates = 0
+                self.positive = math.fsum(flow[0] for flow in self.flows)
+                self.negative = math.fsum(flow[1] for flow in self.flows)
+        return mfi
+
+
+# Indicator kinds by name, constructed with their parameters in order
+KINDS = {'macd': MACD, 'obv': OBV, 'bbands': BollingerBands, 'sar': SAR, 'mfi': MFI}
+# Candlestick columns each kind is updated with, in argument order
+ROW_COLUMNS = {MACD: (4,), OBV: (4, 5), BollingerBands: (4,), SAR: (2, 1), MFI: (2, 1, 4, 5)}
+
+
+class IndicatorStreams:
+    """
+    The set of streaming indicators tracked for one Period.
+
+    Closed candlesticks are committed in order with commit(). The state
+    before the most recent commit is kept, so a late trade that amends the
+    last closed candlestick can be applied with amend() in O(1). Warming up
+    passes keep=False for all but the last commit, copying the state only
+    once.
+    """
+    def __init__(self, buffer, macd_periods=(10, 26, 9), mfi_period=14, extra=None):
+        self.buffer = buffer
+        self.total = 0
+        self.last_row = None
+        self.previous = None
+        self.indicators = {
+            'macd': MACD(*macd_periods),
+            'obv': OBV(ema_period=21),
+            'bbands': BollingerBands(timeperiod=20, nbdevup=2, nbdevdn=2),
+            'sar': SAR(),
+            'mfi': MFI(timeperiod=mfi_period),
+        }
+        # Further configurations, name -> (kind, params) as in KINDS
+        for name, (kind, params) in (extra or {}).items():
+            self.indicators[name] = KINDS[kind](*params)
+
+    def __getitem__(self, name):
+        return self.indicators[name]
+
+    def commit(self, row, keep=True):
+        self.previous = (copy.deepcopy(self.indicators), self.last_row) if keep else None
+        for indicator in self.indicators.values():
+            indicator.update(*[row[column] for column in ROW_COLUMNS[indicator.__class__]])
+        self.last_row = row
+        self.total += 1
+
+    def amend(self, row):
+        self.indicators, self.last_row = self.previous
+        self.total -= 1
+        self.commit(row)
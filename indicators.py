@@ -4,69 +4,122 @@
 #
 # System for containing all technical indicators and processing associated data
 
-import talib
 import logging
+import incremental
 import numpy as np
 from decimal import Decimal
 
 
 class IndicatorSubsystem:
-    def __init__(self, period_list):
+    def __init__(self, period_list, macd_periods=(10, 26, 9), mfi_period=14):
         self.logger = logging.getLogger('trader-logger')
+        self.macd_periods = macd_periods
+        self.mfi_period = mfi_period
         self.current_indicators = {}
+        self.streams = {}
+        # The configurations the built-in indicators are calculated with
+        self.builtin = {'macd': tuple(macd_periods), 'mfi': (mfi_period,), 'bbands': (20, 2, 2),
+                        'sar': (0.02, 0.2), 'obv': (21,)}
+        # period name -> {key: (kind, params)} required with require()
+        self.required = {}
         for period in period_list:
             self.current_indicators[period.name] = {}
         for period in period_list:
             self.current_indicators[period.name]['bid'] = {}
             self.current_indicators[period.name]['ask'] = {}
 
-    def recalculate_indicators(self, cur_period, order_book):
+    def require(self, period_name, kind, params):
+        """
+        Registers an indicator configuration, e.g. ('macd', (12, 26, 9)), for
+        a period and returns the key its value is published under in
+        current_indicators[period_name]. Each distinct configuration is
+        calculated once per update however many strategies require it, and
+        the configurations of the built-in indicators are not calculated
+        again at all.
+        """
+        params = tuple(params)
+        key = '%s_%s' % (kind, '_'.join(str(param) for param in params))
+        required = self.required.setdefault(period_name, {})
+        if key not in required:
+            required[key] = (kind, params)
+            if self.builtin[kind] != params:
+                # Rebuilt with the new configuration on the next update
+                self.streams.pop(period_name, None)
+        return key
+
+    def get_streams(self, cur_period):
+        candlesticks = cur_period.candlesticks
+        streams = self.streams.get(cur_period.name)
+        if streams is None or streams.buffer is not candlesticks or \
+           candlesticks.total - streams.total > len(candlesticks):
+            # New or re-initialized period, warm up from the stored history
+            extra = dict((key, spec) for key, spec in self.required.get(cur_period.name, {}).items()
+                         if self.builtin[spec[0]] != spec[1])
+            streams = incremental.IndicatorStreams(candlesticks, macd_periods=self.macd_periods,
+                                                   mfi_period=self.mfi_period, extra=extra)
+            streams.total = candlesticks.total - len(candlesticks)
+            self.streams[cur_period.name] = streams
+        elif streams.last_row is not None and candlesticks.total - streams.total < len(candlesticks):
+            # A late trade may have amended the last committed candlestick
+            last_row = candlesticks[streams.total - candlesticks.total - 1]
+            if not np.array_equal(last_row, streams.last_row):
+                streams.amend(last_row)
+        # Only the last commit can still be amended
+        for idx in range(streams.total - candlesticks.total, 0):
+            streams.commit(candlesticks[idx], keep=idx == -1)
+        return streams
+
+    def recalculate_indicators(self, cur_period, order_book=None):
         total_periods = len(cur_period.candlesticks)
         if total_periods > 0:
-            cur_bid = float(order_book.get_bid() + Decimal('0.01'))
-            cur_ask = float(order_book.get_ask() - Decimal('0.01'))
-            closing_prices = cur_period.get_closing_prices()
-            closing_prices_bid = np.append(closing_prices, cur_bid)
-            closing_prices_ask = np.append(closing_prices, cur_ask)
-            closing_prices_close = np.append(closing_prices, cur_period.cur_candlestick.close)
-
-            volumes = np.append(cur_period.get_volumes(),
-                                cur_period.cur_candlestick.volume)
-            highs = np.append(cur_period.get_highs(), cur_period.cur_candlestick.high)
-            lows = np.append(cur_period.get_lows(), cur_period.cur_candlestick.low)
+            cur_stick = cur_period.cur_candlestick
+            if order_book is not None:
+                cur_bid = float(order_book.get_bid() + Decimal('0.01'))
+                cur_ask = float(order_book.get_ask() - Decimal('0.01'))
+            else:
+                # Products without an order book use the last trade for both
+                cur_bid = cur_ask = cur_stick.close
+            streams = self.get_streams(cur_period)
 
             # Need to calculate Bollinger Bands first, to use in OBV
-            self.calculate_bbands(cur_period.name, closing_prices_ask)
-            self.calculate_sar(cur_period.name, highs, lows)
-            self.calculate_mfi(cur_period.name, highs, lows, closing_prices_close, volumes)
+            self.calculate_bbands(cur_period.name, streams, cur_ask)
+            self.calculate_sar(cur_period.name, streams, cur_stick.high, cur_stick.low)
+            self.calculate_mfi(cur_period.name, streams, cur_stick.high, cur_stick.low,
+                               cur_stick.close, cur_stick.volume)
 
-            self.calculate_macd(cur_period.name, closing_prices_ask, 'ask')
-            self.calculate_obv(cur_period.name, closing_prices_ask, volumes, 'ask')
+            self.calculate_macd(cur_period.name, streams, cur_ask, 'ask')
+            self.calculate_obv(cur_period.name, streams, cur_ask, cur_stick.volume, 'ask')
 
-            self.calculate_macd(cur_period.name, closing_prices_bid, 'bid')
-            self.calculate_obv(cur_period.name, closing_prices_bid, volumes, 'bid')
+            self.calculate_macd(cur_period.name, streams, cur_bid, 'bid')
+            self.calculate_obv(cur_period.name, streams, cur_bid, cur_stick.volume, 'bid')
+
+            for key, (kind, params) in self.required.get(cur_period.name, {}).items():
+                self.calculate_required(cur_period.name, streams, key, kind, params, cur_stick, cur_bid, cur_ask)
 
             self.current_indicators[cur_period.name]['total_periods'] = total_periods
 
-            self.logger.debug("[INDICATORS %s] Periods: %d MACD_DIFF: %f MACD_HIST: %f MFI: %f" %
-                              (cur_period.name, self.current_indicators[cur_period.name]['total_periods'], self.current_indicators[cur_period.name]['macd_hist_diff'],
-                               self.current_indicators[cur_period.name]['macd_hist'], self.current_indicators[cur_period.name]['mfi']))
+            if self.logger.isEnabledFor(logging.DEBUG):
+                self.logger.debug("[INDICATORS %s] Periods: %d MACD_DIFF: %f MACD_HIST: %f MFI: %f",
+                                  cur_period.name, self.current_indicators[cur_period.name]['total_periods'], self.current_indicators[cur_period.name]['macd_hist_diff'],
+                                  self.current_indicators[cur_period.name]['macd_hist'], self.current_indicators[cur_period.name]['mfi'])
 
-    def calculate_bbands(self, period_name, close):
-        upperband, middleband, lowerband = talib.BBANDS(close, timeperiod=20, nbdevup=2, nbdevdn=2, matype=0)
+    def calculate_bbands(self, period_name, streams, close):
+        upperband, middleband, lowerband = streams['bbands'].peek(close)
 
-        self.current_indicators[period_name]['bband_upper'] = upperband[-1]
-        self.current_indicators[period_name]['bband_lower'] = lowerband[-1]
+        self.current_indicators[period_name]['bband_upper'] = upperband
+        self.current_indicators[period_name]['bband_lower'] = lowerband
 
-    def calculate_macd(self, period_name, closing_prices, bid_or_ask):
-        macd, macd_sig, macd_hist = talib.MACD(closing_prices, fastperiod=10,
-                                               slowperiod=26, signalperiod=9)
-        self.current_indicators[period_name]['macd'] = macd[-1]
-        self.current_indicators[period_name]['macd_sig'] = macd_sig[-1]
-        self.current_indicators[period_name]['macd_hist'] = macd_hist[-1]
-        self.current_indicators[period_name]['macd_hist_diff'] = Decimal(macd_hist[-1]) - Decimal(macd_hist[-2])
+    def calculate_macd(self, period_name, streams, close, bid_or_ask):
+        macd, macd_sig, macd_hist = streams['macd'].peek(close)
+        self.current_indicators[period_name]['macd'] = macd
+        self.current_indicators[period_name]['macd_sig'] = macd_sig
+        self.current_indicators[period_name]['macd_hist'] = macd_hist
+        self.current_indicators[period_name]['macd_hist_diff'] = Decimal(macd_hist) - Decimal(streams['macd'].macd_hist)
 
     def calculate_vol_macd(self, period_name, volumes):
+        # TA-Lib, and the pandas it imports when installed, only load for the
+        # indicators still calculated with it
+        import talib
         macd, macd_sig, macd_hist = talib.MACD(volumes, fastperiod=10,
                                                slowperiod=26, signalperiod=14)
         self.current_indicators[period_name]['vol_macd'] = macd[-1]
@@ -74,25 +127,53 @@ class IndicatorSubsystem:
         self.current_indicators[period_name]['vol_macd_hist'] = macd_hist[-1]
 
     def calculate_avg_volume(self, period_name, volumes):
+        import talib
         avg_vol = talib.SMA(volumes, timeperiod=15)
 
         self.current_indicators[period_name]['avg_volume'] = avg_vol[-1]
 
-    def calculate_obv(self, period_name, closing_prices, volumes, bid_or_ask):
-        # cryptowat.ch does not include the first value in their OBV
-        # calculation, we we won't either to provide parity
-        obv = talib.OBV(closing_prices[1:], volumes[1:])
-        obv_ema = talib.EMA(obv, timeperiod=21)
-
-        self.current_indicators[period_name][bid_or_ask]['obv_ema'] = obv_ema[-1]
-        self.current_indicators[period_name][bid_or_ask]['obv'] = obv[-1]
-
-    def calculate_sar(self, period_name, highs, lows):
-        sar = talib.SAR(highs, lows)
-
-        self.current_indicators[period_name]['sar'] = sar[-1]
-
-    def calculate_mfi(self, period_name, highs, lows, closing_prices, volumes):
-        mfi = talib.MFI(highs, lows, closing_prices, volumes)
-
-        self.current_indicators[period_name]['mfi'] = mfi[-1]
+    def calculate_obv(self, period_name, streams, close, volume, bid_or_ask):
+        obv, obv_ema = streams['obv'].peek(close, volume)
+
+        self.current_indicators[period_name][bid_or_ask]['obv_ema'] = obv_ema
+        self.current_indicators[period_name][bid_or_ask]['obv'] = obv
+
+    def calculate_sar(self, period_name, streams, high, low):
+        sar = streams['sar'].peek(high, low)
+
+        self.current_indicators[period_name]['sar'] = sar
+
+    def calculate_mfi(self, period_name, streams, high, low, close, volume):
+        mfi = streams['mfi'].peek(high, low, close, volume)
+
+        self.current_indicators[period_name]['mfi'] = mfi
+
+    def calculate_required(self, period_name, streams, key, kind, params, cur_stick, cur_bid, cur_ask):
+        # Same inputs as the built-in indicators, whose values are reused
+        current = self.current_indicators[period_name]
+        builtin = self.builtin[kind] == params
+        if kind == 'macd':
+            if builtin:
+                value = dict((name, current[name]) for name in ('macd', 'macd_sig', 'macd_hist', 'macd_hist_diff'))
+            else:
+                macd, macd_sig, macd_hist = streams[key].peek(cur_bid)
+                value = {'macd': macd, 'macd_sig': macd_sig, 'macd_hist': macd_hist,
+                         'macd_hist_diff': Decimal(macd_hist) - Decimal(streams[key].macd_hist)}
+        elif kind == 'mfi':
+            value = current['mfi'] if builtin else \
+                streams[key].peek(cur_stick.high, cur_stick.low, cur_stick.close, cur_stick.volume)
+        elif kind == 'bbands':
+            if builtin:
+                value = {'bband_upper': current['bband_upper'], 'bband_lower': current['bband_lower']}
+            else:
+                upperband, middleband, lowerband = streams[key].peek(cur_ask)
+                value = {'bband_upper': upperband, 'bband_lower': lowerband}
+        elif kind == 'sar':
+            value = current['sar'] if builtin else streams[key].peek(cur_stick.high, cur_stick.low)
+        else:
+            if builtin:
+                value = dict(current['bid'])
+            else:
+                obv, obv_ema = streams[key].peek(cur_bid, cur_stick.volume)
+                value = {'obv': obv, 'obv_ema': obv_ema}
+        current[key] = value
@@ -0,0 +1,189 @@
+#
+# market.py
+# Mike Cardillo
+#
+# Routing of websocket messages to per-product candlestick and indicator
+# pipelines
+
+import sys
+import six
+import time
+import Queue
+import logging
+import threading
+import multiprocessing.pool
+import feed
+import trade
+import period
+import metrics
+import indicators
+import microstructure
+
+
+def concurrently(function, items):
+    # function(item) for every item, each in its own thread
+    items = list(items)
+    if len(items) < 2:
+        return [function(item) for item in items]
+    pool = multiprocessing.pool.ThreadPool(len(items))
+    try:
+        return pool.map(function, items)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def period_name(granularity):
+    # Periods are named by their size in minutes, e.g. '1', '5', '60'
+    return str(granularity // 60)
+
+
+class ProductPipeline:
+    """
+    The periods and indicators of one product. Trades only go through the
+    one minute base period, every other granularity is an AggregatePeriod
+    built from its closed candlesticks.
+    """
+    def __init__(self, product_id, granularities=(60,), order_book=None, initialize=True,
+                 api_url=period.API_URL, store=None):
+        self.product_id = product_id
+        self.order_book = order_book
+        base = period.Period(period_size=60, name=period_name(60), product_id=product_id,
+                             initialize=initialize, api_url=api_url, store=store)
+        self.period_list = [base]
+        for granularity in sorted(set(granularities)):
+            if granularity > 60:
+                self.period_list.append(period.AggregatePeriod(base, granularity, name=period_name(granularity),
+                                                               initialize=initialize))
+        self.indicator_subsys = indicators.IndicatorSubsystem(self.period_list)
+        # Order book and trade tape features, published as current_indicators['micro']
+        self.microstructure = microstructure.MicrostructureFeatures(order_book)
+        # Called with (pipeline, msg) after each message has been processed
+        self.listeners = []
+        # Matches before this time were in the history when it was fetched,
+        # see initialize()
+        self.history_time = None
+
+    def get_period(self, granularity=60):
+        for cur_period in self.period_list:
+            if cur_period.period_size == granularity:
+                return cur_period
+
+    def initialize(self):
+        """
+        Reloads the history of every period. The histories are fetched
+        concurrently, then the base period is initialized first as the
+        aggregates rebuild their open bucket from it. Matches the feed
+        buffered while fetching that are older than the fetch are already
+        counted in the history and do not update the periods again.
+        """
+        history_time = period.from_epoch(time.time())
+        histories = concurrently(lambda cur_period: cur_period.get_history(), self.period_list)
+        for cur_period, hist_data in zip(self.period_list, histories):
+            cur_period.initialize(hist_data)
+        # Indicators warm up here rather than on the first match
+        for cur_period in self.period_list:
+            self.indicator_subsys.get_streams(cur_period)
+        self.history_time = history_time
+
+    def process_message(self, msg):
+        if msg.get('type') == "match":
+            started = metrics.clock()
+            if self.history_time is None or trade.parse_time(msg.get('time')) >= self.history_time:
+                self.history_time = None
+                self.period_list[0].process_trade(msg)
+                for cur_period in self.period_list[1:]:
+                    cur_period.refresh()
+                for cur_period in self.period_list:
+                    self.indicator_subsys.recalculate_indicators(cur_period, self.order_book)
+            self.microstructure.process_trade(msg)
+            self.indicator_subsys.current_indicators['micro'] = self.microstructure.features()
+            metrics.indicator_seconds.observe_since(started, self.product_id)
+        elif msg.get('type') == "heartbeat":
+            self.period_list[0].process_heartbeat(msg)
+            self.microstructure.process_heartbeat(msg)
+            self.indicator_subsys.current_indicators['micro'] = self.microstructure.features()
+        for listener in self.listeners:
+            listener(self, msg)
+
+
+class MarketDataDispatcher:
+    """
+    Routes each message to the pipeline of its product_id. With workers=0
+    messages are processed in the calling thread. Otherwise every product is
+    pinned to one of the worker threads, so its messages stay in order and
+    the caller only enqueues, blocking once a worker falls queue_size
+    messages behind. Errors raised by a worker are re-raised in the caller
+    on the next dispatch().
+    """
+    def __init__(self, pipelines, workers=0, queue_size=10000):
+        self.logger = logging.getLogger('trader-logger')
+        self.pipelines = dict((pipeline.product_id, pipeline) for pipeline in pipelines)
+        self.workers = workers
+        self.queue_size = queue_size
+        self.worker_of = dict((product_id, idx % workers if workers else 0)
+                              for idx, product_id in enumerate(sorted(self.pipelines)))
+        self.errors = Queue.Queue()
+        self.queues = []
+        self.threads = []
+        self.start()
+
+    def start(self):
+        self.queues = [feed.FeedQueue(self.queue_size, name='worker_%d' % idx) for idx in range(self.workers)]
+        self.threads = [threading.Thread(target=self.work, args=(queue,), name='market_worker_%d' % idx)
+                        for idx, queue in enumerate(self.queues)]
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+
+    def close(self):
+        for queue in self.queues:
+            queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.queues = []
+        self.threads = []
+
+    def initialize(self, timer=None):
+        """
+        Reloads the history of every pipeline, all of them concurrently, so
+        this takes as long as the slowest product. With a
+        metrics.StartupTimer each product's time is recorded.
+        """
+        # Workers are stopped so no stale message is applied to fresh history
+        self.close()
+
+        def initialize(pipeline):
+            if timer is None:
+                pipeline.initialize()
+            else:
+                timer.time('history %s' % pipeline.product_id, pipeline.initialize)
+        concurrently(initialize, [self.pipelines[product_id] for product_id in sorted(self.pipelines)])
+        while not self.errors.empty():
+            self.errors.get()
+        self.start()
+
+    def work(self, queue):
+        while True:
+            msg = queue.get()
+            if msg is None:
+                break
+            try:
+                self.pipelines[msg.get('product_id')].process_message(msg)
+            except Exception:
+                self.errors.put(sys.exc_info())
+
+    def raise_errors(self):
+        if not self.errors.empty():
+            six.reraise(*self.errors.get())
+
+    def dispatch(self, msg):
+        self.raise_errors()
+        pipeline = self.pipelines.get(msg.get('product_id'))
+        if pipeline is None:
+            return None
+        if self.queues:
+            self.queues[self.worker_of[pipeline.product_id]].put(msg)
+        else:
+            pipeline.process_message(msg)
+        return pipeline
@@ -0,0 +1,75 @@
+#
+# marketdata.py
+# Mike Cardillo
+#
+# Market data daemon: owns the websocket feeds, the order book and the
+# period history, and publishes the state of every product into
+# MARKET_STATE_DIR (see marketstate.py). Traders started with the same
+# MARKET_STATE_DIR read it from there instead of opening feeds of their own.
+
+import Queue
+import logging
+import config
+import feed
+import market
+import engine
+import asynclog
+import tickstore
+import candlestore
+import marketstate
+
+logger = logging.getLogger('trader-logger')
+logger.setLevel(getattr(logging, getattr(config, 'LOG_LEVEL', "DEBUG")))
+log_handler = asynclog.AsyncLogHandler(asynclog.RotatingFileWriter(getattr(config, 'MARKET_DATA_LOG_FILE',
+                                                                           "marketdata.log"),
+                                                                   getattr(config, 'LOG_MAX_BYTES', 0),
+                                                                   getattr(config, 'LOG_ROTATE_SECONDS', 0),
+                                                                   getattr(config, 'LOG_BACKUPS', 5)))
+logger.addHandler(log_handler)
+
+state_dir = getattr(config, 'MARKET_STATE_DIR', '') or "/dev/shm/gdax-trader"
+products = sorted(set(getattr(config, 'PRODUCTS', []) + ["BTC-USD"]))
+granularities = getattr(config, 'GRANULARITIES', [60])
+api_url = getattr(config, 'API_URL', "https://api.gdax.com")
+websocket_url = getattr(config, 'WEBSOCKET_URL', "wss://ws-feed.gdax.com")
+queue_size = getattr(config, 'QUEUE_SIZE', 10000)
+
+candle_store = candlestore.CandleStore(config.CANDLE_DIR) if getattr(config, 'CANDLE_DIR', '') else None
+tick_writer = tickstore.TickCapture(config.CAPTURE_DIR) if getattr(config, 'CAPTURE_DIR', '') else None
+gdax_websocket = feed.TradeAndHeartbeatWebsocket(url=websocket_url, products=products, tick_writer=tick_writer,
+                                                 queue_size=queue_size, gap_tracker=feed.TradeGapTracker(api_url))
+order_book = engine.OrderBookCustom(url=websocket_url, api_url=api_url)
+order_book.start()
+pipelines = [market.ProductPipeline(product_id, granularities,
+                                    order_book=order_book if product_id == "BTC-USD" else None,
+                                    initialize=False, api_url=api_url, store=candle_store)
+             for product_id in products]
+writers = [marketstate.MarketStateWriter(state_dir, pipeline) for pipeline in pipelines]
+dispatcher = market.MarketDataDispatcher(pipelines, workers=getattr(config, 'INDICATOR_WORKERS', 0),
+                                         queue_size=queue_size)
+# The feed buffers while the history of every product loads concurrently
+gdax_websocket.start()
+dispatcher.initialize()
+logger.debug("[MARKETDATA] Publishing %s to %s", ', '.join(products), state_dir)
+
+while(True):
+    try:
+        msg = gdax_websocket.websocket_queue.get(timeout=15)
+        if msg.get('type') == "reinitialize":
+            dispatcher.initialize()
+            continue
+        dispatcher.dispatch(msg)
+    except KeyboardInterrupt:
+        gdax_websocket.close()
+        order_book.close()
+        dispatcher.close()
+        for writer in writers:
+            writer.close()
+        log_handler.close()
+        break
+    except Queue.Empty:
+        logger.debug("No market data for 15 seconds, %d websocket reconnects so far",
+                     gdax_websocket.reconnects)
+    except Exception:
+        logger.debug("Error processing market data", exc_info=True)
+        dispatcher.initialize()
@@ -0,0 +1,502 @@
+#
+# marketstate.py
+# Mike Cardillo
+#
+# Market state shared between processes through memory mapped files, one per
+# product: top of book, microstructure features, and for every period its
+# closed and open candlesticks and built-in indicators. marketdata.py owns
+# the feeds and writes the state, any number of traders and dashboards map
+# it read-only and see NumPy views of the same memory.
+#
+# Updates are published under a seqlock: the writer makes the sequence
+# number odd, writes, and makes it even again, and a reader retries any read
+# that overlapped a change of the sequence number.
+
+import os
+import json
+import mmap
+import time
+import struct
+import operator
+import logging
+import threading
+import numpy as np
+from decimal import Decimal
+import feed
+import period
+import indicators
+
+LAYOUT = 1
+HEADER_SIZE = 4096
+CONTROL_FIELDS = ('sequence', 'closed', 'matches', 'heartbeats')
+TOP_FIELDS = ('bid', 'ask', 'price', 'time')
+META_FIELDS = ('next_slot', 'count', 'total')
+INDICATOR_FIELDS = ('total_periods', 'macd', 'macd_sig', 'macd_hist', 'macd_hist_diff', 'mfi', 'sar',
+                    'bband_upper', 'bband_lower', 'bid_obv', 'bid_obv_ema', 'ask_obv', 'ask_obv_ema')
+NAN = float('nan')
+# The sequence number, first in the control array
+SEQUENCE = struct.Struct('<Q')
+
+
+def segment_path(directory, product_id):
+    return os.path.join(directory, product_id + '.state')
+
+
+def regions(description):
+    # name -> (offset, dtype, shape) of every array in a segment
+    layout = {}
+    offset = HEADER_SIZE
+
+    def add(name, dtype, shape):
+        layout[name] = (offset, dtype, shape)
+        return offset + np.dtype(dtype).itemsize * int(np.prod(shape))
+    offset = add('control', '<u8', (len(CONTROL_FIELDS),))
+    offset = add('top', '<f8', (len(TOP_FIELDS),))
+    offset = add('micro', '<f8', (len(description['micro']),))
+    for name, period_size in description['periods']:
+        offset = add('meta/' + name, '<f8', (len(META_FIELDS),))
+        offset = add('current/' + name, '<f8', (6,))
+        offset = add('indicators/' + name, '<f8', (len(INDICATOR_FIELDS),))
+        offset = add('candles/' + name, '<f8', (6, 2 * description['capacity']))
+    return layout, offset
+
+
+def views(buffer, description):
+    arrays = {}
+    for name, (offset, dtype, shape) in regions(description)[0].items():
+        arrays[name] = np.frombuffer(buffer, dtype=dtype, count=int(np.prod(shape)), offset=offset).reshape(shape)
+    return arrays
+
+
+# The INDICATOR_FIELDS of current_indicators[period_name], its 'bid' and its 'ask'
+INDICATOR_VALUES = operator.itemgetter(*INDICATOR_FIELDS[:-4])
+OBV_VALUES = operator.itemgetter('obv', 'obv_ema')
+
+
+class MarketStateWriter:
+    """
+    Publishes the state of a market.ProductPipeline after every message it
+    processes, and the top of book on every change of its order book. The
+    segment is created next to any previous one and renamed over it, after
+    marking the previous one closed, so attached readers know to reattach.
+    """
+    def __init__(self, directory, pipeline, capacity=10000):
+        self.logger = logging.getLogger('trader-logger')
+        self.pipeline = pipeline
+        self.path = segment_path(directory, pipeline.product_id)
+        self.description = {'layout': LAYOUT, 'product_id': pipeline.product_id, 'capacity': capacity,
+                            'periods': [[cur_period.name, cur_period.period_size]
+                                        for cur_period in pipeline.period_list],
+                            'micro': sorted(pipeline.microstructure.features())}
+        header = json.dumps(self.description).encode('utf-8')
+        if len(header) > HEADER_SIZE:
+            raise ValueError("Market state description does not fit in %d bytes" % HEADER_SIZE)
+        size = regions(self.description)[1]
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        temporary = self.path + '.tmp'
+        with open(temporary, 'wb') as new_file:
+            new_file.write(header + b'\0' * (HEADER_SIZE - len(header)))
+            new_file.truncate(size)
+        self.file = open(temporary, 'r+b')
+        self.mm = mmap.mmap(self.file.fileno(), size)
+        # The small arrays are written with struct, which is much cheaper
+        # per update than assigning Python values into NumPy views
+        self.packers = {}
+        for name, (offset, dtype, shape) in regions(self.description)[0].items():
+            if not name.startswith('candles/'):
+                self.packers[name] = (struct.Struct('<%d%s' % (int(np.prod(shape)), 'Q' if dtype == '<u8' else 'd')),
+                                      offset)
+        self.arrays = views(self.mm, self.description)
+        self.sequence = 0
+        self.counters = [0, 0, 0]
+        self.top = [NAN] * len(TOP_FIELDS)
+        self.pack('top', self.top)
+        self.pack('micro', [NAN] * len(self.description['micro']))
+        self.buffers = {}
+        # Periods with candlesticks closed or amended since the last update
+        self.changed = set()
+        for cur_period in pipeline.period_list:
+            name = cur_period.name
+            self.pack('current/' + name, [NAN] * 6)
+            self.pack('indicators/' + name, [NAN] * len(INDICATOR_FIELDS))
+            self.buffers[name] = [None, period.CandlestickBuffer(capacity, data=self.arrays['candles/' + name])]
+            cur_period.listeners.append(lambda row, amended=False, name=name: self.changed.add(name))
+        if os.path.exists(self.path):
+            mark_closed(self.path)
+        os.rename(temporary, self.path)
+        # Publishing is serialized between the pipeline and order book threads
+        self.lock = threading.Lock()
+        pipeline.listeners.append(self.on_message)
+        if pipeline.order_book is not None and hasattr(pipeline.order_book, 'listeners'):
+            pipeline.order_book.listeners.append(self.on_top_of_book)
+
+    def pack(self, name, values):
+        packer, offset = self.packers[name]
+        packer.pack_into(self.mm, offset, *values)
+
+    def begin(self):
+        # An odd sequence number tells readers a write is in progress
+        self.sequence += 1
+        SEQUENCE.pack_into(self.mm, HEADER_SIZE, self.sequence)
+
+    def end(self):
+        self.pack('control', [self.sequence + 1] + self.counters)
+        self.sequence += 1
+
+    def on_top_of_book(self, bid, ask):
+        with self.lock:
+            self.begin()
+            try:
+                self.top[0:2] = (float(bid), float(ask))
+                self.pack('top', self.top)
+            finally:
+                self.end()
+
+    def on_message(self, pipeline, msg):
+        current_indicators = pipeline.indicator_subsys.current_indicators
+        micro = current_indicators.get('micro', {})
+        with self.lock:
+            self.begin()
+            try:
+                if msg.get('type') == "match":
+                    self.counters[1] += 1
+                    self.top[2] = float(msg.get('price'))
+                    self.top[3] = micro.get('time') or NAN
+                elif msg.get('type') == "heartbeat":
+                    self.counters[2] += 1
+                if pipeline.order_book is not None and pipeline.order_book.is_ready():
+                    self.top[0:2] = (float(pipeline.order_book.get_bid()), float(pipeline.order_book.get_ask()))
+                self.pack('top', self.top)
+                self.pack('micro', [NAN if value is None else value
+                                    for value in map(micro.get, self.description['micro'])])
+                for cur_period in pipeline.period_list:
+                    self.write_period(cur_period, current_indicators.get(cur_period.name, {}))
+            finally:
+                self.end()
+
+    def write_period(self, cur_period, values):
+        name = cur_period.name
+        source = cur_period.candlesticks
+        published, buffer = self.buffers[name]
+        if source is not published or source.total != buffer.total or name in self.changed:
+            self.changed.discard(name)
+            new_rows = source.total - buffer.total
+            if source is not published or new_rows < 0 or new_rows > len(source):
+                # New or re-initialized period, start over
+                buffer.next_slot = buffer.count = buffer.total = 0
+                buffer.extend(source[:])
+                buffer.total = source.total
+                self.buffers[name][0] = source
+            elif new_rows > 0:
+                buffer.extend(source[len(source) - new_rows:])
+            if len(source):
+                # The last candlestick may have been amended by a late trade
+                buffer.amend_last(source[-1])
+            self.pack('meta/' + name, (buffer.next_slot, buffer.count, buffer.total))
+        stick = cur_period.cur_candlestick
+        if stick is not None and stick.open is not None:
+            self.pack('current/' + name, (period.to_epoch(stick.time), stick.low, stick.high,
+                                          stick.open, stick.close, stick.volume))
+        try:
+            self.pack('indicators/' + name, INDICATOR_VALUES(values) + OBV_VALUES(values['bid']) +
+                      OBV_VALUES(values['ask']))
+        except KeyError:
+            # Not calculated yet
+            pass
+
+    def close(self):
+        with self.lock:
+            self.begin()
+            self.counters[0] = 1
+            self.end()
+        self.mm.flush()
+
+
+def mark_closed(path):
+    # Tells the readers of an older segment to reattach
+    try:
+        with open(path, 'r+b') as old_file:
+            mm = mmap.mmap(old_file.fileno(), HEADER_SIZE + 8 * len(CONTROL_FIELDS))
+            control = np.frombuffer(mm, dtype='<u8', count=len(CONTROL_FIELDS), offset=HEADER_SIZE)
+            control[0] += 1
+            control[1] = 1
+            control[0] += 1
+            del control
+            mm.close()
+    except (IOError, OSError, ValueError):
+        pass
+
+
+class MarketStateReader:
+    """
+    Read-only attachment to the segment of one product. Every array in
+    arrays is a view of the shared memory, so reads cost no copying; read()
+    runs a function of them until it did not overlap a write.
+    """
+    def __init__(self, directory, product_id, timeout=30.0):
+        self.path = segment_path(directory, product_id)
+        deadline = time.time() + timeout
+        while not os.path.exists(self.path):
+            if time.time() > deadline:
+                raise ValueError("No market state at %s, is marketdata.py running?" % self.path)
+            time.sleep(0.1)
+        self.file = open(self.path, 'rb')
+        self.inode = os.fstat(self.file.fileno()).st_ino
+        self.mm = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.description = json.loads(self.mm[:HEADER_SIZE].rstrip(b'\0').decode('utf-8'))
+        if self.description.get('layout') != LAYOUT:
+            raise ValueError("%s has layout %s, expected %d" % (self.path, self.description.get('layout'), LAYOUT))
+        self.arrays = views(self.mm, self.description)
+        self.control = self.arrays['control']
+
+    def sequence(self):
+        return int(self.control[0])
+
+    def counters(self):
+        # (sequence, matches, heartbeats)
+        return self.read(lambda: (int(self.control[0]), int(self.control[2]), int(self.control[3])))
+
+    def replaced(self):
+        # True once the writer closed this segment or a new one took its place
+        if self.control[1]:
+            return True
+        try:
+            return os.stat(self.path).st_ino != self.inode
+        except OSError:
+            return False
+
+    def read(self, fn, retries=10000):
+        for attempt in xrange(retries):
+            before = self.control[0]
+            if before % 2 == 0:
+                result = fn()
+                if self.control[0] == before:
+                    return result
+            time.sleep(0)
+        raise ValueError("Market state at %s kept changing while being read" % self.path)
+
+    def top(self):
+        # (bid, ask, last trade price, last trade time)
+        return self.read(lambda: tuple(self.arrays['top']))
+
+    def candlesticks(self, period_name):
+        """
+        Closed candlesticks as a CandlestickBuffer over the shared memory.
+        Its rows are views, valid until the writer overwrites them.
+        """
+        next_slot, count, total = self.read(lambda: tuple(self.arrays['meta/' + period_name]))
+        buffer = period.CandlestickBuffer(self.description['capacity'], data=self.arrays['candles/' + period_name])
+        buffer.next_slot, buffer.count, buffer.total = int(next_slot), int(count), int(total)
+        return buffer
+
+    def snapshot(self):
+        """
+        A consistent copy of everything but the closed candlesticks: top,
+        micro and, per period, meta, current and indicators.
+        """
+        return self.read(lambda: dict((name, array.copy()) for name, array in self.arrays.items()
+                                      if not name.startswith('candles/')))
+
+
+class SharedOrderBook:
+    """
+    The top of book published by marketdata.py, in place of OrderBookCustom
+    for TradeEngine. listeners are called by SharedFeed when it changes.
+    """
+    def __init__(self, product_id='BTC-USD'):
+        self.product_id = product_id
+        self.top_of_book = None
+        self.listeners = []
+
+    def start(self):
+        pass
+
+    def close(self):
+        pass
+
+    def update(self, bid, ask):
+        if bid != bid or ask != ask:
+            # Not published yet
+            return
+        top_of_book = (Decimal('%.2f' % bid), Decimal('%.2f' % ask))
+        if top_of_book != self.top_of_book:
+            self.top_of_book = top_of_book
+            for listener in self.listeners:
+                listener(*top_of_book)
+
+    def is_ready(self):
+        return self.top_of_book is not None
+
+    def wait_until_ready(self, timeout=None):
+        deadline = time.time() + (timeout if timeout is not None else 30.0)
+        while self.top_of_book is None:
+            if time.time() > deadline:
+                raise ValueError("Order book not ready after %s seconds" % timeout)
+            time.sleep(0.01)
+
+    def get_bid(self, timeout=None):
+        if self.top_of_book is None:
+            self.wait_until_ready(timeout)
+        return self.top_of_book[0]
+
+    def get_ask(self, timeout=None):
+        if self.top_of_book is None:
+            self.wait_until_ready(timeout)
+        return self.top_of_book[1]
+
+
+class SharedPeriod:
+    # What the trading loop and the interface read from a period.Period
+    def __init__(self, name, period_size, product_id):
+        self.name = name
+        self.period_size = period_size
+        self.product_id = product_id
+        self.verbose_heartbeat = False
+        self.candlesticks = period.CandlestickBuffer(1)
+        self.cur_candlestick = None
+
+
+class SharedIndicatorSubsystem(indicators.IndicatorSubsystem):
+    """
+    current_indicators as published by marketdata.py. Only the built-in
+    configurations are published, so only they can be required.
+    """
+    def __init__(self, period_list):
+        indicators.IndicatorSubsystem.__init__(self, period_list)
+        self.period_names = [cur_period.name for cur_period in period_list]
+
+    def require(self, period_name, kind, params):
+        if self.builtin[kind] != tuple(params):
+            raise ValueError("%s %s is not published by marketdata.py" % (kind, tuple(params)))
+        return indicators.IndicatorSubsystem.require(self, period_name, kind, params)
+
+    def load(self, snapshot, micro_fields):
+        current_indicators = {'micro': dict(zip(micro_fields, snapshot['micro']))}
+        for period_name in self.period_names:
+            published = dict(zip(INDICATOR_FIELDS, snapshot['indicators/' + period_name]))
+            values = {'bid': {}, 'ask': {}}
+            if published['total_periods'] != published['total_periods']:
+                # Not calculated yet
+                current_indicators[period_name] = values
+                continue
+            for field, value in published.items():
+                if field[:4] in ('bid_', 'ask_'):
+                    values[field[:3]][field[4:]] = value
+                else:
+                    values[field] = value
+            values['total_periods'] = int(values['total_periods'])
+            values['macd_hist_diff'] = Decimal(repr(values['macd_hist_diff']))
+            current_indicators[period_name] = values
+        self.current_indicators = current_indicators
+        for period_name in self.period_names:
+            if 'macd_hist_diff' not in current_indicators[period_name]:
+                continue
+            for key, (kind, params) in self.required.get(period_name, {}).items():
+                # Built-in configurations only, which reuse the values above
+                self.calculate_required(period_name, None, key, kind, params, None, None, None)
+
+
+class SharedPipeline:
+    """
+    Stands in for market.ProductPipeline in a trader that reads the market
+    state from marketdata.py. process_message() loads the latest published
+    state and calls the listeners, initialize() reattaches to the segment.
+    """
+    def __init__(self, directory, product_id, order_book=None):
+        self.directory = directory
+        self.product_id = product_id
+        self.order_book = order_book
+        self.listeners = []
+        self.reader = MarketStateReader(directory, product_id)
+        self.period_list = [SharedPeriod(name, period_size, product_id)
+                            for name, period_size in self.reader.description['periods']]
+        self.indicator_subsys = SharedIndicatorSubsystem(self.period_list)
+
+    def get_period(self, granularity=60):
+        for cur_period in self.period_list:
+            if cur_period.period_size == granularity:
+                return cur_period
+
+    def initialize(self):
+        self.reader = MarketStateReader(self.directory, self.product_id)
+
+    def load(self):
+        snapshot = self.reader.snapshot()
+        for cur_period in self.period_list:
+            cur_period.candlesticks = self.reader.candlesticks(cur_period.name)
+            row = snapshot['current/' + cur_period.name]
+            cur_period.cur_candlestick = period.Candlestick(existing_candlestick=row) if row[0] == row[0] else None
+        self.indicator_subsys.load(snapshot, self.reader.description['micro'])
+        return snapshot
+
+    def process_message(self, msg):
+        self.load()
+        for listener in self.listeners:
+            listener(self, msg)
+
+
+class SharedFeed:
+    """
+    Stands in for feed.TradeAndHeartbeatWebsocket. A thread polls the
+    sequence numbers of the pipelines' segments every poll_interval seconds
+    and queues a match message, with the price and time of the last trade,
+    for a product when trades were published for it since the last poll, a
+    heartbeat message when only heartbeats were, and a reinitialize message
+    when marketdata.py was restarted. Order books are updated on every poll.
+    """
+    def __init__(self, pipelines, queue_size=10000, poll_interval=0.002):
+        self.logger = logging.getLogger('trader-logger')
+        self.pipelines = pipelines
+        self.websocket_queue = feed.FeedQueue(queue_size)
+        self.poll_interval = poll_interval
+        self.reconnects = 0
+        self.closing = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.closing.clear()
+        self.thread = threading.Thread(target=self.run, name='shared_feed')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def poll(self, seen):
+        for pipeline in self.pipelines:
+            reader = pipeline.reader
+            if reader.replaced():
+                if seen.get(pipeline.product_id) != 'replaced':
+                    self.reconnects += 1
+                    seen[pipeline.product_id] = 'replaced'
+                    self.websocket_queue.put_message({'type': "reinitialize", 'product_id': pipeline.product_id})
+                continue
+            counters = reader.counters()
+            last = seen.get(pipeline.product_id)
+            if isinstance(last, tuple) and last[0] == counters[0]:
+                continue
+            bid, ask, price, trade_time = reader.top()
+            if pipeline.order_book is not None:
+                pipeline.order_book.update(bid, ask)
+            if isinstance(last, tuple):
+                if counters[1] != last[1]:
+                    # The last trade stands in for every trade published since the last poll
+                    msg = {'type': "match", 'product_id': pipeline.product_id, 'price': repr(price)}
+                    if trade_time == trade_time:
+                        msg['time'] = period.from_epoch(trade_time).strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+                    self.websocket_queue.put_message(msg)
+                elif counters[2] != last[2]:
+                    self.websocket_queue.put_message({'type': "heartbeat", 'product_id': pipeline.product_id})
+            seen[pipeline.product_id] = counters
+
+    def run(self):
+        # product_id -> counters last seen, or 'replaced' until reattached
+        seen = {}
+        while not self.closing.wait(self.poll_interval):
+            try:
+                self.poll(seen)
+            except Exception:
+                self.logger.debug("[SHARED] Polling the market state failed", exc_info=True)
+
+    def close(self):
+        self.closing.set()
+        if self.thread is not None:
+            self.thread.join()
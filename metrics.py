@@ -0,0 +1,280 @@
+#
+# metrics.py
+# Mike Cardillo
+#
+# Counters, gauges and latency histograms for the trading loop, exposed in
+# the Prometheus text format over HTTP (MetricsServer) or as a file that is
+# rewritten periodically (SnapshotWriter).
+#
+# Instrumentation stays off until enable() is called. While it is off,
+# clock() returns None and inc()/observe_since() return after checking one
+# flag, so instrumented hot paths only pay for a function call.
+
+import os
+import time
+import types
+import bisect
+import logging
+import threading
+from timeit import default_timer
+try:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+except ImportError:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+
+enabled = False
+# Histogram upper bounds in seconds
+LATENCY_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                   0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+REGISTRY = []
+
+
+def enable():
+    global enabled
+    enabled = True
+
+
+def clock():
+    # Start time for observe_since(), None while disabled
+    return default_timer() if enabled else None
+
+
+def escape_label(value):
+    # Label values as the text exposition format quotes them
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_labels(label, value):
+    if value is None:
+        return ''
+    return '{%s="%s"}' % (label, escape_label(value))
+
+
+class Counter:
+    def __init__(self, name, help, label=None):
+        self.name = name
+        self.help = help
+        self.label = label
+        self.values = {}
+        self.lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def inc(self, value=None, amount=1):
+        if not enabled:
+            return
+        with self.lock:
+            self.values[value] = self.values.get(value, 0) + amount
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.help), '# TYPE %s counter' % self.name]
+        with self.lock:
+            for value, count in sorted(self.values.items()):
+                lines.append('%s%s %d' % (self.name, format_labels(self.label, value), count))
+        return lines
+
+
+class Gauge:
+    """
+    Value read only when the metrics are rendered, from a function set per
+    label value, e.g. the size of a queue. Costs nothing on the hot path.
+    """
+    def __init__(self, name, help, label=None):
+        self.name = name
+        self.help = help
+        self.label = label
+        self.functions = {}
+        REGISTRY.append(self)
+
+    def set_function(self, value, function):
+        self.functions[value] = function
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.help), '# TYPE %s gauge' % self.name]
+        for value, function in sorted(self.functions.items()):
+            try:
+                lines.append('%s%s %s' % (self.name, format_labels(self.label, value), repr(float(function()))))
+            except Exception:
+                continue
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help, label=None, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.label = label
+        self.buckets = tuple(buckets)
+        # label value -> [bucket counts (the last one is +Inf), sum]
+        self.values = {}
+        self.lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def observe(self, seconds, value=None):
+        if not enabled:
+            return
+        idx = bisect.bisect_left(self.buckets, seconds)
+        with self.lock:
+            entry = self.values.get(value)
+            if entry is None:
+                entry = self.values[value] = [[0] * (len(self.buckets) + 1), 0.0]
+            entry[0][idx] += 1
+            entry[1] += seconds
+
+    def observe_since(self, started, value=None):
+        if started is None:
+            return
+        self.observe(default_timer() - started, value)
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.help), '# TYPE %s histogram' % self.name]
+        with self.lock:
+            values = [(value, list(entry[0]), entry[1]) for value, entry in sorted(self.values.items())]
+        for value, counts, total in values:
+            prefix = '' if value is None else '%s="%s",' % (self.label, escape_label(value))
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                lines.append('%s_bucket{%sle="%s"} %d' % (self.name, prefix, bound, cumulative))
+            labels = format_labels(self.label, value)
+            lines.append('%s_sum%s %r' % (self.name, labels, total))
+            lines.append('%s_count%s %d' % (self.name, labels, cumulative))
+        return lines
+
+
+def render():
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+messages_total = Counter('gdax_messages_total', "Websocket messages received", 'type')
+reconnects_total = Counter('gdax_reconnects_total', "Websocket reconnects", 'feed')
+rejects_total = Counter('gdax_order_rejects_total', "Orders rejected by the exchange", 'side')
+queue_depth = Gauge('gdax_queue_depth', "Messages waiting in a market data queue", 'queue')
+queue_wait_seconds = Histogram('gdax_queue_wait_seconds', "Time messages spent in a market data queue", 'queue')
+indicator_seconds = Histogram('gdax_indicator_seconds', "Time to process a match through periods and indicators",
+                              'product')
+rest_seconds = Histogram('gdax_rest_seconds', "REST round trip time", 'endpoint')
+reprice_seconds = Histogram('gdax_reprice_seconds', "Time to replace an order at a new price", 'side')
+startup_seconds = Gauge('gdax_startup_seconds', "Time from process start until a startup step finished", 'step')
+
+
+class StartupTimer:
+    """
+    Records when each startup step finished, relative to started, and how
+    long the step itself took if it was timed. Steps may run concurrently. Recorded steps
+    are exported through startup_seconds, report() formats them for the log.
+    """
+    def __init__(self, started=None):
+        self.started = time.time() if started is None else started
+        # (name, seconds the step took, seconds since started)
+        self.steps = []
+        self.lock = threading.Lock()
+
+    def record(self, name, began=None):
+        # Without began the step is only a point in time
+        finished = time.time() - self.started
+        took = finished - (began - self.started) if began is not None else None
+        with self.lock:
+            self.steps.append((name, took, finished))
+        startup_seconds.set_function(name, lambda: finished)
+
+    def time(self, name, function, *args, **kwargs):
+        # A step that raises is not recorded
+        began = time.time()
+        result = function(*args, **kwargs)
+        self.record(name, began)
+        return result
+
+    def report(self):
+        with self.lock:
+            steps = sorted(self.steps, key=lambda step: step[2])
+        return ', '.join('%s at %.3f s' % (name, finished) if took is None else
+                         '%s %.3f s (done at %.3f s)' % (name, took, finished)
+                         for name, took, finished in steps)
+
+
+class TimedClient:
+    """
+    Wraps a gdax client so every method call is timed into rest_seconds,
+    labelled with the method name. Other attributes, such as the callable
+    auth object the user feed signs with, are passed through unchanged.
+    """
+    def __init__(self, client):
+        self.client = client
+
+    def __getattr__(self, name):
+        attribute = getattr(self.client, name)
+        if not isinstance(attribute, types.MethodType):
+            return attribute
+
+        def timed(*args, **kwargs):
+            started = clock()
+            try:
+                return attribute(*args, **kwargs)
+            finally:
+                rest_seconds.observe_since(started, name)
+        return timed
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class MetricsServer:
+    # Serves /metrics on a daemon thread
+    def __init__(self, port, host='127.0.0.1'):
+        self.logger = logging.getLogger('trader-logger')
+        self.server = HTTPServer((host, port), MetricsHandler)
+        self.thread = threading.Thread(target=self.server.serve_forever, name='metrics_server')
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+        self.logger.debug("[METRICS] Serving on %s:%d", *self.server.server_address[:2])
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class SnapshotWriter:
+    # Rewrites path with the current metrics every interval seconds
+    def __init__(self, path, interval=10.0):
+        self.path = path
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name='metrics_snapshot')
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+
+    def close(self):
+        self.stopped.set()
+        self.thread.join()
+        self.write()
+
+    def write(self):
+        # Written to a temporary file first so readers never see half a snapshot
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w') as snapshot_file:
+            snapshot_file.write(render())
+        os.rename(temp_path, self.path)
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.write()
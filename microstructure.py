@@ -0,0 +1,197 @@
+#
+# microstructure.py
+# Mike Cardillo
+#
+# Streaming features of the order book and the trade tape: top of book depth
+# imbalance, microprice, spread statistics, and VWAP and signed trade flow
+# over sliding time windows. Every window is a ring of one second buckets
+# with running sums, so each book or match message costs O(1) and publishing
+# the features costs O(levels + windows), independent of the trading rate.
+
+import math
+import time
+import trade
+import period
+import orderbook
+
+NAN = float('nan')
+
+
+class TimeWindow:
+    """
+    Sums of the values added during the last `seconds`, kept in a ring of
+    one second buckets of `columns` values each. A bucket leaves once the
+    last value added to it ages out, so the window covers at least
+    `seconds` and at most a second more, and never needs more than
+    seconds + 1 buckets however fast values arrive. A value older than the
+    newest bucket is added to it.
+    """
+    def __init__(self, seconds, columns):
+        self.seconds = seconds
+        self.capacity = int(math.ceil(seconds)) + 1
+        # Per bucket: its second, the time of its last value, its sums and its number of values
+        self.starts = [0.0] * self.capacity
+        self.times = [0.0] * self.capacity
+        self.values = [[0.0] * columns for idx in range(self.capacity)]
+        self.counts = [0] * self.capacity
+        self.sums = [0.0] * columns
+        self.head = 0
+        self.buckets = 0
+        self.count = 0
+        self.removed = 0
+
+    def __len__(self):
+        return self.count
+
+    def pop(self):
+        values = self.values[self.head]
+        for idx, value in enumerate(values):
+            self.sums[idx] -= value
+        self.count -= self.counts[self.head]
+        self.head = (self.head + 1) % self.capacity
+        self.buckets -= 1
+        self.removed += 1
+        if not self.buckets:
+            self.sums = [0.0] * len(self.sums)
+        elif self.removed >= self.capacity:
+            # Re-summing now and then keeps running subtraction from drifting
+            self.removed = 0
+            entries = [self.values[(self.head + idx) % self.capacity] for idx in range(self.buckets)]
+            self.sums = [math.fsum(column) for column in zip(*entries)]
+
+    def evict(self, now):
+        start = now - self.seconds
+        while self.buckets and self.times[self.head] <= start:
+            self.pop()
+
+    def add(self, now, values):
+        self.evict(now)
+        second = math.floor(now)
+        slot = (self.head + self.buckets - 1) % self.capacity
+        if self.buckets and second <= self.starts[slot]:
+            bucket = self.values[slot]
+            for idx, value in enumerate(values):
+                bucket[idx] += value
+            self.times[slot] = max(self.times[slot], now)
+        else:
+            slot = (self.head + self.buckets) % self.capacity
+            self.starts[slot] = second
+            self.times[slot] = now
+            self.values[slot] = list(values)
+            self.counts[slot] = 0
+            self.buckets += 1
+        self.counts[slot] += 1
+        for idx, value in enumerate(values):
+            self.sums[idx] += value
+        self.count += 1
+
+
+class MicrostructureFeatures:
+    """
+    Features of one product, published as a dict by features():
+
+        spread, spread_mean, spread_std   top of book spread, and its mean and
+                                          standard deviation over spread_window
+                                          seconds of top of book changes
+        imbalance                         (bid size - ask size) / (bid size +
+                                          ask size) of the best `levels` levels
+        microprice                        best bid and ask weighted by the size
+                                          on the opposite side
+        vwap_<s>, volume_<s>, trades_<s>  VWAP, volume and number of trades
+                                          over the last s seconds
+        flow_<s>, flow_ratio_<s>          taker buy minus taker sell volume
+                                          over the last s seconds, and that as
+                                          a fraction of the volume
+
+    Depth features need an OrderBookCustom and are NaN otherwise. With an
+    order book that has top of book listeners the spread is sampled on every
+    top of book change, otherwise on every trade. Trade windows run on the
+    exchange's trade times, so backtests see the same values. Windows are
+    kept to the second, see TimeWindow.
+    """
+    def __init__(self, order_book=None, levels=5, windows=(10, 60, 300), spread_window=60):
+        self.order_book = order_book
+        self.levels = levels
+        self.windows = tuple(windows)
+        # Columns: notional, volume, signed volume
+        self.trade_windows = [TimeWindow(seconds, 3) for seconds in self.windows]
+        self.window_keys = [tuple(name % seconds for name in ('vwap_%d', 'volume_%d', 'trades_%d', 'flow_%d',
+                                                              'flow_ratio_%d'))
+                            for seconds in self.windows]
+        # Columns: spread, spread squared
+        self.spread_window = TimeWindow(spread_window, 2)
+        # (spread, mean, std), replaced as a whole so readers never need a lock
+        self.spread_stats = (NAN, NAN, NAN)
+        self.last_time = None
+        self.sample_on_trade = True
+        if order_book is not None and hasattr(order_book, 'listeners'):
+            order_book.listeners.append(self.on_top_of_book)
+            self.sample_on_trade = False
+
+    def sample_spread(self, now, bid, ask):
+        spread = ask - bid
+        self.spread_window.add(now, (spread, spread * spread))
+        count = len(self.spread_window)
+        total, total_sq = self.spread_window.sums
+        mean = total / count
+        variance = total_sq / count - mean * mean
+        self.spread_stats = (spread, mean, math.sqrt(variance) if variance > 0.0 else 0.0)
+
+    def on_top_of_book(self, bid, ask):
+        # Called from the order book's thread, on its clock
+        self.sample_spread(time.time(), float(bid), float(ask))
+
+    def process_trade(self, msg):
+        now = period.to_epoch(trade.parse_time(msg.get('time')))
+        self.last_time = now
+        price = float(msg.get('price'))
+        size = float(msg.get('size'))
+        # The side of a match is the maker's, a sell maker means a taker buy
+        signed = size if msg.get('side') == 'sell' else -size
+        values = (price * size, size, signed)
+        for window in self.trade_windows:
+            window.add(now, values)
+        if self.sample_on_trade and self.order_book is not None and self.order_book.is_ready():
+            self.sample_spread(now, float(self.order_book.get_bid()), float(self.order_book.get_ask()))
+
+    def process_heartbeat(self, msg):
+        now = period.to_epoch(trade.parse_time(msg.get('time')))
+        self.last_time = now
+        for window in self.trade_windows:
+            window.evict(now)
+
+    def book_features(self):
+        book = getattr(self.order_book, 'book', None)
+        if book is None:
+            return NAN, NAN
+        bids, asks = book.bids, book.asks
+        bid_keys, ask_keys = bids.keys[-self.levels:], asks.keys[-self.levels:]
+        if not bid_keys or not ask_keys:
+            return NAN, NAN
+        # The book is written by its own thread, a level may just have gone
+        bid_sizes = [bids.sizes.get(key, 0) for key in bid_keys]
+        ask_sizes = [asks.sizes.get(key, 0) for key in ask_keys]
+        bid_total, ask_total = sum(bid_sizes), sum(ask_sizes)
+        imbalance = float(bid_total - ask_total) / (bid_total + ask_total) if bid_total + ask_total else NAN
+        best_bid, best_ask = bid_keys[-1] * bids.sign, ask_keys[-1] * asks.sign
+        if bid_sizes[-1] + ask_sizes[-1]:
+            microprice = float(best_bid * ask_sizes[-1] + best_ask * bid_sizes[-1]) / \
+                (bid_sizes[-1] + ask_sizes[-1]) / orderbook.PRICE_SCALE
+        else:
+            microprice = NAN
+        return imbalance, microprice
+
+    def features(self):
+        spread, spread_mean, spread_std = self.spread_stats
+        imbalance, microprice = self.book_features()
+        values = {'time': self.last_time, 'spread': spread, 'spread_mean': spread_mean, 'spread_std': spread_std,
+                  'imbalance': imbalance, 'microprice': microprice}
+        for window, (vwap_key, volume_key, trades_key, flow_key, ratio_key) in zip(self.trade_windows,
+                                                                                  self.window_keys):
+            notional, volume, signed = window.sums
+            values[vwap_key] = notional / volume if volume > 0.0 else NAN
+            values[volume_key] = volume
+            values[trades_key] = window.count
+            values[flow_key] = signed
+            values[ratio_key] = signed / volume if volume > 0.0 else NAN
+        return values
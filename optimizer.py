@@ -0,0 +1,184 @@
+#
+# optimizer.py
+# Mike Cardillo
+#
+# Parameter sweep for the MACD/MFI strategy in TradeEngine.determine_trades()
+# over a historical candle set.
+#
+# Candles are evaluated at their close: a buy signal (histogram rising and MFI
+# below the threshold) goes long, a sell signal (histogram falling and
+# negative) goes flat, and returns are taken close to close.
+#
+# Indicator math is batched across the parameter axis with the functions in
+# vectorized.py. The candles and the EMAs shared by many combinations are
+# written once to .npy files that every worker memory-maps read-only, so
+# nothing large is pickled. Because the EMAs are shared, the fast EMA is
+# seeded from the first candle rather than aligned with the slow one as
+# talib.MACD does; this only differs during the warm-up.
+
+import os
+import sys
+import shutil
+import argparse
+import tempfile
+import itertools
+import multiprocessing
+import numpy as np
+import vectorized
+import tickstore
+
+PARAM_DTYPE = np.dtype([('fastperiod', 'i4'), ('slowperiod', 'i4'), ('signalperiod', 'i4'),
+                        ('mfi_period', 'i4'), ('mfi_buy', 'f8')])
+RESULT_DTYPE = np.dtype(PARAM_DTYPE.descr + [('pnl', 'f8'), ('max_drawdown', 'f8'), ('trades', 'i4')])
+
+LOW, HIGH, CLOSE, VOLUME = 1, 2, 4, 5
+
+# Memory-mapped inputs of a worker process, set up by init_worker()
+shared = {}
+
+
+def parameter_grid(fastperiods, slowperiods, signalperiods, mfi_periods, mfi_buys):
+    grid = np.array([combo for combo in itertools.product(fastperiods, slowperiods, signalperiods,
+                                                          mfi_periods, mfi_buys)
+                     if combo[0] < combo[1]], dtype=PARAM_DTYPE)
+    return grid
+
+
+def sample_grid(grid, samples, seed=None):
+    if samples >= len(grid):
+        return grid
+    rng = np.random.RandomState(seed)
+    return grid[np.sort(rng.choice(len(grid), samples, replace=False))]
+
+
+def positions(buy, sell):
+    # Long from a buy signal until the next sell signal, flat otherwise
+    state = np.where(buy, 1, np.where(sell, 0, -1)).astype('i1')
+    last = np.where(state >= 0, np.arange(state.shape[1]), 0)
+    np.maximum.accumulate(last, axis=1, out=last)
+    held = state[np.arange(state.shape[0])[:, None], last]
+    return np.maximum(held, 0)
+
+
+def evaluate(candles, params, ema, ema_periods, fee_rate=0.0):
+    closes = candles[:, CLOSE]
+    fast = ema[np.searchsorted(ema_periods, params['fastperiod'])]
+    slow = ema[np.searchsorted(ema_periods, params['slowperiod'])]
+    macd = fast - slow
+    macd_sig = vectorized.ema_rows(macd, params['signalperiod'])
+    macd_hist = macd - macd_sig
+    hist_diff = np.full(macd_hist.shape, np.nan)
+    hist_diff[:, 1:] = np.diff(macd_hist, axis=1)
+
+    mfi_periods, mfi_rows = np.unique(params['mfi_period'], return_inverse=True)
+    mfi = vectorized.mfi_rows(candles[:, HIGH], candles[:, LOW], closes, candles[:, VOLUME],
+                              mfi_periods)[mfi_rows]
+
+    with np.errstate(invalid='ignore'):
+        buy = (hist_diff > 0) & (mfi < params['mfi_buy'][:, None])
+        sell = (hist_diff < 0) & (macd_hist < 0)
+    held = positions(buy, sell)
+
+    log_returns = held[:, :-1] * np.log(closes[1:] / closes[:-1])
+    trades = np.count_nonzero(np.diff(held, axis=1), axis=1) + held[:, 0]
+    equity = np.exp(np.cumsum(log_returns, axis=1))
+    drawdown = 1.0 - equity / np.maximum.accumulate(equity, axis=1)
+
+    results = np.zeros(len(params), dtype=RESULT_DTYPE)
+    for name in PARAM_DTYPE.names:
+        results[name] = params[name]
+    results['pnl'] = equity[:, -1] * (1.0 - fee_rate) ** trades - 1.0
+    results['max_drawdown'] = drawdown.max(axis=1)
+    results['trades'] = trades
+    return results
+
+
+def init_worker(path, fee_rate):
+    shared['candles'] = np.load(os.path.join(path, 'candles.npy'), mmap_mode='r')
+    shared['ema'] = np.load(os.path.join(path, 'ema.npy'), mmap_mode='r')
+    shared['ema_periods'] = np.load(os.path.join(path, 'ema_periods.npy'))
+    shared['fee_rate'] = fee_rate
+
+
+def evaluate_chunk(params):
+    return evaluate(shared['candles'], params, shared['ema'], shared['ema_periods'], shared['fee_rate'])
+
+
+def sweep(candles, params, processes=None, chunk_size=16, fee_rate=0.0):
+    """
+    Evaluates every parameter combination over candles (GDAX historic rates
+    layout, oldest first) and returns the results sorted by PnL, none for
+    an empty grid.
+    """
+    if len(params) == 0:
+        return np.zeros(0, dtype=RESULT_DTYPE)
+    candles = np.ascontiguousarray(candles, dtype='f8')
+    path = tempfile.mkdtemp(prefix='gdax-sweep-')
+    try:
+        # EMAs only depend on their period, so compute each one once up front
+        ema_periods = np.unique(np.concatenate((params['fastperiod'], params['slowperiod'])))
+        np.save(os.path.join(path, 'candles.npy'), candles)
+        np.save(os.path.join(path, 'ema.npy'), vectorized.ema_rows(candles[:, CLOSE], ema_periods))
+        np.save(os.path.join(path, 'ema_periods.npy'), ema_periods)
+
+        chunks = [params[idx:idx + chunk_size] for idx in range(0, len(params), chunk_size)]
+        pool = multiprocessing.Pool(processes, initializer=init_worker, initargs=(path, fee_rate))
+        try:
+            results = np.concatenate(pool.map(evaluate_chunk, chunks))
+        finally:
+            pool.close()
+            pool.join()
+    finally:
+        shutil.rmtree(path)
+    return results[np.argsort(-results['pnl'], kind='mergesort')]
+
+
+def print_results(results, limit=20, out=sys.stdout):
+    out.write("%5s %5s %5s %5s %7s %10s %10s %7s\n" %
+              ('fast', 'slow', 'sig', 'mfi_p', 'mfi_buy', 'pnl', 'drawdown', 'trades'))
+    for row in results[:limit]:
+        out.write("%5d %5d %5d %5d %7.1f %9.2f%% %9.2f%% %7d\n" %
+                  (row['fastperiod'], row['slowperiod'], row['signalperiod'], row['mfi_period'],
+                   row['mfi_buy'], row['pnl'] * 100, row['max_drawdown'] * 100, row['trades']))
+
+
+def parse_range(spec, cast=int):
+    # "10" -> [10], "6:14:2" -> [6, 8, 10, 12, 14], "10,12,20" -> [10, 12, 20]
+    if ':' in spec:
+        start, stop, step = [cast(value) for value in (spec.split(':') + ['1'])[:3]]
+        values = []
+        while start <= stop:
+            values.append(start)
+            start += step
+        return values
+    return [cast(value) for value in spec.split(',')]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Sweep MACD/MFI strategy parameters over historical candles")
+    parser.add_argument('candles', help=".npy file of candles (time, low, high, open, close, volume) "
+                                        "or a tick capture directory")
+    parser.add_argument('--period-size', type=int, default=60, help="candle size when resampling ticks")
+    parser.add_argument('--fast', default='6:14:2', help="MACD fast periods")
+    parser.add_argument('--slow', default='20:32:2', help="MACD slow periods")
+    parser.add_argument('--signal', default='5:13:2', help="MACD signal periods")
+    parser.add_argument('--mfi-period', default='10:18:4', help="MFI periods")
+    parser.add_argument('--mfi-buy', default='10:30:5', help="MFI threshold below which to buy")
+    parser.add_argument('--samples', type=int, default=0, help="random sample of this many combinations")
+    parser.add_argument('--seed', type=int, default=None, help="seed for --samples")
+    parser.add_argument('--fee-rate', type=float, default=0.0, help="fee charged on each trade, as a fraction")
+    parser.add_argument('--processes', type=int, default=None, help="worker processes (default: all cores)")
+    parser.add_argument('--top', type=int, default=20, help="rows to print")
+    args = parser.parse_args()
+
+    if os.path.isdir(args.candles):
+        candles = tickstore.TickReader(args.candles).candles(args.period_size)
+    else:
+        candles = np.load(args.candles)
+    grid = parameter_grid(parse_range(args.fast), parse_range(args.slow), parse_range(args.signal),
+                          parse_range(args.mfi_period), parse_range(args.mfi_buy, float))
+    if len(grid) == 0:
+        parser.error("no parameter combinations with a fast period below the slow period")
+    if args.samples:
+        grid = sample_grid(grid, args.samples, args.seed)
+    print_results(sweep(candles, grid, processes=args.processes, fee_rate=args.fee_rate), limit=args.top)
@@ -0,0 +1,175 @@
+#
+# orderbook.py
+# Mike Cardillo
+#
+# Level 3 order book maintained from the GDAX full channel.
+#
+# Prices and sizes are kept as integers (cents and 1e-8 units) parsed
+# straight from the message strings, so no Decimal arithmetic happens per
+# message. Each side is a sorted list of price levels with their aggregated
+# size and order count in dicts, and every order is found through a hash of
+# order ids. Keys are stored so that the best level is always the last
+# element of the list, which makes the best bid/ask O(1) and puts most
+# insertions near the end of the list.
+
+import time
+import bisect
+import numpy as np
+from decimal import Decimal
+
+PRICE_PLACES = 2
+SIZE_PLACES = 8
+PRICE_SCALE = 10 ** PRICE_PLACES
+SIZE_SCALE = 10 ** SIZE_PLACES
+
+
+def parse_fixed(value, places):
+    # '4123.4' -> 412340 for places=2, without going through float or Decimal
+    whole, _, fraction = value.partition('.')
+    return int(whole + (fraction + '0' * places)[:places])
+
+
+def to_price(tick):
+    return Decimal(tick) / PRICE_SCALE
+
+
+class BookSide:
+    """
+    Price levels of one side of the book. Bids are keyed by tick and asks by
+    -tick, so in both cases the best level is the largest key.
+    """
+    def __init__(self, sign):
+        self.sign = sign
+        self.keys = []
+        self.sizes = {}
+        self.counts = {}
+
+    def __len__(self):
+        return len(self.keys)
+
+    def best(self):
+        # Best price in ticks, None for an empty side
+        return self.keys[-1] * self.sign if self.keys else None
+
+    def add(self, tick, size):
+        key = tick * self.sign
+        if key in self.sizes:
+            self.sizes[key] += size
+            self.counts[key] += 1
+        else:
+            bisect.insort(self.keys, key)
+            self.sizes[key] = size
+            self.counts[key] = 1
+
+    def reduce(self, tick, size, remove_order=False):
+        key = tick * self.sign
+        self.sizes[key] -= size
+        if remove_order:
+            self.counts[key] -= 1
+            if self.counts[key] == 0:
+                del self.keys[bisect.bisect_left(self.keys, key)]
+                del self.sizes[key]
+                del self.counts[key]
+
+    def depth(self, levels=10):
+        """
+        Prices and aggregated sizes of the best levels, best first, as float
+        arrays.
+        """
+        keys = self.keys[-levels:][::-1]
+        prices = np.array(keys, dtype='f8') * self.sign / PRICE_SCALE
+        sizes = np.array([self.sizes[key] for key in keys], dtype='f8') / SIZE_SCALE
+        return prices, sizes
+
+
+class OrderBook:
+    """
+    Applies full channel messages in sequence order. process() returns False
+    without changing the book when a message shows that earlier ones are
+    missing; the caller then loads a new snapshot with load_snapshot().
+    """
+    def __init__(self):
+        self.reset()
+        self.gaps = 0
+        self.resyncs = 0
+        self.last_resync_seconds = None
+
+    def reset(self):
+        self.bids = BookSide(1)
+        self.asks = BookSide(-1)
+        # order id -> [side, tick, remaining size]
+        self.orders = {}
+        self.sequence = -1
+
+    def load_snapshot(self, snapshot, started=None):
+        # snapshot as returned by PublicClient.get_product_order_book(level=3);
+        # started is when the resync began, for the timing statistics
+        self.reset()
+        for price, size, order_id in snapshot['bids']:
+            self.add(order_id, self.bids, parse_fixed(price, PRICE_PLACES), parse_fixed(size, SIZE_PLACES))
+        for price, size, order_id in snapshot['asks']:
+            self.add(order_id, self.asks, parse_fixed(price, PRICE_PLACES), parse_fixed(size, SIZE_PLACES))
+        self.sequence = int(snapshot['sequence'])
+        self.resyncs += 1
+        if started is not None:
+            self.last_resync_seconds = time.time() - started
+
+    def add(self, order_id, side, tick, size):
+        self.orders[order_id] = [side, tick, size]
+        side.add(tick, size)
+
+    def remove(self, order_id):
+        order = self.orders.pop(order_id, None)
+        if order is not None:
+            order[0].reduce(order[1], order[2], remove_order=True)
+
+    def process(self, msg):
+        sequence = msg.get('sequence')
+        if sequence is None or sequence <= self.sequence:
+            # Not a book message, or already part of the snapshot
+            return True
+        if sequence > self.sequence + 1:
+            self.gaps += 1
+            return False
+        msg_type = msg.get('type')
+        if msg_type == 'open':
+            self.add(msg['order_id'], self.bids if msg['side'] == 'buy' else self.asks,
+                     parse_fixed(msg['price'], PRICE_PLACES), parse_fixed(msg['remaining_size'], SIZE_PLACES))
+        elif msg_type == 'done':
+            self.remove(msg['order_id'])
+        elif msg_type == 'match':
+            order = self.orders.get(msg['maker_order_id'])
+            if order is not None:
+                size = parse_fixed(msg['size'], SIZE_PLACES)
+                if size >= order[2]:
+                    self.remove(msg['maker_order_id'])
+                else:
+                    order[2] -= size
+                    order[0].reduce(order[1], size)
+        elif msg_type == 'change':
+            order = self.orders.get(msg['order_id'])
+            if order is not None and msg.get('new_size') is not None:
+                new_size = parse_fixed(msg['new_size'], SIZE_PLACES)
+                order[0].reduce(order[1], order[2] - new_size)
+                order[2] = new_size
+        self.sequence = sequence
+        return True
+
+    def best_ticks(self):
+        return self.bids.best(), self.asks.best()
+
+    def get_bid(self):
+        return to_price(self.bids.best())
+
+    def get_ask(self):
+        return to_price(self.asks.best())
+
+    def depth(self, levels=10):
+        """
+        Top levels of both sides as a dict of float arrays: bid_prices,
+        bid_sizes, ask_prices and ask_sizes, best first.
+        """
+        bid_prices, bid_sizes = self.bids.depth(levels)
+        ask_prices, ask_sizes = self.asks.depth(levels)
+        return {'bid_prices': bid_prices, 'bid_sizes': bid_sizes,
+                'ask_prices': ask_prices, 'ask_sizes': ask_sizes}
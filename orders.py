@@ -0,0 +1,233 @@
+#
+# orders.py
+# Mike Cardillo
+#
+# Local order and balance state kept up to date from the authenticated GDAX
+# "user" channel, so TradeEngine does not have to poll REST while working an
+# order. REST is only used to reconcile the local state periodically.
+
+import time
+import hmac
+import json
+import base64
+import hashlib
+import logging
+import threading
+import feed
+from decimal import Decimal
+from websocket import create_connection
+
+RECONCILE_INTERVAL = 60.0
+# REST statuses of an order still on the book or about to be
+LIVE_STATUSES = ('pending', 'open', 'active', 'received')
+
+
+class OrderTracker(feed.ReconnectingWebsocket):
+    """
+    State machine over the user channel events of our own orders:
+    received -> open -> (match)* -> done. Balances are tracked as
+    balance/hold per currency like GDAX accounts, available being the
+    difference. Only limit orders are tracked exactly, anything else is
+    corrected by the next reconcile().
+    """
+    def __init__(self, auth_client, product_id='BTC-USD', url="wss://ws-feed.gdax.com"):
+        self.logger = logging.getLogger('trader-logger')
+        self.auth_client = auth_client
+        self.product_id = product_id
+        self.base_currency, self.quote_currency = product_id.split('-')
+        self.lock = threading.Lock()
+        self.orders = {}
+        self.balances = {}
+        self.holds = {}
+        self.events = 0
+        self.last_reconcile = None
+        # Called with the updated order after each event
+        self.listeners = []
+        super(OrderTracker, self).__init__(url=url, products=[product_id])
+
+    def _connect(self):
+        self.ws = create_connection(self.url.rstrip('/'))
+        self.stop = False
+        auth = self.auth_client.auth
+        timestamp = str(time.time())
+        message = (timestamp + 'GET' + '/users/self/verify').encode('ascii')
+        signature = hmac.new(base64.b64decode(auth.secret_key), message, hashlib.sha256)
+        self.ws.send(json.dumps({'type': 'subscribe', 'product_ids': self.products, 'channels': ['user'],
+                                 'signature': base64.b64encode(signature.digest()).decode('ascii'),
+                                 'key': auth.api_key, 'passphrase': auth.passphrase,
+                                 'timestamp': timestamp}))
+        # Events that arrive meanwhile wait in the socket
+        self.reconcile()
+
+    def on_open(self):
+        self.stop = False
+        self.last_reconcile = None
+        self.logger.debug("-- User Feed Opened ---")
+
+    def on_reconnect(self):
+        # REST is used until _connect() has reconciled again
+        self.last_reconcile = None
+
+    def on_close(self):
+        self.logger.debug("-- User Feed Closed ---")
+
+    def is_ready(self):
+        return not self.stop and self.last_reconcile is not None
+
+    def needs_reconcile(self):
+        return self.last_reconcile is None or time.time() - self.last_reconcile > RECONCILE_INTERVAL
+
+    def reconcile(self, attempts=3):
+        """
+        Replaces balances and open orders with what REST reports. The
+        snapshot is dropped if user channel events arrived while it was being
+        fetched, unless this is the last attempt.
+        """
+        for attempt in range(attempts):
+            seen = self.events
+            accounts = self.auth_client.get_accounts()
+            open_orders = [order for order in self.auth_client.get_orders()[0]
+                           if order.get('product_id', self.product_id) == self.product_id]
+            open_ids = set(order.get('id') for order in open_orders)
+            # Orders we think are open but REST does not list anymore
+            with self.lock:
+                missing = [order_id for order_id, order in self.orders.items()
+                           if order['status'] != 'done' and order_id not in open_ids]
+            gone = dict((order_id, self.auth_client.get_order(order_id)) for order_id in missing)
+            with self.lock:
+                if self.events != seen and attempt + 1 < attempts:
+                    continue
+                for account in accounts:
+                    self.balances[account.get('currency')] = Decimal(account.get('balance'))
+                    self.holds[account.get('currency')] = Decimal(account.get('hold'))
+                for order in open_orders:
+                    self.orders[order.get('id')] = self.from_rest(order, held=True)
+                for order_id, order in gone.items():
+                    if order.get('message') == 'NotFound' or order.get('status') is None:
+                        self.orders[order_id]['status'] = 'done'
+                        self.orders[order_id]['done_reason'] = 'canceled'
+                        self.orders[order_id]['done_at'] = time.time()
+                    else:
+                        self.orders[order_id] = self.from_rest(order)
+                # Keep finished orders around for one interval, TradeEngine
+                # may still ask for the order it was working
+                for order_id, order in list(self.orders.items()):
+                    if order['done_at'] is not None and time.time() - order['done_at'] > RECONCILE_INTERVAL:
+                        del self.orders[order_id]
+                self.last_reconcile = time.time()
+            self.logger.debug("[ORDERS] Reconciled %d open orders", len(open_orders))
+            return
+
+    def from_rest(self, order, held=False):
+        # held tells whether the order's remaining size is part of self.holds.
+        # Any other status than a live one is final, e.g. a rejected post only
+        # order never gets user channel events.
+        status = order.get('status')
+        if status in LIVE_STATUSES:
+            done_reason, done_at = order.get('done_reason'), None
+        else:
+            done_reason, done_at = order.get('done_reason') or status, time.time()
+            status = 'done'
+        return {'id': order.get('id'), 'side': order.get('side'), 'price': order.get('price'),
+                'size': Decimal(order.get('size', '0')), 'filled_size': Decimal(order.get('filled_size', '0')),
+                'status': status, 'done_reason': done_reason, 'done_at': done_at, 'held': held}
+
+    def track(self, ret):
+        # Order as returned by a REST buy/sell, before its received event
+        if ret.get('id') is None:
+            return
+        with self.lock:
+            if ret.get('id') not in self.orders:
+                self.orders[ret.get('id')] = self.from_rest(ret)
+
+    def get_order(self, order_id):
+        # Same shape as AuthenticatedClient.get_order(): cancelled and rejected orders are NotFound
+        with self.lock:
+            order = self.orders.get(order_id)
+            if order is None or (order['status'] == 'done' and order['done_reason'] in ('canceled', 'rejected')):
+                return {'message': 'NotFound'}
+            return dict(order)
+
+    def get_open_orders(self):
+        with self.lock:
+            return [dict(order) for order in self.orders.values() if order['status'] != 'done']
+
+    def get_available(self, currency):
+        with self.lock:
+            return self.balances.get(currency, Decimal('0')) - self.holds.get(currency, Decimal('0'))
+
+    def hold(self, order, size, sign):
+        # Limit buys hold quote currency at the order price, sells hold size
+        if order['side'] == 'buy':
+            self.holds[self.quote_currency] = self.holds.get(self.quote_currency, Decimal('0')) + \
+                sign * size * Decimal(order['price'])
+        else:
+            self.holds[self.base_currency] = self.holds.get(self.base_currency, Decimal('0')) + sign * size
+
+    def on_message(self, msg):
+        msg_type = msg.get('type')
+        if msg_type not in ('received', 'open', 'match', 'done', 'change') or \
+           msg.get('product_id', self.product_id) != self.product_id:
+            return
+        with self.lock:
+            self.events += 1
+            order = getattr(self, 'process_' + msg_type)(msg)
+        if order is not None:
+            for listener in self.listeners:
+                listener(order)
+
+    def process_received(self, msg):
+        if msg.get('order_type', 'limit') != 'limit':
+            return None
+        order = self.orders.get(msg.get('order_id'))
+        if order is None:
+            order = self.orders[msg.get('order_id')] = {'id': msg.get('order_id'), 'side': msg.get('side'),
+                                                        'price': msg.get('price'), 'filled_size': Decimal('0'),
+                                                        'status': None, 'done_reason': None, 'done_at': None,
+                                                        'held': False}
+        order['size'] = Decimal(msg.get('size'))
+        if not order['held']:
+            self.hold(order, order['size'] - order['filled_size'], 1)
+            order['held'] = True
+        order['status'] = 'received'
+        return order
+
+    def process_open(self, msg):
+        order = self.orders.get(msg.get('order_id'))
+        if order is not None and order['status'] != 'done':
+            order['status'] = 'open'
+        return order
+
+    def process_change(self, msg):
+        order = self.orders.get(msg.get('order_id'))
+        if order is not None and msg.get('new_size') is not None and order['status'] != 'done':
+            if order['held']:
+                self.hold(order, Decimal(msg.get('new_size')) - Decimal(msg.get('old_size')), 1)
+            order['size'] += Decimal(msg.get('new_size')) - Decimal(msg.get('old_size'))
+        return order
+
+    def process_match(self, msg):
+        order = self.orders.get(msg.get('maker_order_id')) or self.orders.get(msg.get('taker_order_id'))
+        if order is None:
+            return None
+        size = Decimal(msg.get('size'))
+        value = size * Decimal(msg.get('price'))
+        order['filled_size'] += size
+        if order['held']:
+            self.hold(order, size, -1)
+        sign = 1 if order['side'] == 'buy' else -1
+        self.balances[self.base_currency] = self.balances.get(self.base_currency, Decimal('0')) + sign * size
+        self.balances[self.quote_currency] = self.balances.get(self.quote_currency, Decimal('0')) - sign * value
+        return order
+
+    def process_done(self, msg):
+        order = self.orders.get(msg.get('order_id'))
+        if order is None or order['status'] == 'done':
+            return None
+        if order['held']:
+            self.hold(order, order['size'] - order['filled_size'], -1)
+            order['held'] = False
+        order['status'] = 'done'
+        order['done_reason'] = msg.get('reason')
+        order['done_at'] = time.time()
+        return order
@@ -6,13 +6,26 @@
 
 import numpy as np
 import gdax
+import time
 import datetime
-import dateutil.parser
 import trade
 import pytz
-import requests
+import rest
 import logging
 
+EPOCH = datetime.datetime(1970, 1, 1, tzinfo=pytz.utc)
+API_URL = 'https://api.gdax.com'
+# Candles per historic rates request
+HISTORIC_RATES_PAGE = 200
+
+
+def to_epoch(isotime):
+    return (isotime - EPOCH).total_seconds()
+
+
+def from_epoch(timestamp):
+    return datetime.datetime.fromtimestamp(timestamp, pytz.utc)
+
 
 class Candlestick:
     def __init__(self, isotime=None, existing_candlestick=None):
@@ -26,6 +39,7 @@ class Candlestick:
             self.volume = 0
         elif existing_candlestick is not None:
             self.time, self.low, self.high, self.open, self.close, self.volume = existing_candlestick
+            self.time = from_epoch(self.time)
 
     def add_trade(self, new_trade):
         if not self.open:
@@ -43,8 +57,8 @@ class Candlestick:
 
         self.close = new_trade.price
         self.volume = self.volume + new_trade.volume
-        self.logger.debug("[TRADE] Time: %s Price: %f Vol: %f" %
-                          (new_trade.time, new_trade.price, new_trade.volume))
+        self.logger.debug("[TRADE] Time: %s Price: %f Vol: %f",
+                          new_trade.time, new_trade.price, new_trade.volume)
 
     def close_candlestick(self, period_name, prev_stick=None):
         self.logger.debug("Candlestick Closed!")
@@ -54,57 +68,201 @@ class Candlestick:
             self.low = prev_stick[4]
             self.close = prev_stick[4]
         self.print_stick(period_name)
-        return np.array([self.time, self.low, self.high, self.open,
-                        self.close, self.volume])
+        return np.array([to_epoch(self.time), self.low, self.high, self.open,
+                        self.close, self.volume], dtype='f8')
 
     def print_stick(self, period_name):
-        self.logger.debug("[CANDLESTICK %s] Time: %s Open: %s High: %s Low: %s Close: %s Vol: %s" %
-                          (period_name, self.time, self.open, self.high, self.low,
-                           self.close, self.volume))
+        self.logger.debug("[CANDLESTICK %s] Time: %s Open: %s High: %s Low: %s Close: %s Vol: %s",
+                          period_name, self.time, self.open, self.high, self.low,
+                          self.close, self.volume)
+
+
+class CandlestickBuffer:
+    """
+    Fixed-capacity, column-oriented store of closed candlesticks.
+
+    Columns follow the GDAX historic rates layout (time, low, high, open,
+    close, volume), with time stored as epoch seconds. Every row is written
+    to both slot and slot + capacity, so the most recent rows are always a
+    single contiguous slice of each column and can be handed out as views.
+    """
+    TIME, LOW, HIGH, OPEN, CLOSE, VOLUME = range(6)
+
+    def __init__(self, capacity=10000, data=None):
+        self.capacity = capacity
+        # data may be given to keep the rows elsewhere, e.g. in shared memory
+        self.data = data if data is not None else np.zeros((6, 2 * capacity), dtype='f8')
+        self.next_slot = 0
+        self.count = 0
+        self.total = 0
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, idx):
+        start = self.next_slot + self.capacity - self.count
+        rows = self.data[:, start:self.next_slot + self.capacity]
+        if isinstance(idx, slice):
+            return rows[:, idx].T
+        return rows[:, idx].copy()
+
+    def column(self, col):
+        # Views are only valid until the next append
+        end = self.next_slot + self.capacity
+        return self.data[col, end - self.count:end]
+
+    def append(self, row):
+        slot = self.next_slot
+        self.data[:, slot] = row
+        self.data[:, slot + self.capacity] = row
+        self.next_slot = (slot + 1) % self.capacity
+        self.count = min(self.count + 1, self.capacity)
+        self.total += 1
+
+    def extend(self, rows):
+        rows = np.asarray(rows, dtype='f8')[-self.capacity:]
+        slots = (self.next_slot + np.arange(len(rows))) % self.capacity
+        self.data[:, slots] = rows.T
+        self.data[:, slots + self.capacity] = rows.T
+        self.next_slot = (self.next_slot + len(rows)) % self.capacity
+        self.count = min(self.count + len(rows), self.capacity)
+        self.total += len(rows)
+
+    def amend_last(self, row):
+        slot = (self.next_slot - 1) % self.capacity
+        self.data[:, slot] = row
+        self.data[:, slot + self.capacity] = row
+
+
+def resample_candlesticks(candles, period_size):
+    """
+    Groups candlesticks (GDAX historic rates layout, oldest first) into
+    period_size buckets with vectorized NumPy reductions.
+    """
+    candles = np.asarray(candles, dtype='f8')
+    if len(candles) == 0:
+        return np.zeros((0, 6))
+    buckets = candles[:, 0] - candles[:, 0] % period_size
+    if np.any(buckets[1:] < buckets[:-1]):
+        order = np.argsort(buckets, kind='mergesort')
+        candles, buckets = candles[order], buckets[order]
+    starts = np.concatenate(([0], np.flatnonzero(np.diff(buckets)) + 1))
+    ends = np.append(starts[1:], len(buckets))
+    return np.column_stack((buckets[starts],
+                            np.minimum.reduceat(candles[:, 1], starts),
+                            np.maximum.reduceat(candles[:, 2], starts),
+                            candles[starts, 3],
+                            candles[ends - 1, 4],
+                            np.add.reduceat(candles[:, 5], starts)))
 
 
 class Period:
-    def __init__(self, period_size=60, name='Period', initialize=True):
+    def __init__(self, period_size=60, name='Period', product_id='BTC-USD', initialize=True,
+                 max_candlesticks=10000, api_url=API_URL, store=None):
         self.period_size = period_size
         self.name = name
+        self.product_id = product_id
+        self.api_url = api_url
+        # Optional candlestore.CandleStore closed candlesticks are checkpointed to
+        self.store = store
         self.first_trade = True
         self.verbose_heartbeat = False
+        self.max_candlesticks = max_candlesticks
+        # Called with (row, amended) whenever a candlestick is closed or amended
+        self.listeners = []
         self.logger = logging.getLogger('trader-logger')
+        if store is not None:
+            self.listeners.append(self.checkpoint)
         if initialize:
             self.initialize()
         else:
-            self.candlesticks = np.array([])
+            self.candlesticks = CandlestickBuffer(self.max_candlesticks)
+            self.cur_candlestick = None
 
-    def initialize(self):
-        self.candlesticks = self.get_historical_data()
-        self.cur_candlestick = Candlestick(existing_candlestick=self.candlesticks[-1])
-        self.candlesticks = self.candlesticks[:-1]
+    def initialize(self, hist_data=None):
+        # hist_data is the result of get_history() when it was fetched beforehand
+        if hist_data is None:
+            hist_data = self.get_history()
+        self.candlesticks = CandlestickBuffer(self.max_candlesticks)
+        self.candlesticks.extend(hist_data[:-1])
+        self.cur_candlestick = Candlestick(existing_candlestick=hist_data[-1])
         self.cur_candlestick_start = self.cur_candlestick.time
 
-    def get_historical_data(self):
-        gdax_client = gdax.PublicClient()
-        hist_data = np.array(gdax_client.get_product_historic_rates('BTC-USD', granularity=self.period_size), dtype='object')
-        for row in hist_data:
-            row[0] = datetime.datetime.fromtimestamp(row[0], pytz.utc)
-        return np.flipud(hist_data)
+    def get_history(self):
+        """
+        Closed candlesticks from the store followed by what REST has for the
+        time since the last stored one, the final row being the open
+        candlestick. Newly fetched closed candlesticks are stored.
+        """
+        if self.store is None:
+            return self.get_historical_data()
+        stored = self.store.load(self.product_id, self.period_size, self.max_candlesticks)
+        if len(stored) == 0:
+            hist_data = self.get_historical_data()
+        else:
+            start = stored[-1, 0] + self.period_size
+            hist_data = self.get_historical_data(start=start)
+            hist_data = hist_data[hist_data[:, 0] >= start]
+        self.store.append(self.product_id, self.period_size, hist_data[:-1])
+        self.logger.debug("[PERIOD %s] Loaded %d stored and %d REST candlesticks",
+                          self.name, len(stored), len(hist_data))
+        return np.concatenate((stored, hist_data)) if len(hist_data) else stored
+
+    def get_historical_data(self, start=None):
+        # The latest page of candlesticks, or every page from start until now
+        gdax_client = gdax.PublicClient(self.api_url)
+        if start is None:
+            rest.public_limiter.acquire()
+            hist_data = np.array(gdax_client.get_product_historic_rates(self.product_id,
+                                                                        granularity=self.period_size),
+                                 dtype='f8')
+            return np.flipud(hist_data)
+        now = time.time()
+        start = max(start, now - self.max_candlesticks * self.period_size)
+        pages = []
+        while start <= now:
+            end = min(start + (HISTORIC_RATES_PAGE - 1) * self.period_size, now)
+            rest.public_limiter.acquire()
+            page = gdax_client.get_product_historic_rates(self.product_id, start=from_epoch(start).isoformat(),
+                                                          end=from_epoch(end).isoformat(),
+                                                          granularity=self.period_size)
+            pages.append(np.array(page, dtype='f8').reshape(-1, 6))
+            start = end + self.period_size
+        if not pages:
+            # start is not in the past
+            return np.zeros((0, 6))
+        hist_data = np.concatenate(pages)
+        # Pages come newest first and may overlap at their edges
+        times, first = np.unique(hist_data[:, 0], return_index=True)
+        return hist_data[first]
+
+    def checkpoint(self, row, amended=False):
+        self.store.checkpoint(self.product_id, self.period_size, row, amended)
+
+    def notify(self, row, amended=False):
+        for listener in self.listeners:
+            listener(row, amended)
 
     def process_heartbeat(self, msg):
-        isotime = dateutil.parser.parse(msg.get('time'))
-        if isotime:
+        isotime = trade.parse_time(msg.get('time'))
+        if isotime and self.cur_candlestick is not None:
             if self.verbose_heartbeat:
-                self.logger.debug("[HEARTBEAT] " + str(isotime) + " " + str(msg.get('last_trade_id')))
+                self.logger.debug("[HEARTBEAT] %s %s", isotime, msg.get('last_trade_id'))
             if isotime - self.cur_candlestick_start > datetime.timedelta(seconds=self.period_size):
                 self.close_candlestick()
                 self.new_candlestick(isotime)
 
     def process_trade(self, msg):
         cur_trade = trade.Trade(msg)
-        isotime = dateutil.parser.parse(msg.get('time')).replace(microsecond=0)
+        isotime = cur_trade.time.replace(microsecond=0)
+        if self.cur_candlestick is None:
+            self.new_candlestick(isotime)
         if isotime < self.cur_candlestick.time:
             prev_stick = Candlestick(existing_candlestick=self.candlesticks[-1])
-            self.candlesticks = self.candlesticks[:-1]
             prev_stick.add_trade(cur_trade)
-            self.add_stick(prev_stick)
+            row = prev_stick.close_candlestick(self.name)
+            self.candlesticks.amend_last(row)
+            self.notify(row, amended=True)
         else:
             if isotime > self.cur_candlestick.time + datetime.timedelta(seconds=self.period_size):
                 self.close_candlestick()
@@ -113,28 +271,134 @@ class Period:
             self.cur_candlestick.print_stick(self.name)
 
     def get_highs(self):
-        return np.array(self.candlesticks[:, 2], dtype='f8')
+        return self.candlesticks.column(CandlestickBuffer.HIGH)
 
     def get_lows(self):
-        return np.array(self.candlesticks[:, 1], dtype='f8')
+        return self.candlesticks.column(CandlestickBuffer.LOW)
 
     def get_closing_prices(self):
-        return np.array(self.candlesticks[:, 4], dtype='f8')
+        return self.candlesticks.column(CandlestickBuffer.CLOSE)
 
     def get_volumes(self):
-        return np.array(self.candlesticks[:, 5], dtype='f8')
+        return self.candlesticks.column(CandlestickBuffer.VOLUME)
 
     def new_candlestick(self, isotime):
         self.cur_candlestick = Candlestick(isotime=isotime)
         self.cur_candlestick_start = isotime.replace(second=0, microsecond=0)
 
     def add_stick(self, stick_to_add):
-        self.candlesticks = np.row_stack((self.candlesticks, stick_to_add.close_candlestick(self.name)))
+        row = stick_to_add.close_candlestick(self.name)
+        self.candlesticks.append(row)
+        self.notify(row)
 
     def close_candlestick(self):
         if len(self.candlesticks) > 0:
-            self.candlesticks = np.row_stack((self.candlesticks,
-                                              self.cur_candlestick.close_candlestick(period_name=self.name,
-                                                                                     prev_stick=self.candlesticks[-1])))
+            row = self.cur_candlestick.close_candlestick(period_name=self.name,
+                                                         prev_stick=self.candlesticks[-1])
         else:
-            self.candlesticks = np.array([self.cur_candlestick.close_candlestick(self.name)])
+            row = self.cur_candlestick.close_candlestick(self.name)
+        self.candlesticks.append(row)
+        self.notify(row)
+
+
+class AggregatePeriod(Period):
+    """
+    Higher timeframe built from the closed candlesticks of a base Period
+    rather than from individual trades. The open candlestick combines the
+    base candlesticks already closed in the current bucket (self.partial)
+    with the base period's open candlestick, see refresh().
+    """
+    def __init__(self, base_period, period_size, name='Period', initialize=True, max_candlesticks=10000):
+        self.base_period = base_period
+        self.partial = None
+        Period.__init__(self, period_size=period_size, name=name, product_id=base_period.product_id,
+                        initialize=initialize, max_candlesticks=max_candlesticks, api_url=base_period.api_url,
+                        store=base_period.store)
+        if not initialize:
+            self.initialize_from_base()
+        base_period.listeners.append(self.add_candlestick)
+
+    def bucket(self, timestamp):
+        return timestamp - timestamp % self.period_size
+
+    def bucket_rows(self, start):
+        # Closed base candlesticks falling in the bucket starting at start
+        rows = self.base_period.candlesticks[-(self.period_size // self.base_period.period_size + 1):]
+        return rows[(rows[:, 0] >= start) & (rows[:, 0] < start + self.period_size)]
+
+    def initialize(self, hist_data=None):
+        # Closed history comes from REST at our own granularity, the open
+        # bucket is rebuilt from the base period's candlesticks
+        if hist_data is None:
+            hist_data = self.get_history()
+        start = self.bucket(to_epoch(self.base_period.cur_candlestick.time))
+        self.candlesticks = CandlestickBuffer(self.max_candlesticks)
+        self.candlesticks.extend(hist_data[hist_data[:, 0] < start])
+        self.set_partial(start)
+        self.refresh()
+
+    def initialize_from_base(self):
+        candles = resample_candlesticks(self.base_period.candlesticks[:], self.period_size)
+        if self.base_period.cur_candlestick is not None and len(candles) > 0:
+            if candles[-1, 0] == self.bucket(to_epoch(self.base_period.cur_candlestick.time)):
+                candles = candles[:-1]
+        self.candlesticks.extend(candles)
+        if self.base_period.cur_candlestick is not None:
+            self.set_partial(self.bucket(to_epoch(self.base_period.cur_candlestick.time)))
+            self.refresh()
+
+    def set_partial(self, start):
+        rows = self.bucket_rows(start)
+        self.partial = resample_candlesticks(rows, self.period_size)[0] if len(rows) else None
+
+    def add_candlestick(self, row, amended=False):
+        start = self.bucket(row[0])
+        if amended:
+            if self.partial is not None and start == self.partial[0]:
+                self.set_partial(start)
+            elif len(self.candlesticks) > 0 and start == self.candlesticks[-1][0]:
+                self.candlesticks.amend_last(resample_candlesticks(self.bucket_rows(start), self.period_size)[0])
+                self.notify(self.candlesticks[-1], amended=True)
+            return
+        if self.partial is not None and self.partial[0] < start:
+            self.close_partial()
+        if self.partial is None:
+            self.partial = np.array(row, dtype='f8')
+            self.partial[0] = start
+        else:
+            self.partial[1] = min(self.partial[1], row[1])
+            self.partial[2] = max(self.partial[2], row[2])
+            self.partial[4] = row[4]
+            self.partial[5] += row[5]
+        # Close as soon as the last base candlestick of the bucket closes
+        if row[0] + self.base_period.period_size >= start + self.period_size:
+            self.close_partial()
+
+    def close_partial(self):
+        self.candlesticks.append(self.partial)
+        self.notify(self.candlesticks[-1])
+        self.partial = None
+
+    def refresh(self):
+        base_stick = self.base_period.cur_candlestick
+        if base_stick is None:
+            return
+        start = self.bucket(to_epoch(base_stick.time))
+        partial = self.partial if self.partial is not None and self.partial[0] == start else None
+        if base_stick.close is None:
+            if partial is None:
+                return
+            row = partial
+        elif partial is None:
+            row = [start, base_stick.low, base_stick.high, base_stick.open, base_stick.close, base_stick.volume]
+        else:
+            row = [start, min(partial[1], base_stick.low), max(partial[2], base_stick.high), partial[3],
+                   base_stick.close, partial[5] + base_stick.volume]
+        self.cur_candlestick = Candlestick(existing_candlestick=row)
+        self.cur_candlestick_start = self.cur_candlestick.time
+
+    def process_heartbeat(self, msg):
+        pass
+
+    def process_trade(self, msg):
+        pass
@@ -0,0 +1,240 @@
+#
+# rest.py
+# Mike Cardillo
+#
+# Shared access to the GDAX REST API: pooled keep-alive sessions, token
+# bucket rate limiting at the exchange limits, and a caching client for the
+# authenticated reads TradeEngine and the interface make over and over.
+
+import json
+import time
+import logging
+import threading
+import requests
+import metrics
+
+# GDAX allows 3 requests per second on public and 5 on private endpoints,
+# with bursts of twice that
+PUBLIC_RATE = 3.0
+PRIVATE_RATE = 5.0
+# Seconds a cached read stays fresh
+DEFAULT_TTLS = {'get_accounts': 1.0, 'get_orders': 1.0, 'get_fills': 5.0}
+
+
+class TokenBucket:
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = float(burst if burst is not None else 2 * rate)
+        self.tokens = self.burst
+        self.updated = time.time()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        # Blocks until a request may be sent
+        with self.lock:
+            now = time.time()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait > 0:
+            time.sleep(wait)
+
+
+def pooled_session(pool_size=4):
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+public_limiter = TokenBucket(PUBLIC_RATE)
+public_session = pooled_session()
+
+
+def public_get(url, params=None, endpoint=None, timeout=10):
+    """
+    GET a public endpoint through the shared session and rate limit,
+    returning the decoded JSON.
+    """
+    public_limiter.acquire()
+    started = metrics.clock()
+    try:
+        return public_session.get(url, params=params, timeout=timeout).json()
+    finally:
+        metrics.rest_seconds.observe_since(started, endpoint or url)
+
+
+class CachedClient:
+    """
+    Wraps a gdax.AuthenticatedClient. The endpoints the bot uses go through
+    one keep-alive session and the private rate limit. get_accounts,
+    get_orders and get_fills results are cached for their TTL, and
+    concurrent identical reads share a single request. Orders placed or
+    canceled invalidate the cache. peek() returns cached results for
+    display without waiting on the network.
+
+    Any other method is passed to the wrapped client, rate limited.
+    """
+    def __init__(self, auth_client, ttls=None, rate=PRIVATE_RATE, timeout=10):
+        self.logger = logging.getLogger('trader-logger')
+        self.client = auth_client
+        self.url = auth_client.url.rstrip('/')
+        self.auth = auth_client.auth
+        self.ttls = dict(DEFAULT_TTLS)
+        if ttls:
+            self.ttls.update(ttls)
+        self.limiter = TokenBucket(rate)
+        self.session = pooled_session()
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        # key -> (time fetched, result)
+        self.cache = {}
+        # Bumped by invalidate(), so reads that started before an order was
+        # placed or canceled are not cached
+        self.generation = 0
+        # key -> [Event, result, exception] of the request in flight
+        self.in_flight = {}
+        self.requests = 0
+
+    def __getattr__(self, name):
+        attribute = getattr(self.client, name)
+        if not callable(attribute):
+            return attribute
+
+        def limited(*args, **kwargs):
+            self.limiter.acquire()
+            return attribute(*args, **kwargs)
+        return limited
+
+    def request(self, method, path, endpoint, params=None, data=None):
+        self.limiter.acquire()
+        started = metrics.clock()
+        self.requests += 1
+        try:
+            return self.session.request(method, self.url + path, params=params,
+                                        data=json.dumps(data) if data is not None else None,
+                                        auth=self.auth, timeout=self.timeout)
+        finally:
+            metrics.rest_seconds.observe_since(started, endpoint)
+
+    def cached(self, key, fetch):
+        # Fresh cached result, the result of an identical request in flight,
+        # or a new request
+        ttl = self.ttls.get(key[0], 0)
+        with self.lock:
+            entry = self.cache.get(key)
+            if entry is not None and time.time() - entry[0] < ttl:
+                return entry[1]
+            waiting = self.in_flight.get(key)
+            if waiting is None:
+                waiting = self.in_flight[key] = [threading.Event(), None, None]
+                owner = True
+            else:
+                owner = False
+        if not owner:
+            waiting[0].wait()
+            if waiting[2] is not None:
+                raise waiting[2]
+            return waiting[1]
+        try:
+            fetched = time.time()
+            generation = self.generation
+            waiting[1] = fetch()
+            with self.lock:
+                if generation == self.generation:
+                    self.cache[key] = (fetched, waiting[1])
+            return waiting[1]
+        except Exception as e:
+            waiting[2] = e
+            raise
+        finally:
+            with self.lock:
+                del self.in_flight[key]
+            waiting[0].set()
+
+    def peek(self, name, *args, **kwargs):
+        """
+        Last cached result of a read, however old, or None. A stale or
+        missing entry is refreshed in the background.
+        """
+        key = (name, args, tuple(sorted(kwargs.items())))
+        with self.lock:
+            entry = self.cache.get(key)
+            stale = entry is None or time.time() - entry[0] >= self.ttls.get(name, 0)
+            refresh = stale and key not in self.in_flight
+        if refresh:
+            thread = threading.Thread(target=self.refresh, args=(name, args, kwargs), name='rest_refresh')
+            thread.daemon = True
+            thread.start()
+        return entry[1] if entry is not None else None
+
+    def refresh(self, name, args, kwargs):
+        try:
+            getattr(self, name)(*args, **kwargs)
+        except Exception:
+            self.logger.debug("[REST] Refreshing %s failed", name, exc_info=True)
+
+    def invalidate(self):
+        with self.lock:
+            self.generation += 1
+            self.cache.clear()
+
+    def paginate(self, path, endpoint, params=None):
+        # Pages as returned by gdax-python: a list of the JSON of each page
+        params = dict(params or {})
+        pages = []
+        while True:
+            response = self.request('GET', path, endpoint, params=params)
+            page = response.json()
+            if page or not pages:
+                pages.append(page)
+            if 'cb-after' not in response.headers or not page or params.get('limit'):
+                return pages
+            params['after'] = response.headers['cb-after']
+
+    def get_accounts(self):
+        return self.cached(('get_accounts', (), ()),
+                           lambda: self.request('GET', '/accounts', 'get_accounts').json())
+
+    def get_orders(self):
+        return self.cached(('get_orders', (), ()), lambda: self.paginate('/orders', 'get_orders'))
+
+    def get_fills(self, limit=None, **kwargs):
+        params = dict((key, value) for key, value in kwargs.items() if value)
+        if limit:
+            params['limit'] = limit
+        # The same key peek('get_fills', limit=...) looks up
+        return self.cached(('get_fills', (), tuple(sorted(params.items()))),
+                           lambda: self.paginate('/fills', 'get_fills', params))
+
+    def get_order(self, order_id):
+        # Order status is never served from the cache
+        return self.request('GET', '/orders/' + order_id, 'get_order').json()
+
+    def place_order(self, side, **kwargs):
+        kwargs['side'] = side
+        try:
+            return self.request('POST', '/orders', 'place_order', data=kwargs).json()
+        finally:
+            self.invalidate()
+
+    def buy(self, **kwargs):
+        return self.place_order('buy', **kwargs)
+
+    def sell(self, **kwargs):
+        return self.place_order('sell', **kwargs)
+
+    def cancel_order(self, order_id):
+        try:
+            return self.request('DELETE', '/orders/' + order_id, 'cancel_order').json()
+        finally:
+            self.invalidate()
+
+    def cancel_all(self, product_id=None):
+        try:
+            return self.request('DELETE', '/orders', 'cancel_all',
+                                params={'product_id': product_id} if product_id else None).json()
+        finally:
+            self.invalidate()
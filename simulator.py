@@ -0,0 +1,1284 @@
+#
+# simulator.py
+# Mike Cardillo
+#
+# Local stand-in for the GDAX REST API and websocket feed, to load test the
+# unmodified bot: point API_URL and WEBSOCKET_URL in config.py at it, with
+# the simulator's KEY, SECRET and PASSPHRASE.
+#
+# Seeded synthetic order flow is matched in a price-time priority matching
+# engine per product, on a market clock that runs `speed` times faster than
+# the wall clock. The bot's orders go through the same matching engine, so
+# its fills, and what it receives on the full, matches, level2, heartbeat
+# and user channels, follow from the book like on GDAX. REST latency,
+# errors, order rejects and websocket disconnects can be injected.
+#
+# The exchange measures how long the bot takes to reprice: the time from
+# publishing the top of book an order was priced from to that order
+# arriving. Statistics are logged and served as JSON on /simulator/stats.
+#
+#   python simulator.py --port 8000 --speed 10 --seed 1 --latency 50
+
+import json
+import math
+import time
+import uuid
+import hmac
+import Queue
+import base64
+import bisect
+import random
+import socket
+import struct
+import hashlib
+import logging
+import argparse
+import calendar
+import datetime
+import threading
+import collections
+import trade
+import orderbook
+from decimal import Decimal
+try:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlparse, parse_qs
+except ImportError:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlparse, parse_qs
+
+PRICE_PLACES = orderbook.PRICE_PLACES
+SIZE_PLACES = orderbook.SIZE_PLACES
+VALUE_SCALE = orderbook.PRICE_SCALE * orderbook.SIZE_SCALE
+# Share of synthetic events that are market orders and cancels, the rest
+# are limit orders. Some limit orders improve on the best price instead of
+# being placed around the fair price, which keeps the spread at a tick or
+# two most of the time.
+MARKET_SHARE = 0.05
+CANCEL_SHARE = 0.3
+IMPROVE_SHARE = 0.3
+# Trades kept for /products/<product>/trades, and candlesticks made up
+# before the market clock started (a year of minutes)
+TRADE_HISTORY = 10000
+MAX_HISTORY = 525600
+GRANULARITIES = (60, 300, 900, 3600, 21600, 86400)
+# Payloads a websocket client may fall behind before it is disconnected
+MAX_PENDING = 100000
+# Reprice latencies kept for the percentiles
+LATENCY_SAMPLES = 10000
+WEBSOCKET_GUID = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+OPCODE_TEXT = 0x1
+OPCODE_CLOSE = 0x8
+OPCODE_PING = 0x9
+OPCODE_PONG = 0xa
+CHANNELS = ('full', 'matches', 'level2', 'heartbeat', 'user')
+# Channels each message type is published on
+MESSAGE_CHANNELS = {'received': ('full',), 'open': ('full',), 'done': ('full',), 'change': ('full',),
+                    'match': ('full', 'matches'), 'l2update': ('level2',), 'heartbeat': ('heartbeat',)}
+
+
+def format_fixed(value, places):
+    # 412340 -> '4123.40' for places=2, the inverse of orderbook.parse_fixed()
+    whole, fraction = divmod(abs(value), 10 ** places)
+    return '%s%d.%0*d' % ('-' if value < 0 else '', whole, places, fraction)
+
+
+def format_price(tick):
+    return format_fixed(tick, PRICE_PLACES)
+
+
+def format_size(units):
+    return format_fixed(units, SIZE_PLACES)
+
+
+def format_amount(amount):
+    # Decimals never in exponent notation, GDAX sends 0.0000000000 for zero
+    return format(amount, 'f')
+
+
+def format_value(value):
+    # A price * size product of ticks and units, in quote currency
+    return format_amount(Decimal(value) / VALUE_SCALE)
+
+
+def format_time(timestamp):
+    return datetime.datetime.utcfromtimestamp(timestamp).strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+
+
+def parse_epoch(value):
+    # Epoch seconds or an ISO 8601 time, taken as UTC unless it has a zone
+    try:
+        return float(value)
+    except ValueError:
+        date = trade.parse_time(value)
+        return calendar.timegm(date.utctimetuple()) + date.microsecond / 1e6
+
+
+def sign(secret, timestamp, method, path, body=''):
+    # CB-ACCESS-SIGN of a request, as gdax.AuthenticatedClient computes it
+    message = (timestamp + method + path + body).encode('ascii')
+    return base64.b64encode(hmac.new(base64.b64decode(secret), message, hashlib.sha256).digest()).decode('ascii')
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+class PriceLevels:
+    """
+    One side of a matching engine's book: a FIFO queue of resting orders per
+    price level. Like orderbook.BookSide, bids are keyed by tick and asks by
+    -tick so the best level is always the last key. Ticks of the levels that
+    changed are collected in `changed` for the level2 channel.
+    """
+    def __init__(self, sign):
+        self.sign = sign
+        self.keys = []
+        self.queues = {}
+        self.sizes = {}
+        self.changed = set()
+
+    def best(self):
+        return self.keys[-1] * self.sign if self.keys else None
+
+    def first(self):
+        # Oldest order at the best level
+        return self.queues[self.keys[-1]][0]
+
+    def add(self, order):
+        key = order['tick'] * self.sign
+        if key not in self.queues:
+            bisect.insort(self.keys, key)
+            self.queues[key] = collections.deque()
+            self.sizes[key] = 0
+        self.queues[key].append(order)
+        self.sizes[key] += order['remaining']
+        self.changed.add(order['tick'])
+
+    def reduce(self, order, size):
+        self.sizes[order['tick'] * self.sign] -= size
+        self.changed.add(order['tick'])
+
+    def remove(self, order):
+        key = order['tick'] * self.sign
+        queue = self.queues[key]
+        if queue[0] is order:
+            queue.popleft()
+        else:
+            del queue[[idx for idx, resting in enumerate(queue) if resting is order][0]]
+        self.sizes[key] -= order['remaining']
+        self.changed.add(order['tick'])
+        if not queue:
+            del self.keys[bisect.bisect_left(self.keys, key)]
+            del self.queues[key]
+            del self.sizes[key]
+
+    def levels(self, limit=None):
+        # (tick, size, orders) of the best levels, best first
+        keys = self.keys[::-1] if limit is None else self.keys[:-limit - 1:-1]
+        return [(key * self.sign, self.sizes[key], len(self.queues[key])) for key in keys]
+
+    def orders(self):
+        for key in reversed(self.keys):
+            for order in self.queues[key]:
+                yield order
+
+
+class MatchingEngine:
+    """
+    Price-time priority matching of one product. submit() and cancel()
+    return the full channel messages they caused, in sequence order, each
+    as (message, accounts) with the simulator accounts that own an order in
+    it. Accounts are told about fills and finished orders as they happen.
+    """
+    def __init__(self, product_id):
+        self.product_id = product_id
+        self.bids = PriceLevels(1)
+        self.asks = PriceLevels(-1)
+        # order id -> order, of the resting orders
+        self.orders = {}
+        self.sequence = 0
+        self.trade_id = 0
+        # (trade_id, time, tick, size, maker side), oldest first
+        self.trades = []
+        # minute -> [low, high, open, close, volume] of the trades
+        self.candles = {}
+
+    def best_ticks(self):
+        return self.bids.best(), self.asks.best()
+
+    def get_bid(self):
+        return orderbook.to_price(self.bids.best())
+
+    def get_ask(self):
+        return orderbook.to_price(self.asks.best())
+
+    def message(self, messages, msg, now, *orders):
+        self.sequence += 1
+        msg['product_id'] = self.product_id
+        msg['sequence'] = self.sequence
+        msg['time'] = format_time(now)
+        messages.append((msg, tuple(order['account'] for order in orders if order['account'] is not None)))
+
+    def submit(self, order, now):
+        messages = []
+        received = {'type': 'received', 'order_id': order['id'], 'side': order['side'],
+                    'order_type': order['type'], 'size': format_size(order['remaining'])}
+        if order['tick'] is not None:
+            received['price'] = format_price(order['tick'])
+        self.message(messages, received, now, order)
+        buying = order['side'] == 'buy'
+        book, contra = (self.bids, self.asks) if buying else (self.asks, self.bids)
+        while order['remaining'] > 0:
+            best = contra.best()
+            if best is None or (order['tick'] is not None and (best > order['tick'] if buying else
+                                                               best < order['tick'])):
+                break
+            maker = contra.first()
+            size = min(maker['remaining'], order['remaining'])
+            self.trade_id += 1
+            self.message(messages, {'type': 'match', 'trade_id': self.trade_id, 'maker_order_id': maker['id'],
+                                    'taker_order_id': order['id'], 'side': maker['side'],
+                                    'size': format_size(size), 'price': format_price(best)}, now, maker, order)
+            self.record_trade(now, best, size, maker['side'])
+            contra.reduce(maker, size)
+            self.fill(maker, best, size, 'M', now)
+            self.fill(order, best, size, 'T', now)
+            if maker['remaining'] == 0:
+                self.finish(messages, maker, 'filled', now)
+        if order['remaining'] > 0 and order['tick'] is not None:
+            order['status'] = 'open'
+            self.orders[order['id']] = order
+            book.add(order)
+            self.message(messages, {'type': 'open', 'order_id': order['id'], 'side': order['side'],
+                                    'price': format_price(order['tick']),
+                                    'remaining_size': format_size(order['remaining'])}, now, order)
+        else:
+            # Market orders never rest
+            self.finish(messages, order, 'filled' if order['remaining'] == 0 else 'canceled', now)
+        return messages
+
+    def cancel(self, order_id, now):
+        if order_id not in self.orders:
+            return None
+        messages = []
+        self.finish(messages, self.orders[order_id], 'canceled', now)
+        return messages
+
+    def fill(self, order, tick, size, liquidity, now):
+        order['remaining'] -= size
+        order['filled'] += size
+        order['executed'] += tick * size
+        if order['account'] is not None:
+            order['account'].fill(order, tick, size, liquidity, self.trade_id, now)
+
+    def finish(self, messages, order, reason, now):
+        if self.orders.pop(order['id'], None) is not None:
+            (self.bids if order['side'] == 'buy' else self.asks).remove(order)
+        order['status'] = 'done'
+        order['done_reason'] = reason
+        order['done_at'] = now
+        done = {'type': 'done', 'order_id': order['id'], 'side': order['side'], 'reason': reason,
+                'remaining_size': format_size(order['remaining'])}
+        if order['tick'] is not None:
+            done['price'] = format_price(order['tick'])
+        self.message(messages, done, now, order)
+        if order['account'] is not None:
+            order['account'].finish(order)
+
+    def record_trade(self, now, tick, size, side):
+        self.trades.append((self.trade_id, now, tick, size, side))
+        if len(self.trades) > 2 * TRADE_HISTORY:
+            del self.trades[:-TRADE_HISTORY]
+        minute = int(now // 60) * 60
+        candle = self.candles.get(minute)
+        if candle is None:
+            self.candles[minute] = [tick, tick, tick, tick, size]
+        else:
+            candle[0] = min(candle[0], tick)
+            candle[1] = max(candle[1], tick)
+            candle[3] = tick
+            candle[4] += size
+
+    def level_changes(self):
+        # [side, price, size] of the levels changed since the last call
+        changes = [['buy', format_price(tick), format_size(self.bids.sizes.get(tick, 0))]
+                   for tick in sorted(self.bids.changed, reverse=True)]
+        changes.extend(['sell', format_price(tick), format_size(self.asks.sizes.get(-tick, 0))]
+                       for tick in sorted(self.asks.changed))
+        self.bids.changed.clear()
+        self.asks.changed.clear()
+        return changes
+
+    def snapshot(self, level=1):
+        # As GET /products/<product>/book returns it
+        if level == 3:
+            return {'sequence': self.sequence,
+                    'bids': [[format_price(order['tick']), format_size(order['remaining']), order['id']]
+                             for order in self.bids.orders()],
+                    'asks': [[format_price(order['tick']), format_size(order['remaining']), order['id']]
+                             for order in self.asks.orders()]}
+        limit = 50 if level == 2 else 1
+        return {'sequence': self.sequence,
+                'bids': [[format_price(tick), format_size(size), count]
+                         for tick, size, count in self.bids.levels(limit)],
+                'asks': [[format_price(tick), format_size(size), count]
+                         for tick, size, count in self.asks.levels(limit)]}
+
+
+class History:
+    """
+    Made-up one minute candlesticks of the time before the market clock
+    started: a seeded random walk backwards from the starting price.
+    """
+    def __init__(self, seed, tick, volatility):
+        self.random = random.Random(seed)
+        self.volatility = volatility
+        self.opens = [tick]
+        # [low, high, open, close, volume] of the minutes before the start, latest first
+        self.rows = []
+
+    def row(self, minutes_before):
+        if minutes_before > MAX_HISTORY:
+            return None
+        while len(self.rows) < minutes_before:
+            close = self.opens[-1]
+            open_tick = max(1, int(round(close - self.random.gauss(0.0, self.volatility))))
+            high = max(open_tick, close) + int(abs(self.random.gauss(0.0, self.volatility / 2)))
+            low = max(1, min(open_tick, close) - int(abs(self.random.gauss(0.0, self.volatility / 2))))
+            volume = int(self.random.lognormvariate(1.0, 1.0) * orderbook.SIZE_SCALE)
+            self.rows.append([low, high, open_tick, close, volume])
+            self.opens.append(open_tick)
+        return self.rows[minutes_before - 1]
+
+
+class OrderFlow:
+    """
+    Synthetic order flow of one product. Its fair price is a random walk and
+    limit orders are placed around it, so orders left on the wrong side of
+    the fair price are taken as it moves. Market orders and cancels of
+    random resting orders keep trading going and the book size steady.
+    """
+    def __init__(self, engine, rand, tick, volatility, depth=200.0, max_orders=2000):
+        self.engine = engine
+        self.random = rand
+        self.fair = float(tick)
+        # Standard deviation of the fair price per minute, in ticks
+        self.volatility = volatility
+        self.depth = depth
+        self.max_orders = max_orders
+        self.resting = []
+        self.last_time = None
+
+    def new_order(self, side, tick, size, now, order_type='limit'):
+        return {'id': str(uuid.UUID(int=self.random.getrandbits(128), version=4)), 'product_id':
+                self.engine.product_id, 'side': side, 'type': order_type, 'tick': tick, 'size': size,
+                'remaining': size, 'filled': 0, 'executed': 0, 'account': None, 'post_only': False,
+                'created_at': now, 'status': 'pending', 'done_reason': None, 'done_at': None}
+
+    def size(self):
+        # Multiples of 0.0001, 0.05 in the median
+        return max(1, int(self.random.lognormvariate(math.log(500), 1.2))) * 10 ** (SIZE_PLACES - 4)
+
+    def place(self, now):
+        side = 'buy' if self.random.random() < 0.5 else 'sell'
+        offset = int(self.random.expovariate(1.0 / self.depth))
+        bid, ask = self.engine.best_ticks()
+        if self.random.random() < IMPROVE_SHARE and bid is not None and ask is not None:
+            tick = ask - 1 if side == 'buy' else bid + 1
+        elif side == 'buy':
+            tick = max(1, int(self.fair) - offset)
+        else:
+            tick = int(self.fair) + 1 + offset
+        order = self.new_order(side, tick, self.size(), now)
+        messages = self.engine.submit(order, now)
+        if order['status'] == 'open':
+            self.resting.append(order)
+        return messages
+
+    def cancel(self, now):
+        # Orders that were filled meanwhile are dropped on the way
+        while self.resting:
+            idx = self.random.randrange(len(self.resting))
+            order = self.resting[idx]
+            self.resting[idx] = self.resting[-1]
+            self.resting.pop()
+            if order['status'] == 'open':
+                return self.engine.cancel(order['id'], now)
+        return []
+
+    def take(self, now):
+        side = 'buy' if self.random.random() < 0.5 else 'sell'
+        return self.engine.submit(self.new_order(side, None, self.size(), now, 'market'), now)
+
+    def step(self, now):
+        if self.last_time is not None:
+            self.fair += self.random.gauss(0.0, self.volatility * math.sqrt((now - self.last_time) / 60.0))
+            self.fair = max(self.fair, float(self.depth))
+        self.last_time = now
+        action = self.random.random()
+        if action < MARKET_SHARE:
+            return self.take(now)
+        elif action < MARKET_SHARE + CANCEL_SHARE or len(self.engine.orders) >= self.max_orders:
+            return self.cancel(now)
+        return self.place(now)
+
+    def fill_book(self, count, now):
+        # Limit orders on both sides of the fair price, before anyone listens
+        for idx in xrange(count):
+            self.place(now)
+
+
+class Account:
+    """
+    Balances, orders and fills of the API key the bot trades with. Limit
+    orders hold their price * size of the quote currency (buys) or their
+    size (sells) until they are filled or done, like GDAX.
+    """
+    def __init__(self, key, secret, passphrase, balances, maker_fee='0.0', taker_fee='0.0'):
+        self.key = key
+        self.secret = secret
+        self.passphrase = passphrase
+        self.user_id = str(uuid.uuid5(uuid.NAMESPACE_OID, 'user:' + key))
+        self.profile_id = str(uuid.uuid5(uuid.NAMESPACE_OID, 'profile:' + key))
+        self.balances = dict((currency, Decimal(amount)) for currency, amount in balances.items())
+        self.holds = dict((currency, Decimal('0')) for currency in balances)
+        self.maker_fee = Decimal(maker_fee)
+        self.taker_fee = Decimal(taker_fee)
+        # Orders until they are canceled, GDAX forgets those
+        self.orders = {}
+        self.fills = []
+
+    def currencies(self, order):
+        base, quote = order['product_id'].split('-')
+        return base, quote
+
+    def required(self, order):
+        # (currency, amount) to hold for the order
+        base, quote = self.currencies(order)
+        if order['side'] == 'buy':
+            return quote, Decimal(order['tick'] * order['remaining']) / VALUE_SCALE
+        return base, Decimal(order['remaining']) / orderbook.SIZE_SCALE
+
+    def available(self, currency):
+        return self.balances.get(currency, Decimal('0')) - self.holds.get(currency, Decimal('0'))
+
+    def hold(self, order, sign=1):
+        currency, amount = self.required(order)
+        self.holds[currency] = self.holds.get(currency, Decimal('0')) + sign * amount
+
+    def fill(self, order, tick, size, liquidity, trade_id, now):
+        base, quote = self.currencies(order)
+        amount = Decimal(size) / orderbook.SIZE_SCALE
+        value = Decimal(tick * size) / VALUE_SCALE
+        fee = value * (self.maker_fee if liquidity == 'M' else self.taker_fee)
+        if order['side'] == 'buy':
+            # Held at the order price, a taker may have bought for less
+            self.holds[quote] -= Decimal(order['tick'] * size) / VALUE_SCALE
+            self.balances[quote] -= value + fee
+            self.balances[base] = self.balances.get(base, Decimal('0')) + amount
+        else:
+            self.holds[base] -= amount
+            self.balances[base] -= amount
+            self.balances[quote] = self.balances.get(quote, Decimal('0')) + value - fee
+        order['fees'] += fee
+        self.fills.append({'trade_id': trade_id, 'product_id': order['product_id'], 'order_id': order['id'],
+                           'user_id': self.user_id, 'profile_id': self.profile_id, 'liquidity': liquidity,
+                           'price': format_price(tick), 'size': format_size(size), 'fee': format_amount(fee),
+                           'side': order['side'], 'created_at': format_time(now), 'settled': True,
+                           'usd_volume': format_amount(value)})
+
+    def finish(self, order):
+        if order['remaining'] > 0:
+            self.hold(order, -1)
+        if order['done_reason'] == 'canceled':
+            self.orders.pop(order['id'], None)
+
+    def view(self, order):
+        # An order as the REST API returns it
+        view = {'id': order['id'], 'price': format_price(order['tick']), 'size': format_size(order['size']),
+                'product_id': order['product_id'], 'side': order['side'], 'stp': 'dc', 'type': order['type'],
+                'time_in_force': 'GTC', 'post_only': order['post_only'],
+                'created_at': format_time(order['created_at']), 'fill_fees': format_amount(order['fees']),
+                'filled_size': format_size(order['filled']), 'executed_value': format_value(order['executed']),
+                'status': order['status'], 'settled': order['status'] == 'done'}
+        if order['done_at'] is not None:
+            view['done_at'] = format_time(order['done_at'])
+            view['done_reason'] = order['done_reason']
+        if order.get('reject_reason'):
+            view['reject_reason'] = order['reject_reason']
+        return view
+
+    def accounts(self):
+        return [{'id': str(uuid.uuid5(uuid.NAMESPACE_OID, self.key + ':' + currency)), 'currency': currency,
+                 'balance': format_amount(self.balances[currency]), 'hold': format_amount(self.holds[currency]),
+                 'available': format_amount(self.available(currency)), 'profile_id': self.profile_id}
+                for currency in sorted(self.balances)]
+
+
+class RestError(Exception):
+    def __init__(self, status, message):
+        Exception.__init__(self, message)
+        self.status = status
+        self.message = message
+
+
+class Exchange:
+    """
+    The simulated exchange: one MatchingEngine and OrderFlow per product,
+    the Account of the bot, and the websocket connections. A market thread
+    applies the synthetic events and publishes their messages on the market
+    clock. Everything that touches the books holds self.lock.
+
+    Fault injection, all off by default:
+        latency, jitter    seconds added to every REST round trip, half on
+                           the way in and half on the way out
+        ws_latency         seconds between publishing and sending a message
+        error_rate         fraction of REST requests answered with a 500
+        reject_rate        fraction of orders rejected on top of the post
+                           only rejects
+        disconnect_interval  mean seconds between dropping a random
+                           websocket connection
+        drop_rate          fraction of matches left out of the market data
+                           channels, as if lost; /trades still has them
+    """
+    def __init__(self, products, account, seed=0, speed=1.0, events_per_second=40.0, volatility='10.0',
+                 start=None, initial_orders=400):
+        self.logger = logging.getLogger('trader-logger')
+        self.account = account
+        self.speed = float(speed)
+        self.events_per_second = float(events_per_second)
+        self.random = random.Random(seed)
+        self.faults = random.Random(seed + 1)
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.start_time = time.time() if start is None else float(start)
+        self.now = self.start_time
+        self.wall_start = None
+        self.engines = {}
+        self.flows = []
+        self.histories = {}
+        volatility = float(Decimal(volatility) * orderbook.PRICE_SCALE)
+        for idx, (product_id, price) in enumerate(products):
+            tick = orderbook.parse_fixed(price, PRICE_PLACES)
+            engine = self.engines[product_id] = MatchingEngine(product_id)
+            self.flows.append(OrderFlow(engine, self.random, tick, volatility))
+            self.histories[product_id] = History(seed * 1000 + idx, tick, volatility)
+        for flow in self.flows:
+            flow.fill_book(initial_orders, self.start_time)
+            flow.engine.level_changes()
+        self.connections = []
+        self.latency = 0.0
+        self.jitter = 0.0
+        self.ws_latency = 0.0
+        self.error_rate = 0.0
+        self.reject_rate = 0.0
+        self.disconnect_interval = 0.0
+        self.drop_rate = 0.0
+        # product_id -> [(bid tick, wall time published), (ask tick, wall time published)]
+        self.published_top = dict((product_id, [(None, None), (None, None)]) for product_id in self.engines)
+        self.reprice_latencies = collections.deque(maxlen=LATENCY_SAMPLES)
+        self.stats = collections.Counter()
+        self.max_lag = 0.0
+        self.thread = threading.Thread(target=self.run, name='simulator_market')
+        self.thread.daemon = True
+
+    def start(self):
+        self.wall_start = time.time()
+        self.thread.start()
+
+    def close(self):
+        self.stopped.set()
+        self.thread.join()
+        with self.lock:
+            connections = list(self.connections)
+        for connection in connections:
+            connection.drop()
+
+    def wall_time(self, market_time):
+        return self.wall_start + (market_time - self.start_time) / self.speed
+
+    def market_time(self):
+        # Never behind a message already sent, the market thread may lag
+        self.now = max(self.now, self.start_time + (time.time() - self.wall_start) * self.speed)
+        return self.now
+
+    def run(self):
+        rate = self.events_per_second * len(self.flows)
+        next_event = self.start_time + self.random.expovariate(rate)
+        next_heartbeat = math.floor(self.start_time) + 1.0
+        next_disconnect = None
+        while not self.stopped.is_set():
+            due = min(next_event, next_heartbeat)
+            wait = self.wall_time(due) - time.time()
+            if wait > 0:
+                time.sleep(min(wait, 0.1))
+                continue
+            self.max_lag = max(self.max_lag, -wait)
+            with self.lock:
+                self.now = max(self.now, due)
+                if due == next_heartbeat:
+                    self.heartbeat()
+                    next_heartbeat += 1.0
+                else:
+                    flow = self.flows[self.random.randrange(len(self.flows))]
+                    self.process(flow.engine, flow.step(self.now))
+                    self.stats['events'] += 1
+                    next_event += self.random.expovariate(rate)
+            if not self.disconnect_interval:
+                next_disconnect = None
+            elif next_disconnect is None:
+                next_disconnect = time.time() + self.faults.expovariate(1.0 / self.disconnect_interval)
+            elif time.time() >= next_disconnect:
+                self.disconnect()
+                next_disconnect = None
+
+    def heartbeat(self):
+        # With self.lock held
+        for engine in self.engines.values():
+            self.publish([({'type': 'heartbeat', 'product_id': engine.product_id, 'sequence': engine.sequence,
+                            'last_trade_id': engine.trade_id, 'time': format_time(self.now)}, ())])
+
+    def disconnect(self):
+        with self.lock:
+            if not self.connections:
+                return
+            connection = self.connections[self.faults.randrange(len(self.connections))]
+        self.logger.debug("[SIMULATOR] Dropping websocket connection %s:%d", *connection.address[:2])
+        self.stats['disconnects'] += 1
+        connection.drop()
+
+    def process(self, engine, messages):
+        # Publishes what an event did to the book, with self.lock held
+        if not messages:
+            return
+        self.publish(messages)
+        changes = engine.level_changes()
+        if changes:
+            self.publish([({'type': 'l2update', 'product_id': engine.product_id, 'time': format_time(self.now),
+                            'changes': changes}, ())])
+        top = self.published_top[engine.product_id]
+        for side, tick in enumerate(engine.best_ticks()):
+            if tick != top[side][0]:
+                top[side] = (tick, time.time())
+
+    def publish(self, messages):
+        for msg, accounts in messages:
+            self.stats['published'] += 1
+            product_id = msg['product_id']
+            channels = MESSAGE_CHANNELS[msg['type']]
+            payload = None
+            # A dropped match still reaches its owners on the user channel
+            dropped = msg['type'] == 'match' and self.drop_rate and self.faults.random() < self.drop_rate
+            if dropped:
+                self.stats['dropped'] += 1
+            for connection in self.connections:
+                if not dropped and connection.wants(product_id, channels):
+                    if payload is None:
+                        payload = json.dumps(msg)
+                    connection.send(payload)
+                if connection.account in accounts and connection.wants(product_id, ('user',)):
+                    connection.send(json.dumps(dict(msg, user_id=connection.account.user_id,
+                                                    profile_id=connection.account.profile_id)))
+
+    def add_connection(self, connection):
+        with self.lock:
+            self.connections.append(connection)
+        self.stats['connections'] += 1
+
+    def remove_connection(self, connection):
+        with self.lock:
+            if connection in self.connections:
+                self.connections.remove(connection)
+
+    def authenticate(self, key, passphrase, timestamp, signature, method, path, body=''):
+        if key != self.account.key or passphrase != self.account.passphrase:
+            raise RestError(401, "Invalid API Key")
+        try:
+            if abs(time.time() - float(timestamp)) > 30:
+                raise RestError(401, "request timestamp expired")
+        except (TypeError, ValueError):
+            raise RestError(401, "invalid timestamp")
+        if not signature or not hmac.compare_digest(str(signature),
+                                                    str(sign(self.account.secret, timestamp, method, path, body))):
+            raise RestError(401, "invalid signature")
+        return self.account
+
+    def subscribe(self, connection, msg):
+        """
+        Handles a subscribe message. Without channels it subscribes to the
+        full channel, like the original feed API the gdax client speaks.
+        """
+        product_ids = [product_id for product_id in msg.get('product_ids') or [] if product_id in self.engines]
+        channels = msg.get('channels')
+        if channels is None:
+            channels = ['full']
+        with self.lock:
+            for channel in channels:
+                if isinstance(channel, dict):
+                    name = channel.get('name')
+                    ids = [product_id for product_id in channel.get('product_ids') or product_ids
+                           if product_id in self.engines]
+                else:
+                    name, ids = channel, product_ids
+                if name not in CHANNELS:
+                    connection.send(json.dumps({'type': 'error', 'message': "Failed to subscribe",
+                                                'reason': "%s is not a valid channel" % name}))
+                    continue
+                if name == 'user':
+                    try:
+                        connection.account = self.authenticate(msg.get('key'), msg.get('passphrase'),
+                                                               msg.get('timestamp'), msg.get('signature'),
+                                                               'GET', '/users/self/verify')
+                    except RestError as e:
+                        connection.send(json.dumps({'type': 'error', 'message': "Authentication Failed",
+                                                    'reason': e.message}))
+                        continue
+                connection.subscriptions.setdefault(name, set()).update(ids)
+                if name == 'level2':
+                    for product_id in ids:
+                        bids, asks = self.engines[product_id].bids, self.engines[product_id].asks
+                        connection.send(json.dumps({
+                            'type': 'snapshot', 'product_id': product_id,
+                            'bids': [[format_price(tick), format_size(size)] for tick, size, count in bids.levels()],
+                            'asks': [[format_price(tick), format_size(size)] for tick, size, count in asks.levels()]}))
+            connection.send(json.dumps(connection.subscription_message()))
+
+    def set_heartbeat(self, connection, on):
+        # The original feed API's {"type": "heartbeat", "on": true}
+        with self.lock:
+            if on:
+                subscribed = set()
+                for ids in connection.subscriptions.values():
+                    subscribed.update(ids)
+                connection.subscriptions['heartbeat'] = subscribed
+            else:
+                connection.subscriptions.pop('heartbeat', None)
+
+    def delay(self):
+        # One way of the injected REST latency
+        if self.latency or self.jitter:
+            time.sleep((self.latency + self.faults.uniform(0.0, self.jitter)) / 2)
+
+    def request(self, method, path, headers, body):
+        """
+        Answers a REST request. Returns (status, result, extra headers).
+        """
+        url = urlparse(path)
+        query = dict((name, values[-1]) for name, values in parse_qs(url.query).items())
+        parts = [part for part in url.path.split('/') if part]
+        self.stats['requests'] += 1
+        try:
+            if parts == ['simulator', 'stats']:
+                return 200, self.get_stats(), {}
+            if self.error_rate and self.faults.random() < self.error_rate:
+                self.stats['errors_injected'] += 1
+                raise RestError(500, "Internal server error")
+            if parts and parts[0] in ('accounts', 'orders', 'fills'):
+                account = self.authenticate(headers.get('CB-ACCESS-KEY'), headers.get('CB-ACCESS-PASSPHRASE'),
+                                            headers.get('CB-ACCESS-TIMESTAMP'), headers.get('CB-ACCESS-SIGN'),
+                                            method, path, body)
+                return self.private_request(account, method, parts, query, body)
+            if method == 'GET':
+                return self.public_request(parts, query)
+            raise RestError(404, "NotFound")
+        except RestError as e:
+            return e.status, {'message': e.message}, {}
+
+    def public_request(self, parts, query):
+        if parts == ['time']:
+            now = self.market_time()
+            return 200, {'iso': format_time(now), 'epoch': now}, {}
+        if parts == ['products']:
+            return 200, [{'id': product_id, 'base_currency': product_id.split('-')[0],
+                          'quote_currency': product_id.split('-')[1], 'base_min_size': '0.0001',
+                          'quote_increment': '0.01', 'display_name': product_id.replace('-', '/')}
+                         for product_id in sorted(self.engines)], {}
+        if len(parts) != 3 or parts[0] != 'products' or parts[1] not in self.engines:
+            raise RestError(404, "NotFound")
+        engine = self.engines[parts[1]]
+        with self.lock:
+            if parts[2] == 'book':
+                return 200, engine.snapshot(int(query.get('level', 1))), {}
+            if parts[2] == 'ticker':
+                last = engine.trades[-1] if engine.trades else None
+                return 200, {'trade_id': engine.trade_id, 'price': format_price(last[2]) if last else None,
+                             'size': format_size(last[3]) if last else None, 'bid': format_price(engine.bids.best()),
+                             'ask': format_price(engine.asks.best()), 'time': format_time(self.market_time())}, {}
+            if parts[2] == 'trades':
+                return self.get_trades(engine, query)
+            if parts[2] == 'candles':
+                return 200, self.get_candles(engine, query), {}
+        raise RestError(404, "NotFound")
+
+    def get_trades(self, engine, query):
+        # Newest first; after=N pages back through the trade ids below N
+        limit = min(int(query.get('limit', 100)), 100)
+        trades = engine.trades
+        if not trades:
+            return 200, [], {}
+        first_id = trades[0][0]
+        last = min(int(query['after']) - 1, engine.trade_id) if 'after' in query else engine.trade_id
+        page = [{'time': format_time(now), 'trade_id': trade_id, 'price': format_price(tick),
+                 'size': format_size(size), 'side': side}
+                for trade_id, now, tick, size, side in trades[max(0, last - limit + 1 - first_id):
+                                                              max(0, last + 1 - first_id)][::-1]]
+        headers = {}
+        if page:
+            headers = {'cb-before': str(page[0]['trade_id']), 'cb-after': str(page[-1]['trade_id'])}
+        return 200, page, headers
+
+    def get_candles(self, engine, query):
+        granularity = int(query.get('granularity', 60))
+        if granularity not in GRANULARITIES:
+            raise RestError(400, "Unsupported granularity")
+        end = parse_epoch(query['end']) if query.get('end') else self.market_time()
+        start = parse_epoch(query['start']) if query.get('start') else end - 300 * granularity
+        if (end - start) / granularity > 300:
+            raise RestError(400, "granularity too small for the requested time range")
+        history = self.histories[engine.product_id]
+        start_minute = int(self.start_time // 60) * 60
+        rows = []
+        bucket = int(end // granularity) * granularity
+        while bucket >= start - start % granularity:
+            candle = None
+            for minute in xrange(bucket, bucket + granularity, 60):
+                if minute < start_minute:
+                    row = history.row((start_minute - minute) // 60)
+                else:
+                    row = engine.candles.get(minute)
+                if row is None:
+                    continue
+                if candle is None:
+                    candle = list(row)
+                else:
+                    candle[0] = min(candle[0], row[0])
+                    candle[1] = max(candle[1], row[1])
+                    candle[3] = row[3]
+                    candle[4] += row[4]
+            if candle is not None:
+                rows.append([bucket, candle[0] / 100.0, candle[1] / 100.0, candle[2] / 100.0,
+                             candle[3] / 100.0, candle[4] / float(orderbook.SIZE_SCALE)])
+            bucket -= granularity
+        return rows
+
+    def private_request(self, account, method, parts, query, body):
+        with self.lock:
+            if parts == ['accounts'] and method == 'GET':
+                return 200, account.accounts(), {}
+            if parts == ['fills'] and method == 'GET':
+                fills = [fill for fill in reversed(account.fills)
+                         if fill['order_id'] == query.get('order_id', fill['order_id']) and
+                         fill['product_id'] == query.get('product_id', fill['product_id'])]
+                return 200, fills[:min(int(query.get('limit', 100)), 100)], {}
+            if parts == ['orders'] and method == 'GET':
+                orders = [account.view(order) for order in account.orders.values()
+                          if order['status'] in ('open', 'pending') and
+                          order['product_id'] == query.get('product_id', order['product_id'])]
+                return 200, sorted(orders, key=lambda order: order['created_at'], reverse=True), {}
+            if parts == ['orders'] and method == 'POST':
+                return self.place_order(account, json.loads(body or '{}'))
+            if parts == ['orders'] and method == 'DELETE':
+                # gdax.AuthenticatedClient sends the product in the body, rest.CachedClient in the query
+                product_id = query.get('product_id') or json.loads(body or '{}').get('product_id')
+                return 200, [order_id for order_id, order in list(account.orders.items())
+                             if order['status'] == 'open' and product_id in (None, '', order['product_id']) and
+                             self.cancel_order(order)], {}
+            if len(parts) == 2 and parts[0] == 'orders':
+                order = account.orders.get(parts[1])
+                if order is None:
+                    raise RestError(404, "NotFound")
+                if method == 'GET':
+                    return 200, account.view(order), {}
+                if method == 'DELETE':
+                    if order['status'] != 'open' or not self.cancel_order(order):
+                        raise RestError(400, "Order already done")
+                    return 200, [order['id']], {}
+        raise RestError(404, "NotFound")
+
+    def cancel_order(self, order):
+        engine = self.engines[order['product_id']]
+        messages = engine.cancel(order['id'], self.market_time())
+        if messages is None:
+            return False
+        self.process(engine, messages)
+        self.stats['orders_canceled'] += 1
+        return True
+
+    def place_order(self, account, params):
+        engine = self.engines.get(params.get('product_id'))
+        if engine is None:
+            raise RestError(400, "product_id is not a valid product")
+        if params.get('side') not in ('buy', 'sell'):
+            raise RestError(400, "side is not valid")
+        if params.get('type', 'limit') != 'limit':
+            raise RestError(400, "Only limit orders are simulated")
+        try:
+            tick = orderbook.parse_fixed(str(params['price']), PRICE_PLACES)
+            size = orderbook.parse_fixed(str(params['size']), SIZE_PLACES)
+        except (KeyError, ValueError):
+            raise RestError(400, "Invalid price or size")
+        if tick <= 0 or size <= 0:
+            raise RestError(400, "Invalid price or size")
+        now = self.market_time()
+        order = {'id': str(uuid.uuid4()), 'product_id': engine.product_id, 'side': params['side'], 'type': 'limit',
+                 'tick': tick, 'size': size, 'remaining': size, 'filled': 0, 'executed': 0, 'fees': Decimal('0'),
+                 'account': account, 'post_only': bool(params.get('post_only')), 'created_at': now,
+                 'status': 'pending', 'done_reason': None, 'done_at': None}
+        currency, amount = account.required(order)
+        if amount > account.available(currency):
+            raise RestError(400, "Insufficient funds")
+        self.stats['orders_placed'] += 1
+        self.observe_reprice(engine, order)
+        bid, ask = engine.best_ticks()
+        if order['post_only'] and ((order['side'] == 'buy' and ask is not None and tick >= ask) or
+                                   (order['side'] == 'sell' and bid is not None and tick <= bid)):
+            order['reject_reason'] = 'post only'
+        elif self.reject_rate and self.faults.random() < self.reject_rate:
+            order['reject_reason'] = 'simulated'
+        if order.get('reject_reason'):
+            order['status'] = 'rejected'
+            self.stats['orders_rejected'] += 1
+            return 200, account.view(order), {}
+        account.hold(order)
+        account.orders[order['id']] = order
+        view = account.view(order)
+        self.process(engine, engine.submit(order, now))
+        return 200, view, {}
+
+    def observe_reprice(self, engine, order):
+        """
+        Time since the top of book the order is priced from was published:
+        a buy one tick under the best ask or a sell one tick over the best
+        bid, the prices TradeEngine places at. Orders priced from a top of
+        book that has changed since are counted as stale.
+        """
+        bid, ask = self.published_top[engine.product_id]
+        if order['side'] == 'buy' and ask[0] is not None:
+            tick, published = ask[0] - 1, ask[1]
+        elif order['side'] == 'sell' and bid[0] is not None:
+            tick, published = bid[0] + 1, bid[1]
+        else:
+            return
+        if order['tick'] == tick:
+            self.reprice_latencies.append(time.time() - published)
+        else:
+            self.stats['orders_stale'] += 1
+
+    def get_stats(self):
+        elapsed = time.time() - self.wall_start if self.wall_start else 0.0
+        stats = dict(self.stats)
+        latencies = list(self.reprice_latencies)
+        stats.update({'seconds': elapsed, 'market_seconds': self.now - self.start_time,
+                      'published_per_second': self.stats['published'] / elapsed if elapsed else 0.0,
+                      'sent_per_second': self.stats['sent'] / elapsed if elapsed else 0.0,
+                      'max_lag': self.max_lag, 'connections_open': len(self.connections),
+                      'fills': len(self.account.fills), 'reprice_samples': len(latencies),
+                      'reprice_p50': percentile(latencies, 0.5), 'reprice_p90': percentile(latencies, 0.9),
+                      'reprice_p99': percentile(latencies, 0.99),
+                      'balances': dict((currency, format_amount(balance)) for currency, balance in self.account.balances.items())})
+        return stats
+
+
+def encode_frame(opcode, payload):
+    # Server frames are never masked
+    length = len(payload)
+    if length < 126:
+        header = struct.pack('!BB', 0x80 | opcode, length)
+    elif length < 65536:
+        header = struct.pack('!BBH', 0x80 | opcode, 126, length)
+    else:
+        header = struct.pack('!BBQ', 0x80 | opcode, 127, length)
+    return header + payload
+
+
+class Connection:
+    """
+    A websocket client. Payloads queued by send() are written by the
+    connection's own thread, ws_latency after they were published; a client
+    that falls MAX_PENDING payloads behind is disconnected, like GDAX
+    disconnects slow consumers.
+    """
+    def __init__(self, exchange, sock, rfile, address):
+        self.exchange = exchange
+        self.sock = sock
+        self.rfile = rfile
+        self.address = address
+        self.account = None
+        # channel -> product ids
+        self.subscriptions = {}
+        self.pending = Queue.Queue(MAX_PENDING)
+        self.write_lock = threading.Lock()
+        self.closed = threading.Event()
+        self.thread = threading.Thread(target=self.run_sender, name='simulator_sender')
+        self.thread.daemon = True
+
+    def wants(self, product_id, channels):
+        for channel in channels:
+            if product_id in self.subscriptions.get(channel, ()):
+                return True
+        return False
+
+    def subscription_message(self):
+        return {'type': 'subscriptions', 'channels': [{'name': name, 'product_ids': sorted(ids)}
+                                                      for name, ids in sorted(self.subscriptions.items())]}
+
+    def send(self, payload):
+        try:
+            self.pending.put_nowait((time.time(), payload))
+        except Queue.Full:
+            if not self.closed.is_set():
+                self.exchange.stats['slow_disconnects'] += 1
+                self.exchange.logger.debug("[SIMULATOR] %s:%d fell %d messages behind, disconnecting",
+                                           self.address[0], self.address[1], MAX_PENDING)
+            self.drop()
+
+    def drop(self):
+        # Closes the socket without a close frame, like a network failure
+        self.closed.set()
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+
+    def write_frame(self, opcode, payload):
+        if not isinstance(payload, bytes):
+            payload = payload.encode('utf-8')
+        with self.write_lock:
+            self.sock.sendall(encode_frame(opcode, payload))
+
+    def run_sender(self):
+        latency = self.exchange.ws_latency
+        while not self.closed.is_set():
+            try:
+                published, payload = self.pending.get(timeout=0.5)
+            except Queue.Empty:
+                continue
+            if latency:
+                wait = published + latency - time.time()
+                if wait > 0:
+                    time.sleep(wait)
+            try:
+                self.write_frame(OPCODE_TEXT, payload)
+            except socket.error:
+                self.drop()
+                return
+            self.exchange.stats['sent'] += 1
+
+    def read_frame(self):
+        # (opcode, payload) of the next client frame, None once closed
+        header = self.rfile.read(2)
+        if len(header) < 2:
+            return None
+        first, second = struct.unpack('!BB', header)
+        length = second & 0x7f
+        if length == 126:
+            length = struct.unpack('!H', self.rfile.read(2))[0]
+        elif length == 127:
+            length = struct.unpack('!Q', self.rfile.read(8))[0]
+        mask = bytearray(self.rfile.read(4)) if second & 0x80 else None
+        payload = bytearray(self.rfile.read(length))
+        if mask:
+            for idx in xrange(len(payload)):
+                payload[idx] ^= mask[idx % 4]
+        return first & 0x0f, bytes(payload)
+
+    def serve(self):
+        self.exchange.add_connection(self)
+        self.thread.start()
+        try:
+            while not self.closed.is_set():
+                frame = self.read_frame()
+                if frame is None:
+                    break
+                opcode, payload = frame
+                if opcode == OPCODE_CLOSE:
+                    self.write_frame(OPCODE_CLOSE, payload[:2])
+                    break
+                elif opcode == OPCODE_PING:
+                    self.write_frame(OPCODE_PONG, payload)
+                elif opcode == OPCODE_TEXT:
+                    self.on_message(json.loads(payload.decode('utf-8')))
+        except (socket.error, struct.error, ValueError):
+            pass
+        finally:
+            self.exchange.remove_connection(self)
+            self.drop()
+            self.thread.join()
+
+    def on_message(self, msg):
+        if msg.get('type') == 'subscribe':
+            self.exchange.subscribe(self, msg)
+        elif msg.get('type') == 'unsubscribe':
+            with self.exchange.lock:
+                for channel in msg.get('channels') or list(self.subscriptions):
+                    name = channel.get('name') if isinstance(channel, dict) else channel
+                    self.subscriptions.get(name, set()).difference_update(msg.get('product_ids') or
+                                                                          self.subscriptions.get(name, set()))
+            self.send(json.dumps(self.subscription_message()))
+        elif msg.get('type') == 'heartbeat':
+            self.exchange.set_heartbeat(self, msg.get('on'))
+
+
+class ExchangeHandler(BaseHTTPRequestHandler):
+    # Keep-alive, so REST clients reuse their connections
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        if self.headers.get('Upgrade', '').lower() == 'websocket':
+            return self.upgrade()
+        self.answer('GET')
+
+    def do_POST(self):
+        self.answer('POST')
+
+    def do_DELETE(self):
+        self.answer('DELETE')
+
+    def answer(self, method):
+        exchange = self.server.exchange
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+        if not isinstance(body, str):
+            body = body.decode('utf-8')
+        exchange.delay()
+        status, result, headers = exchange.request(method, self.path, self.headers, body)
+        exchange.delay()
+        payload = json.dumps(result).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def upgrade(self):
+        key = self.headers.get('Sec-WebSocket-Key', '')
+        accept = base64.b64encode(hashlib.sha1((key + WEBSOCKET_GUID).encode('ascii')).digest()).decode('ascii')
+        self.send_response(101, 'Switching Protocols')
+        self.send_header('Upgrade', 'websocket')
+        self.send_header('Connection', 'Upgrade')
+        self.send_header('Sec-WebSocket-Accept', accept)
+        self.end_headers()
+        self.wfile.flush()
+        Connection(self.server.exchange, self.connection, self.rfile, self.client_address).serve()
+        self.close_connection = True
+
+    def log_message(self, format, *args):
+        pass
+
+
+class ExchangeServer(ThreadingMixIn, HTTPServer):
+    """
+    REST API and websocket feed of an Exchange on one port, a thread per
+    connection.
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, exchange, port, host='127.0.0.1'):
+        HTTPServer.__init__(self, (host, port), ExchangeHandler)
+        self.exchange = exchange
+        self.thread = threading.Thread(target=self.serve_forever, name='simulator_server')
+        self.thread.daemon = True
+
+    def start(self):
+        self.exchange.start()
+        self.thread.start()
+
+    def close(self):
+        self.exchange.close()
+        self.shutdown()
+        self.server_close()
+
+
+def format_stats(stats):
+    line = "market %.0f s in %.0f s (lag %.3f s), %d published (%.0f/s), %d sent (%.0f/s), %d open connections, " \
+           "%d disconnects, %d matches dropped, orders %d placed %d canceled %d rejected %d stale, %d fills" % \
+           (stats['market_seconds'], stats['seconds'], stats['max_lag'], stats.get('published', 0),
+            stats['published_per_second'], stats.get('sent', 0), stats['sent_per_second'],
+            stats['connections_open'], stats.get('disconnects', 0) + stats.get('slow_disconnects', 0),
+            stats.get('dropped', 0), stats.get('orders_placed', 0), stats.get('orders_canceled', 0), stats.get('orders_rejected', 0),
+            stats.get('orders_stale', 0), stats['fills'])
+    if stats['reprice_samples']:
+        line += ", reprice p50 %.1f ms p90 %.1f ms p99 %.1f ms" % (stats['reprice_p50'] * 1000,
+                                                                  stats['reprice_p90'] * 1000,
+                                                                  stats['reprice_p99'] * 1000)
+    return line
+
+
+def parse_product(value):
+    # BTC-USD:10000.00 -> ('BTC-USD', '10000.00')
+    product_id, _, price = value.partition(':')
+    return product_id, price or '10000.00'
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Simulated GDAX REST API and websocket feed")
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--products', default='BTC-USD:10000.00',
+                        help="comma separated products with their starting price, e.g. BTC-USD:10000,ETH-USD:800")
+    parser.add_argument('--seed', type=int, default=0, help="seed of the synthetic order flow")
+    parser.add_argument('--speed', type=float, default=1.0, help="market seconds per wall clock second")
+    parser.add_argument('--events-per-second', type=float, default=40.0,
+                        help="synthetic orders and cancels per market second and product")
+    parser.add_argument('--volatility', default='10.0', help="standard deviation of the price per market minute")
+    parser.add_argument('--start', default=None, help="market clock start, ISO time or epoch seconds; now by default")
+    parser.add_argument('--key', default='simulator')
+    parser.add_argument('--secret', default=base64.b64encode(b'simulator').decode('ascii'),
+                        help="base64 API secret")
+    parser.add_argument('--passphrase', default='simulator')
+    parser.add_argument('--usd', default='10000.00', help="starting USD balance")
+    parser.add_argument('--btc', default='1.0', help="starting BTC balance")
+    parser.add_argument('--maker-fee', default='0.0')
+    parser.add_argument('--taker-fee', default='0.0025')
+    parser.add_argument('--latency', type=float, default=0.0, help="REST round trip latency in ms")
+    parser.add_argument('--jitter', type=float, default=0.0, help="random extra REST round trip latency in ms")
+    parser.add_argument('--ws-latency', type=float, default=0.0, help="websocket message latency in ms")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="fraction of REST requests that fail")
+    parser.add_argument('--reject-rate', type=float, default=0.0, help="fraction of orders rejected")
+    parser.add_argument('--disconnect-interval', type=float, default=0.0,
+                        help="mean seconds between dropped websocket connections")
+    parser.add_argument('--drop-rate', type=float, default=0.0,
+                        help="fraction of matches left out of the websocket feed")
+    parser.add_argument('--report-interval', type=float, default=10.0, help="seconds between statistics lines")
+    args = parser.parse_args()
+
+    logger = logging.getLogger('trader-logger')
+    logger.setLevel(logging.DEBUG)
+    logger.addHandler(logging.StreamHandler())
+
+    products = [parse_product(value) for value in args.products.split(',') if value]
+    balances = {'USD': args.usd, 'BTC': args.btc}
+    for product_id, price in products:
+        for currency in product_id.split('-'):
+            balances.setdefault(currency, '0')
+    account = Account(args.key, args.secret, args.passphrase, balances, args.maker_fee, args.taker_fee)
+    exchange = Exchange(products, account, seed=args.seed, speed=args.speed,
+                        events_per_second=args.events_per_second, volatility=args.volatility,
+                        start=parse_epoch(args.start) if args.start else None)
+    exchange.latency = args.latency / 1000.0
+    exchange.jitter = args.jitter / 1000.0
+    exchange.ws_latency = args.ws_latency / 1000.0
+    exchange.error_rate = args.error_rate
+    exchange.reject_rate = args.reject_rate
+    exchange.disconnect_interval = args.disconnect_interval
+    exchange.drop_rate = args.drop_rate
+    server = ExchangeServer(exchange, args.port, args.host)
+    server.start()
+    logger.debug("[SIMULATOR] Serving %s on http://%s:%d and ws://%s:%d", ', '.join(dict(products)),
+                 args.host, args.port, args.host, args.port)
+    try:
+        while True:
+            time.sleep(args.report_interval)
+            logger.debug("[SIMULATOR] %s", format_stats(exchange.get_stats()))
+    except KeyboardInterrupt:
+        server.close()
+        logger.debug("[SIMULATOR] %s", format_stats(exchange.get_stats()))
@@ -0,0 +1,200 @@
+#
+# strategies.py
+# Mike Cardillo
+#
+# Pluggable trading strategies. Every strategy subscribes to the indicator
+# configurations it needs on one product and period, so strategies sharing a
+# configuration share its calculation, and hands its decisions to a single
+# OrderRouter. One strategy trades through TradeEngine, any number of others
+# are paper traded side by side.
+
+import math
+import logging
+from decimal import Decimal
+
+
+class Strategy:
+    """
+    Base class of the strategies. requirements() lists the (kind, params)
+    indicator configurations the strategy reads, see
+    IndicatorSubsystem.require(), and decide() is given
+    IndicatorSubsystem.current_indicators after every update and returns
+    'buy', 'sell' or None.
+    """
+    def __init__(self, name, product_id='BTC-USD', period_name='1'):
+        self.name = name
+        self.product_id = product_id
+        self.period_name = period_name
+        # kind -> key in current_indicators[period_name], set by subscribe()
+        self.keys = {}
+
+    def requirements(self):
+        return []
+
+    def subscribe(self, indicator_subsys):
+        self.keys = dict((kind, indicator_subsys.require(self.period_name, kind, params))
+                         for kind, params in self.requirements())
+
+    def ready(self, indicators):
+        current = indicators.get(self.period_name)
+        return current is not None and all(key in current for key in self.keys.values())
+
+    def decide(self, indicators):
+        raise NotImplementedError
+
+
+class MacdMfiStrategy(Strategy):
+    """
+    Buys when the MACD histogram is rising and MFI is below mfi_buy, sells
+    when the histogram is falling and negative. Without subscribe() it reads
+    the built-in indicators of IndicatorSubsystem.
+    """
+    def __init__(self, name='macd_mfi', product_id='BTC-USD', period_name='1', mfi_buy='20.0',
+                 macd_periods=(10, 26, 9), mfi_period=14):
+        Strategy.__init__(self, name, product_id, period_name)
+        self.mfi_buy = Decimal(mfi_buy)
+        self.macd_periods = tuple(macd_periods)
+        self.mfi_period = mfi_period
+
+    def requirements(self):
+        return [('macd', self.macd_periods), ('mfi', (self.mfi_period,))]
+
+    def values(self, indicators):
+        current = indicators[self.period_name]
+        if self.keys:
+            return current[self.keys['macd']], current[self.keys['mfi']]
+        return current, current['mfi']
+
+    def ready(self, indicators):
+        if not Strategy.ready(self, indicators) or 'macd_hist_diff' not in indicators[self.period_name]:
+            return False
+        macd, mfi = self.values(indicators)
+        return not (Decimal(macd['macd_hist_diff']).is_nan() or math.isnan(mfi))
+
+    def decide(self, indicators):
+        macd, mfi = self.values(indicators)
+        if Decimal(macd['macd_hist_diff']) > Decimal('0.0') and Decimal(mfi) < self.mfi_buy:
+            return 'buy'
+        elif Decimal(macd['macd_hist_diff']) < Decimal('0.0') and Decimal(macd['macd_hist']) < Decimal('0.0'):
+            return 'sell'
+        return None
+
+
+class PaperAccount:
+    """
+    Balances of a paper traded strategy. Every decision moves the whole
+    balance, buying at the ask and selling at the bid.
+    """
+    def __init__(self, usd='1000.00', fee_rate='0.0'):
+        self.start_usd = Decimal(usd)
+        self.usd = Decimal(usd)
+        self.btc = Decimal('0.0')
+        self.fee_rate = Decimal(fee_rate)
+        self.trades = 0
+        self.last_price = None
+
+    def fill(self, side, bid, ask):
+        if side == 'buy' and self.usd > 0:
+            self.btc += self.usd * (1 - self.fee_rate) / ask
+            self.usd = Decimal('0.0')
+        elif side == 'sell' and self.btc > 0:
+            self.usd += self.btc * bid * (1 - self.fee_rate)
+            self.btc = Decimal('0.0')
+        else:
+            return False
+        self.trades += 1
+        return True
+
+    def equity(self, price):
+        return self.usd + self.btc * price
+
+    def pnl(self, price):
+        return self.equity(price) - self.start_usd
+
+
+class OrderRouter:
+    """
+    The single destination of strategy decisions. Decisions of the live
+    strategy are executed by TradeEngine, those of every other strategy fill
+    its PaperAccount at the current bid and ask.
+    """
+    def __init__(self, trade_engine=None, paper_usd='1000.00', paper_fee_rate='0.0'):
+        self.logger = logging.getLogger('trader-logger')
+        self.trade_engine = trade_engine
+        self.paper_usd = paper_usd
+        self.paper_fee_rate = paper_fee_rate
+        self.live = None
+        self.accounts = {}
+
+    def add(self, strategy, live=False):
+        if live:
+            if self.live is not None:
+                raise ValueError("%s already trades live" % self.live.name)
+            self.live = strategy
+        elif strategy.name in self.accounts:
+            raise ValueError("A strategy named %s was already added" % strategy.name)
+        else:
+            self.accounts[strategy.name] = PaperAccount(self.paper_usd, self.paper_fee_rate)
+
+    def route(self, strategy, decision, bid, ask):
+        if decision is None:
+            return
+        if strategy is self.live:
+            self.trade_engine.execute(decision)
+            return
+        account = self.accounts[strategy.name]
+        account.last_price = (bid + ask) / 2
+        if account.fill(decision, bid, ask):
+            self.logger.debug("[PAPER %s] %s at %s, equity %s USD", strategy.name, decision.upper(),
+                              ask if decision == 'buy' else bid, account.equity(account.last_price))
+
+    def report(self):
+        # (name, trades, pnl) of the paper traded strategies, best first
+        rows = [(name, account.trades, account.pnl(account.last_price) if account.last_price else Decimal('0.0'))
+                for name, account in self.accounts.items()]
+        return sorted(rows, key=lambda row: row[2], reverse=True)
+
+
+class StrategyRunner:
+    """
+    Subscribes strategies to the indicators of their product's
+    ProductPipeline and, after every message the pipeline processes, routes
+    the decision of each of its strategies whose indicators are ready.
+    """
+    def __init__(self, pipelines, router):
+        self.pipelines = pipelines
+        self.router = router
+        # product_id -> strategies, in the order added
+        self.strategies = {}
+        self.last_prices = {}
+
+    def add(self, strategy, live=False):
+        pipeline = self.pipelines[strategy.product_id]
+        strategy.subscribe(pipeline.indicator_subsys)
+        self.router.add(strategy, live)
+        if strategy.product_id not in self.strategies:
+            self.strategies[strategy.product_id] = []
+            pipeline.listeners.append(self.on_message)
+        self.strategies[strategy.product_id].append(strategy)
+
+    def prices(self, pipeline):
+        if pipeline.order_book is not None and pipeline.order_book.is_ready():
+            return pipeline.order_book.get_bid(), pipeline.order_book.get_ask()
+        # Products without an order book fill at the last trade
+        price = self.last_prices.get(pipeline.product_id)
+        return price, price
+
+    def on_message(self, pipeline, msg):
+        if msg.get('type') == "match":
+            self.last_prices[pipeline.product_id] = Decimal(msg.get('price'))
+        indicators = pipeline.indicator_subsys.current_indicators
+        prices = None
+        for strategy in self.strategies[pipeline.product_id]:
+            if not strategy.ready(indicators):
+                continue
+            decision = strategy.decide(indicators)
+            if decision is not None and prices is None:
+                prices = self.prices(pipeline)
+                if prices[0] is None:
+                    return
+            self.router.route(strategy, decision, *(prices or (None, None)))
@@ -0,0 +1,77 @@
+#
+# test_curses_interface.py
+# Mike Cardillo
+#
+# cursesDisplay skips values that are not calculated yet and redraws a region
+# whose drawing failed.
+
+import unittest
+import period
+import curses_interface
+
+
+class FakeScreen:
+    def __init__(self):
+        self.lines = {}
+
+    def getmaxyx(self):
+        return 24, 120
+
+    def addstr(self, y, x, text, attr=0):
+        self.lines[y] = text
+
+    def refresh(self):
+        pass
+
+
+class FakeEngine:
+    def __init__(self, active_side):
+        self.active_side = active_side
+
+    def get_cached(self, method, default, *args, **kwargs):
+        return {'get_fills': [[]], 'get_orders': [[{'side': 'buy', 'price': '100.00', 'size': '0.5',
+                                                      'status': 'open'}]]}[method]
+
+    def tracking(self):
+        return False
+
+
+def display():
+    # The state of an enabled display, without a terminal or renderer thread
+    interface = curses_interface.cursesDisplay(enable=False)
+    interface.enable = True
+    interface.snapshots = {}
+    interface.drawn = {}
+    interface.closed_total = None
+    interface.closed_rows = ()
+    interface.stdscr = FakeScreen()
+    return interface
+
+
+class UpdateTest(unittest.TestCase):
+    def test_values_not_calculated_yet_are_skipped(self):
+        interface = display()
+        interface.update_indicators({'1': {'bid': {}, 'ask': {}}})
+        interface.update_candlesticks(period.Period(initialize=False))
+        self.assertEqual(interface.snapshots, {})
+
+    def test_failed_draw_is_retried(self):
+        interface = display()
+        interface.update_indicators({'1': {'macd_hist_diff': 1.0, 'macd_hist': None, 'mfi': 50.0}})
+        self.assertRaises(TypeError, interface.draw)
+        self.assertEqual(interface.drawn, {})
+        interface.update_indicators({'1': {'macd_hist_diff': 1.0, 'macd_hist': 2.0, 'mfi': 50.0}})
+        interface.draw()
+        self.assertEqual(interface.drawn['indicators'], (1.0, 2.0, 50.0))
+        self.assertIn("MFI: 50.000000", interface.stdscr.lines[1])
+
+    def test_open_orders_follow_the_active_side(self):
+        interface = display()
+        interface.update_orders(FakeEngine('buy'))
+        self.assertEqual(interface.snapshots['orders'], ((), (('buy', '100.00', '0.5', 'open'),)))
+        interface.update_orders(FakeEngine(None))
+        self.assertEqual(interface.snapshots['orders'], ((), None))
+
+
+if __name__ == '__main__':
+    unittest.main()
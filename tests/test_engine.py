@@ -0,0 +1,43 @@
+#
+# test_engine.py
+# Mike Cardillo
+#
+# TradeEngine hands orders to its order thread through a queue holding only
+# the latest request.
+
+import Queue
+import unittest
+import engine
+
+
+class AliveThread:
+    # An order thread busy in a REST call
+    def is_alive(self):
+        return True
+
+
+class IdleEngine(engine.TradeEngine):
+    # The order request state of a TradeEngine, without its feeds
+    def __init__(self, active_side=None):
+        self.order_requests = Queue.Queue(maxsize=1)
+        self.order_thread = AliveThread()
+        self.active_side = active_side
+
+
+class StartOrderTest(unittest.TestCase):
+    def test_latest_request_replaces_waiting_ones(self):
+        trade_engine = IdleEngine()
+        for idx in range(1000):
+            trade_engine.start_order('buy' if idx % 3 else 'sell')
+        trade_engine.start_order('sell')
+        self.assertEqual(trade_engine.order_requests.qsize(), 1)
+        self.assertEqual(trade_engine.order_requests.get_nowait(), 'sell')
+
+    def test_active_side_is_not_requested_again(self):
+        trade_engine = IdleEngine(active_side='buy')
+        trade_engine.start_order('buy')
+        self.assertTrue(trade_engine.order_requests.empty())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,103 @@
+#
+# test_feed.py
+# Mike Cardillo
+#
+# Trades missed by the websocket feed are detected from their trade ids and
+# backfilled from REST, so the candlesticks come out as if nothing was lost.
+# The feed comes from simulator.py with matches dropped.
+
+import time
+import base64
+import unittest
+import numpy as np
+import feed
+import period
+import rest
+import simulator
+
+START = 1504224000.0
+
+
+class GapBackfillTest(unittest.TestCase):
+    def start_exchange(self, drop_rate):
+        account = simulator.Account('simulator', base64.b64encode(b'simulator').decode('ascii'), 'simulator',
+                                    {'USD': '1000.00', 'BTC': '1.0'})
+        # Drops come from their own random stream, the market is the same for any drop_rate
+        self.exchange = simulator.Exchange([('BTC-USD', '10000.00')], account, seed=7, start=START)
+        self.exchange.drop_rate = drop_rate
+        # The market clock is moved by run_market(), the market thread is not started
+        self.exchange.wall_start = time.time()
+        self.server = simulator.ExchangeServer(self.exchange, 0)
+        self.server.thread.start()
+        port = self.server.server_address[1]
+        self.gap_tracker = feed.TradeGapTracker('http://127.0.0.1:%d' % port)
+        self.feed = feed.TradeAndHeartbeatWebsocket(url='ws://127.0.0.1:%d' % port, products=['BTC-USD'],
+                                                    gap_tracker=self.gap_tracker)
+        self.feed.start()
+        self.addCleanup(self.stop_exchange, self.exchange, self.server, self.feed)
+        deadline = time.time() + 10
+        while not any(connection.wants('BTC-USD', ('heartbeat',)) for connection in self.exchange.connections):
+            self.assertLess(time.time(), deadline, "the feed did not subscribe")
+            time.sleep(0.01)
+
+    def stop_exchange(self, exchange, server, websocket):
+        # Dropping the connection first unblocks the websocket thread
+        connections = list(exchange.connections)
+        for connection in connections:
+            connection.drop()
+        websocket.close()
+        for connection in connections:
+            connection.thread.join()
+        # And closing the pooled REST connections ends their handler threads
+        rest.public_session.close()
+        server.shutdown()
+        server.server_close()
+
+    def run_market(self, seconds, events_per_second=10):
+        # Synthetic order flow with a heartbeat every market second
+        flow = self.exchange.flows[0]
+        for second in range(seconds):
+            with self.exchange.lock:
+                for event in range(events_per_second):
+                    self.exchange.now += 1.0 / events_per_second
+                    self.exchange.process(flow.engine, flow.step(self.exchange.now))
+                self.exchange.heartbeat()
+
+    def receive(self, last_trade_id):
+        # Messages from the feed until the heartbeat after last_trade_id
+        messages = []
+        while True:
+            msg = self.feed.websocket_queue.get(timeout=30)
+            messages.append(msg)
+            if msg['type'] == "heartbeat" and msg['last_trade_id'] == last_trade_id:
+                return messages
+
+    def candlesticks(self, drop_rate, seconds=150):
+        self.start_exchange(drop_rate)
+        engine = self.exchange.engines['BTC-USD']
+        first_trade_id = engine.trade_id + 1
+        self.run_market(seconds)
+        messages = self.receive(engine.trade_id)
+        self.assertEqual(self.gap_tracker.backfilled, self.exchange.stats['dropped'])
+        trade_ids = [msg['trade_id'] for msg in messages if msg['type'] == "match"]
+        self.assertEqual(trade_ids, list(range(first_trade_id, engine.trade_id + 1)))
+
+        one_min = period.Period(initialize=False)
+        for msg in messages:
+            if msg['type'] == "match":
+                one_min.process_trade(msg)
+            else:
+                one_min.process_heartbeat(msg)
+        return one_min.candlesticks[:]
+
+    def test_dropped_trades_are_backfilled(self):
+        expected = self.candlesticks(drop_rate=0.0)
+        self.assertEqual(self.gap_tracker.trade_gaps, 0)
+        candlesticks = self.candlesticks(drop_rate=0.02)
+        self.assertGreater(self.gap_tracker.trade_gaps, 0)
+        self.assertEqual(len(candlesticks), 2)
+        np.testing.assert_allclose(candlesticks, expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
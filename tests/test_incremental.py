@@ -0,0 +1,132 @@
+#
+# test_incremental.py
+# Mike Cardillo
+#
+# The streaming indicators against TA-Lib, and against the batched versions
+# in vectorized.py, on one minute candlesticks.
+
+import os
+import json
+import unittest
+import numpy as np
+import incremental
+import vectorized
+try:
+    import talib
+except ImportError:
+    talib = None
+
+# GDAX historic rates layout, newest first as the API returns them. These are
+# not market data: they were fetched from the /products/BTC-USD/candles
+# endpoint of simulator.py, so prices and volumes come from its synthetic
+# order flow (and its timestamps from when it ran).
+CANDLES = os.path.join(os.path.dirname(__file__), 'data', 'candles_btc_usd_60.json')
+
+
+def load_candles():
+    with open(CANDLES) as candle_file:
+        candles = np.flipud(np.array(json.load(candle_file), dtype='f8'))
+    return candles[:, 2], candles[:, 1], candles[:, 4], candles[:, 5]
+
+
+def stream(indicator, *columns):
+    # Every value of the indicator as the candlesticks are committed
+    return np.array([indicator.update(*values) for values in zip(*columns)], dtype='f8')
+
+
+class ParityTest(unittest.TestCase):
+    def setUp(self):
+        self.highs, self.lows, self.closes, self.volumes = load_candles()
+
+    def assertParity(self, actual, expected):
+        actual, expected = np.asarray(actual, dtype='f8'), np.asarray(expected, dtype='f8')
+        self.assertEqual(actual.shape, expected.shape)
+        # Defined on the same candlesticks, and equal within tolerance there
+        np.testing.assert_array_equal(np.isnan(actual), np.isnan(expected))
+        self.assertGreater(np.count_nonzero(~np.isnan(expected)), 0)
+        np.testing.assert_allclose(actual, expected, rtol=1e-7, atol=1e-6)
+
+
+@unittest.skipIf(talib is None, "TA-Lib is not installed")
+class TalibParityTest(ParityTest):
+    def test_macd(self):
+        macd = stream(incremental.MACD(10, 26, 9), self.closes)
+        for column, expected in enumerate(talib.MACD(self.closes, fastperiod=10, slowperiod=26, signalperiod=9)):
+            self.assertParity(macd[:, column], expected)
+
+    def test_obv(self):
+        # The first candlestick is left out, see incremental.OBV
+        obv = stream(incremental.OBV(ema_period=21), self.closes, self.volumes)
+        expected = talib.OBV(self.closes[1:], self.volumes[1:])
+        self.assertParity(obv[1:, 0], expected)
+        self.assertParity(obv[1:, 1], talib.EMA(expected, timeperiod=21))
+
+    def test_bbands(self):
+        bands = stream(incremental.BollingerBands(20, 2, 2), self.closes)
+        for column, expected in enumerate(talib.BBANDS(self.closes, timeperiod=20, nbdevup=2, nbdevdn=2)):
+            self.assertParity(bands[:, column], expected)
+
+    def test_sar(self):
+        sar = stream(incremental.SAR(0.02, 0.2), self.highs, self.lows)
+        self.assertParity(sar, talib.SAR(self.highs, self.lows, acceleration=0.02, maximum=0.2))
+
+    def test_mfi(self):
+        mfi = stream(incremental.MFI(14), self.highs, self.lows, self.closes, self.volumes)
+        self.assertParity(mfi, talib.MFI(self.highs, self.lows, self.closes, self.volumes, timeperiod=14))
+
+
+class VectorizedParityTest(ParityTest):
+    def test_macd(self):
+        macd = stream(incremental.MACD(10, 26, 9), self.closes)
+        for column, expected in enumerate(vectorized.macd_rows(self.closes, 10, 26, 9)):
+            self.assertParity(macd[:, column], expected[0])
+
+    def test_obv(self):
+        obv = stream(incremental.OBV(ema_period=21), self.closes, self.volumes)
+        for column, expected in enumerate(vectorized.obv_rows(self.closes, self.volumes, 21)):
+            self.assertParity(obv[:, column], expected[0])
+
+    def test_bbands(self):
+        bands = stream(incremental.BollingerBands(20, 2, 2), self.closes)
+        for column, expected in enumerate(vectorized.bbands_rows(self.closes, 20, 2, 2)):
+            self.assertParity(bands[:, column], expected[0])
+
+    def test_sar(self):
+        sar = stream(incremental.SAR(0.02, 0.2), self.highs, self.lows)
+        self.assertParity(sar, vectorized.sar_rows(self.highs, self.lows, 0.02, 0.2)[0])
+
+    def test_mfi(self):
+        mfi = stream(incremental.MFI(14), self.highs, self.lows, self.closes, self.volumes)
+        self.assertParity(mfi, vectorized.mfi_rows(self.highs, self.lows, self.closes, self.volumes, 14)[0])
+
+    def test_running_sums_do_not_drift(self):
+        # Many times the window, for the running sums of BollingerBands and MFI
+        repeat = 40
+        highs, lows, closes, volumes = [np.tile(column, repeat) for column in
+                                        (self.highs, self.lows, self.closes, self.volumes)]
+        bands = stream(incremental.BollingerBands(20, 2, 2), closes)
+        for column, expected in enumerate(vectorized.bbands_rows(closes, 20, 2, 2)):
+            self.assertParity(bands[:, column], expected[0])
+        mfi = stream(incremental.MFI(14), highs, lows, closes, volumes)
+        self.assertParity(mfi, vectorized.mfi_rows(highs, lows, closes, volumes, 14)[0])
+
+    def test_amend_after_warm_up(self):
+        # Warming up keeps the state of the last commit only, enough to amend it
+        rows = np.column_stack((np.zeros(len(self.closes)), self.lows, self.highs, self.closes, self.closes,
+                                self.volumes))
+        streams = incremental.IndicatorStreams(None)
+        for idx, row in enumerate(rows[:-1]):
+            streams.commit(row, keep=idx == len(rows) - 2)
+        amended = rows[-2].copy()
+        amended[4] += 5.0
+        streams.amend(amended)
+        expected = incremental.IndicatorStreams(None)
+        for row in np.concatenate((rows[:-2], [amended])):
+            expected.commit(row)
+        self.assertEqual(streams.total, expected.total)
+        self.assertEqual(streams['macd'].peek(rows[-1][4]), expected['macd'].peek(rows[-1][4]))
+        self.assertEqual(streams['mfi'].peek(*rows[-1][[2, 1, 4, 5]]), expected['mfi'].peek(*rows[-1][[2, 1, 4, 5]]))
+
+
+if __name__ == '__main__':
+    unittest.main()
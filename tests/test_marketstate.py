@@ -0,0 +1,64 @@
+#
+# test_marketstate.py
+# Mike Cardillo
+#
+# Trades published by a MarketStateWriter reach the strategies of a trader
+# reading the market state through SharedFeed and SharedPipeline.
+
+import shutil
+import tempfile
+import unittest
+from decimal import Decimal
+import market
+import strategies
+import marketstate
+
+
+class AlwaysBuy(strategies.Strategy):
+    def ready(self, indicators):
+        return True
+
+    def decide(self, indicators):
+        return 'buy'
+
+
+def match(trade_id, price, size='0.5'):
+    return {'type': "match", 'product_id': "ETH-USD", 'trade_id': trade_id, 'side': "sell",
+            'sequence': trade_id, 'price': price, 'size': size, 'time': "2017-09-01T12:00:%02d.000000Z" % trade_id}
+
+
+class SharedFeedTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.pipeline = market.ProductPipeline("ETH-USD", initialize=False)
+        self.writer = marketstate.MarketStateWriter(self.directory, self.pipeline, capacity=100)
+        self.shared = marketstate.SharedPipeline(self.directory, "ETH-USD")
+        self.feed = marketstate.SharedFeed([self.shared])
+        self.router = strategies.OrderRouter()
+        self.runner = strategies.StrategyRunner({"ETH-USD": self.shared}, self.router)
+        self.runner.add(AlwaysBuy("always", product_id="ETH-USD"))
+
+    def tearDown(self):
+        self.writer.close()
+        shutil.rmtree(self.directory)
+
+    def test_match_reaches_strategies(self):
+        seen = {}
+        self.feed.poll(seen)
+        self.pipeline.process_message(match(1, "301.25"))
+        self.pipeline.process_message(match(2, "301.50"))
+        self.feed.poll(seen)
+        msg = self.feed.websocket_queue.get(timeout=1)
+        self.assertEqual(msg['type'], "match")
+        self.assertEqual(Decimal(msg['price']), Decimal("301.50"))
+        self.assertEqual(msg['time'], "2017-09-01T12:00:02.000000Z")
+        self.shared.process_message(msg)
+        self.assertEqual(self.runner.last_prices["ETH-USD"], Decimal("301.50"))
+        account = self.router.accounts["always"]
+        self.assertEqual(account.trades, 1)
+        self.assertEqual(account.last_price, Decimal("301.50"))
+        self.assertEqual(self.shared.get_period(60).cur_candlestick.close, 301.5)
+
+
+if __name__ == '__main__':
+    unittest.main()
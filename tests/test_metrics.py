@@ -0,0 +1,86 @@
+#
+# test_metrics.py
+# Mike Cardillo
+#
+# TimedClient times the REST methods of the client it wraps and leaves
+# everything else alone.
+
+import json
+import base64
+import hashlib
+import hmac
+import types
+import unittest
+import gdax
+import orders
+import metrics
+
+
+class FakeSocket:
+    def __init__(self):
+        self.sent = []
+
+    def send(self, data):
+        self.sent.append(json.loads(data))
+
+
+class TimedClientTest(unittest.TestCase):
+    def setUp(self):
+        self.was_enabled = metrics.enabled
+        metrics.enable()
+        self.client = gdax.AuthenticatedClient("key", base64.b64encode(b"secret").decode('ascii'), "passphrase",
+                                               api_url="http://127.0.0.1:1")
+        self.timed = metrics.TimedClient(self.client)
+
+    def tearDown(self):
+        metrics.enabled = self.was_enabled
+
+    def test_methods_are_timed(self):
+        calls = lambda: sum(metrics.rest_seconds.values.get('get_product_ticker', [[0]])[0])
+        before = calls()
+        self.client.get_product_ticker = types.MethodType(lambda client, product_id: {'price': "1.00"},
+                                                          self.client)
+        self.assertEqual(self.timed.get_product_ticker("BTC-USD"), {'price': "1.00"})
+        self.assertEqual(calls(), before + 1)
+        self.assertEqual(self.timed.url, self.client.url)
+
+    def test_auth_passes_through(self):
+        self.assertIs(self.timed.auth, self.client.auth)
+        tracker = orders.OrderTracker(self.timed, url="ws://127.0.0.1:1")
+        socket = FakeSocket()
+        tracker.reconcile = lambda: None
+        create_connection = orders.create_connection
+        orders.create_connection = lambda url: socket
+        try:
+            tracker._connect()
+        finally:
+            orders.create_connection = create_connection
+        subscribe = socket.sent[0]
+        self.assertEqual(subscribe['channels'], ['user'])
+        self.assertEqual((subscribe['key'], subscribe['passphrase']), ("key", "passphrase"))
+        message = (subscribe['timestamp'] + 'GET' + '/users/self/verify').encode('ascii')
+        signature = hmac.new(b"secret", message, hashlib.sha256).digest()
+        self.assertEqual(base64.b64decode(subscribe['signature']), signature)
+
+
+class RenderTest(unittest.TestCase):
+    def setUp(self):
+        self.was_enabled = metrics.enabled
+        metrics.enable()
+
+    def tearDown(self):
+        metrics.enabled = self.was_enabled
+
+    def test_histogram_labels_are_escaped(self):
+        histogram = metrics.Histogram('test_seconds', "Test", 'endpoint', buckets=(0.1,))
+        self.addCleanup(metrics.REGISTRY.remove, histogram)
+        histogram.observe(0.05, 'a"b\\c\nd')
+        escaped = 'endpoint="a\\"b\\\\c\\nd"'
+        self.assertEqual(histogram.render()[2:], ['test_seconds_bucket{%s,le="0.1"} 1' % escaped,
+                                                  'test_seconds_bucket{%s,le="+Inf"} 1' % escaped,
+                                                  'test_seconds_sum{%s} 0.05' % escaped,
+                                                  'test_seconds_count{%s} 1' % escaped])
+
+
+if __name__ == '__main__':
+    unittest.main()
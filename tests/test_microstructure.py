@@ -0,0 +1,54 @@
+#
+# test_microstructure.py
+# Mike Cardillo
+#
+# The trade windows of MicrostructureFeatures cover their full length however
+# many trades arrive in it.
+
+import unittest
+import period
+import microstructure
+
+START = 1504224000.0
+
+
+def match(now, price, size, side):
+    return {'type': "match", 'product_id': "BTC-USD", 'time': period.from_epoch(now).strftime('%Y-%m-%dT%H:%M:%S.%fZ'),
+            'price': repr(price), 'size': repr(size), 'side': side}
+
+
+class TradeWindowTest(unittest.TestCase):
+    def test_busy_windows_keep_their_length(self):
+        features = microstructure.MicrostructureFeatures()
+        # 40 trades a second for 400 s, far more than the 300 s window used to hold
+        trades = [(START + idx * 0.025, 100.0 + idx % 7, 0.5 + idx % 3, 'sell' if idx % 4 else 'buy')
+                  for idx in range(16000)]
+        for now, price, size, side in trades:
+            features.process_trade(match(now, price, size, side))
+        now = trades[-1][0]
+        values = features.features()
+        for seconds in (10, 60, 300):
+            # The window goes back at least seconds and at most a second more
+            inside = [trade for trade in trades if trade[0] > now - seconds]
+            around = [trade for trade in trades if trade[0] > now - seconds - 1]
+            self.assertTrue(len(inside) <= values['trades_%d' % seconds] <= len(around))
+            count = values['trades_%d' % seconds]
+            window = trades[-count:]
+            volume = sum(trade[2] for trade in window)
+            self.assertAlmostEqual(values['volume_%d' % seconds], volume)
+            self.assertAlmostEqual(values['vwap_%d' % seconds], sum(trade[1] * trade[2] for trade in window) / volume)
+            self.assertAlmostEqual(values['flow_%d' % seconds],
+                                   sum(trade[2] if trade[3] == 'sell' else -trade[2] for trade in window))
+
+    def test_heartbeat_empties_the_windows(self):
+        features = microstructure.MicrostructureFeatures()
+        features.process_trade(match(START, 100.0, 1.0, 'sell'))
+        features.process_heartbeat({'type': "heartbeat", 'time': period.from_epoch(START + 302).strftime(
+            '%Y-%m-%dT%H:%M:%S.%fZ')})
+        values = features.features()
+        self.assertEqual(values['trades_300'], 0)
+        self.assertEqual(values['volume_300'], 0.0)
+
+
+if __name__ == '__main__':
+    unittest.main()
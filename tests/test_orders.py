@@ -0,0 +1,48 @@
+#
+# test_orders.py
+# Mike Cardillo
+#
+# OrderTracker keeps orders placed over REST until their user channel events
+# arrive, and finishes the ones the exchange did not accept right away.
+
+import unittest
+import orders
+from decimal import Decimal
+
+
+def rest_order(order_id, status):
+    # As returned by AuthenticatedClient.buy()
+    return {'id': order_id, 'side': 'buy', 'price': '100.00', 'size': '0.50000000', 'filled_size': '0',
+            'product_id': 'BTC-USD', 'post_only': True, 'status': status}
+
+
+class TrackTest(unittest.TestCase):
+    def setUp(self):
+        self.tracker = orders.OrderTracker(auth_client=None, product_id='BTC-USD',
+                                           url="ws://127.0.0.1:1")
+
+    def test_rejected_order_is_done(self):
+        self.tracker.track(rest_order('abc', 'rejected'))
+        self.assertEqual(self.tracker.get_open_orders(), [])
+        # TradeEngine.update_buy() places a new order on NotFound
+        self.assertEqual(self.tracker.get_order('abc'), {'message': 'NotFound'})
+        order = self.tracker.orders['abc']
+        self.assertEqual((order['status'], order['done_reason']), ('done', 'rejected'))
+        self.assertIsNotNone(order['done_at'])
+        self.assertEqual(self.tracker.get_available('USD'), Decimal('0'))
+
+    def test_pending_order_is_open(self):
+        self.tracker.track(rest_order('abc', 'pending'))
+        self.assertEqual([order['id'] for order in self.tracker.get_open_orders()], ['abc'])
+        self.assertEqual(self.tracker.get_order('abc')['status'], 'pending')
+        self.assertIsNone(self.tracker.orders['abc']['done_at'])
+        self.tracker.on_message({'type': 'received', 'order_id': 'abc', 'product_id': 'BTC-USD', 'side': 'buy',
+                                 'price': '100.00', 'size': '0.50000000', 'order_type': 'limit'})
+        self.tracker.on_message({'type': 'done', 'order_id': 'abc', 'product_id': 'BTC-USD', 'side': 'buy',
+                                 'price': '100.00', 'remaining_size': '0.50000000', 'reason': 'canceled'})
+        self.assertEqual(self.tracker.get_open_orders(), [])
+        self.assertEqual(self.tracker.get_available('USD'), Decimal('0'))
+
+
+if __name__ == '__main__':
+    unittest.main()
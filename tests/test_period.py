@@ -0,0 +1,21 @@
+#
+# test_period.py
+# Mike Cardillo
+#
+# Period fetches from REST only the history it does not have yet.
+
+import time
+import unittest
+import period
+
+
+class HistoricalDataTest(unittest.TestCase):
+    def test_nothing_to_fetch_from_now(self):
+        # No request is made, the client points nowhere
+        one_min = period.Period(initialize=False, api_url="http://127.0.0.1:1")
+        hist_data = one_min.get_historical_data(start=time.time() + one_min.period_size)
+        self.assertEqual(hist_data.shape, (0, 6))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,244 @@
+#
+# tickstore.py
+# Mike Cardillo
+#
+# Compact on-disk capture of match and heartbeat messages, replayed through
+# memory-mapped NumPy views.
+#
+# Each product gets a directory of append-only segment files holding
+# fixed-width records (see TICK_DTYPE). Next to every segment is a small
+# index of (time, record number) pairs written every INDEX_INTERVAL records,
+# so a time range can be located without scanning the whole segment.
+
+import os
+import glob
+import calendar
+import datetime
+import logging
+import numpy as np
+import period
+import trade
+
+MATCH = 0
+HEARTBEAT = 1
+
+BUY = 1
+SELL = -1
+
+TICK_DTYPE = np.dtype([('time', '<i8'),       # ns since epoch
+                       ('trade_id', '<i8'),   # last_trade_id for heartbeats
+                       ('sequence', '<i8'),
+                       ('price', '<f8'),
+                       ('size', '<f8'),
+                       ('side', 'i1'),        # maker side, BUY or SELL
+                       ('type', 'i1'),        # MATCH or HEARTBEAT
+                       ('pad', 'V6')])
+INDEX_DTYPE = np.dtype([('time', '<i8'), ('record', '<i8')])
+
+INDEX_INTERVAL = 4096
+SEGMENT_RECORDS = 1 << 22
+SEGMENT_SUFFIX = '.ticks'
+INDEX_SUFFIX = '.idx'
+
+
+def time_to_ns(isotime):
+    isotime = trade.parse_time(isotime)
+    return (calendar.timegm(isotime.utctimetuple()) * 1000000 + isotime.microsecond) * 1000
+
+
+def ns_to_time(ns):
+    isotime = datetime.datetime.utcfromtimestamp(ns // 1000000000) + \
+        datetime.timedelta(microseconds=(ns % 1000000000) // 1000)
+    return isotime.strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+
+
+class TickWriter:
+    def __init__(self, root, product_id='BTC-USD', segment_records=SEGMENT_RECORDS, batch_size=256):
+        self.logger = logging.getLogger('trader-logger')
+        self.path = os.path.join(root, product_id)
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        self.segment_records = segment_records
+        self.batch = np.zeros(batch_size, dtype=TICK_DTYPE)
+        self.batch_count = 0
+        self.segment_file = None
+        self.index_file = None
+        self.segment_count = 0
+
+    def open_segment(self, first_time):
+        self.close_segment()
+        name = os.path.join(self.path, '%020d' % first_time)
+        self.segment_file = open(name + SEGMENT_SUFFIX, 'ab')
+        self.index_file = open(name + INDEX_SUFFIX, 'ab')
+        self.segment_count = 0
+        self.logger.debug("[TICKS] Opened segment %s", name)
+
+    def close_segment(self):
+        if self.segment_file is not None:
+            self.segment_file.close()
+            self.index_file.close()
+            self.segment_file = None
+            self.index_file = None
+
+    def write(self, msg):
+        if msg.get('type') == 'match':
+            record = (time_to_ns(msg.get('time')), int(msg.get('trade_id')), int(msg.get('sequence')),
+                      float(msg.get('price')), float(msg.get('size')),
+                      BUY if msg.get('side') == 'buy' else SELL, MATCH, b'')
+        elif msg.get('type') == 'heartbeat':
+            record = (time_to_ns(msg.get('time')), int(msg.get('last_trade_id')), int(msg.get('sequence')),
+                      0.0, 0.0, 0, HEARTBEAT, b'')
+        else:
+            return
+        self.batch[self.batch_count] = record
+        self.batch_count += 1
+        # Heartbeats arrive every second, so at most a second of ticks is buffered
+        if self.batch_count == len(self.batch) or record[6] == HEARTBEAT:
+            self.flush()
+
+    def flush(self):
+        start = 0
+        while start < self.batch_count:
+            if self.segment_file is None or self.segment_count >= self.segment_records:
+                self.open_segment(self.batch['time'][start])
+            end = min(self.batch_count, start + self.segment_records - self.segment_count)
+            records = self.batch[start:end]
+            # Index every record that starts a new INDEX_INTERVAL block
+            first = self.segment_count + (-self.segment_count % INDEX_INTERVAL)
+            offsets = np.arange(first, self.segment_count + len(records), INDEX_INTERVAL)
+            if len(offsets):
+                index = np.zeros(len(offsets), dtype=INDEX_DTYPE)
+                index['time'] = records['time'][offsets - self.segment_count]
+                index['record'] = offsets
+                self.index_file.write(index.tobytes())
+                self.index_file.flush()
+            self.segment_file.write(records.tobytes())
+            self.segment_file.flush()
+            self.segment_count += len(records)
+            start = end
+        self.batch_count = 0
+
+    def close(self):
+        self.flush()
+        self.close_segment()
+
+
+class TickCapture:
+    """
+    Routes messages to one TickWriter per product.
+    """
+    def __init__(self, root, **writer_args):
+        self.root = root
+        self.writer_args = writer_args
+        self.writers = {}
+
+    def write(self, msg):
+        product_id = msg.get('product_id', 'BTC-USD')
+        writer = self.writers.get(product_id)
+        if writer is None:
+            writer = self.writers[product_id] = TickWriter(self.root, product_id, **self.writer_args)
+        writer.write(msg)
+
+    def flush(self):
+        for writer in self.writers.values():
+            writer.flush()
+
+    def close(self):
+        for writer in self.writers.values():
+            writer.close()
+
+
+class TickReader:
+    def __init__(self, root, product_id='BTC-USD'):
+        self.path = os.path.join(root, product_id)
+
+    def segments(self):
+        return sorted(glob.glob(os.path.join(self.path, '*' + SEGMENT_SUFFIX)))
+
+    def load_segment(self, segment):
+        # Ignore a partially written trailing record
+        count = os.path.getsize(segment) // TICK_DTYPE.itemsize
+        if count == 0:
+            return np.zeros(0, dtype=TICK_DTYPE)
+        return np.memmap(segment, dtype=TICK_DTYPE, mode='r', shape=(count,))
+
+    def load_index(self, segment):
+        index_path = segment[:-len(SEGMENT_SUFFIX)] + INDEX_SUFFIX
+        count = os.path.getsize(index_path) // INDEX_DTYPE.itemsize if os.path.exists(index_path) else 0
+        if count == 0:
+            return np.zeros(0, dtype=INDEX_DTYPE)
+        return np.fromfile(index_path, dtype=INDEX_DTYPE, count=count)
+
+    def locate(self, ticks, index, time):
+        # Narrow down to one INDEX_INTERVAL block, then binary search inside it
+        block = np.searchsorted(index['time'], time, side='left')
+        lo = index['record'][block - 1] if block > 0 else 0
+        hi = index['record'][block] + 1 if block < len(index) else len(ticks)
+        return lo + np.searchsorted(ticks['time'][lo:hi], time, side='left')
+
+    def ticks(self, start=None, end=None):
+        """
+        Yields read-only memory-mapped views of the records in [start, end),
+        one per segment. Times are ns since epoch.
+        """
+        segments = self.segments()
+        for idx, segment in enumerate(segments):
+            if end is not None and int(os.path.basename(segment)[:-len(SEGMENT_SUFFIX)]) >= end:
+                break
+            if start is not None and idx + 1 < len(segments) and \
+               int(os.path.basename(segments[idx + 1])[:-len(SEGMENT_SUFFIX)]) <= start:
+                continue
+            ticks = self.load_segment(segment)
+            index = self.load_index(segment)
+            lo = self.locate(ticks, index, start) if start is not None else 0
+            hi = self.locate(ticks, index, end) if end is not None else len(ticks)
+            if hi > lo:
+                yield ticks[lo:hi]
+
+    def messages(self, start=None, end=None):
+        # Rebuilds GDAX-style messages, e.g. for backtest.Backtester
+        for ticks in self.ticks(start, end):
+            columns = zip(ticks['time'].tolist(), ticks['trade_id'].tolist(), ticks['sequence'].tolist(),
+                          ticks['price'].tolist(), ticks['size'].tolist(), ticks['side'].tolist(),
+                          ticks['type'].tolist())
+            for time, trade_id, sequence, price, size, side, tick_type in columns:
+                if tick_type == MATCH:
+                    yield {'type': 'match', 'time': ns_to_time(time), 'trade_id': trade_id,
+                           'sequence': sequence, 'price': repr(price), 'size': repr(size),
+                           'side': 'buy' if side == BUY else 'sell'}
+                else:
+                    yield {'type': 'heartbeat', 'time': ns_to_time(time),
+                           'last_trade_id': trade_id, 'sequence': sequence}
+
+    def candles(self, period_size=60, start=None, end=None):
+        """
+        Resamples matches into candlesticks in the GDAX historic rates layout
+        (time, low, high, open, close, volume), oldest first.
+        """
+        candles = [resample_ticks(ticks[ticks['type'] == MATCH], period_size)
+                   for ticks in self.ticks(start, end)]
+        if not candles:
+            return np.zeros((0, 6))
+        # Candlesticks split across two segments are combined again here
+        return period.resample_candlesticks(np.concatenate(candles), period_size)
+
+
+def resample_ticks(ticks, period_size):
+    if len(ticks) == 0:
+        return np.zeros((0, 6))
+    # Reduced straight from the record views, without a copy per tick
+    buckets = ticks['time'] // 1000000000
+    buckets -= buckets % period_size
+    price = ticks['price']
+    size = ticks['size']
+    if np.any(buckets[1:] < buckets[:-1]):
+        order = np.argsort(buckets, kind='mergesort')
+        buckets, price, size = buckets[order], price[order], size[order]
+    starts = np.concatenate(([0], np.flatnonzero(np.diff(buckets)) + 1))
+    ends = np.append(starts[1:], len(buckets))
+    return np.column_stack((buckets[starts],
+                            np.minimum.reduceat(price, starts),
+                            np.maximum.reduceat(price, starts),
+                            price[starts],
+                            price[ends - 1],
+                            np.add.reduceat(size, starts))).astype('f8')
@@ -4,19 +4,42 @@
 #
 # Objects relating to individual trade data
 
-import dateutil.parser
+import datetime
 import logging
+import pytz
 
 
-class Trade:
+def parse_time(isotime):
+    """
+    Parses the fixed ISO-8601 timestamps GDAX sends, e.g.
+    2017-09-01T12:34:56.789012Z, by slicing instead of going through
+    dateutil. Any other format falls back to dateutil.parser.
+    """
+    if len(isotime) >= 20 and isotime[-1] == 'Z' and isotime[10] == 'T' and \
+       (len(isotime) == 20 or isotime[19] == '.'):
+        try:
+            fraction = isotime[20:-1]
+            return datetime.datetime(int(isotime[0:4]), int(isotime[5:7]), int(isotime[8:10]),
+                                     int(isotime[11:13]), int(isotime[14:16]), int(isotime[17:19]),
+                                     int((fraction + '00000')[:6]) if fraction else 0, pytz.utc)
+        except ValueError:
+            pass
+    # Imported on first use, GDAX's own timestamps never get here
+    import dateutil.parser
+    return dateutil.parser.parse(isotime)
+
+
+class Trade(object):
+    __slots__ = ('seq', 'trade_id', 'time', 'price', 'volume')
+    logger = logging.getLogger('trader-logger')
+
     def __init__(self, msg):
         self.seq = int(msg.get('sequence'))
         self.trade_id = int(msg.get('trade_id'))
-        self.time = dateutil.parser.parse(msg.get('time'))
+        self.time = parse_time(msg.get('time'))
         self.price = float(msg.get('price'))
         self.volume = float(msg.get('size'))
-        self.logger = logging.getLogger('trader-logger')
 
     def print_trade(self):
-        self.logger.debug("[TRADE] Trade ID: %d Price: %f Volume: %f" %
-                          (self.trade_id, self.price, self.volume))
+        self.logger.debug("[TRADE] Trade ID: %d Price: %f Volume: %f",
+                          self.trade_id, self.price, self.volume)
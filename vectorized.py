@@ -0,0 +1,286 @@
+#
+# vectorized.py
+# Mike Cardillo
+#
+# Batched indicator math over 2-D arrays (rows x time). Each row can be a
+# different parameter set or a different series, and every row is computed in
+# the same NumPy pass. Recursive indicators still step through time, but each
+# step updates all rows at once. Results follow the TA-Lib definitions, with
+# NaN where an indicator is not yet defined. Rows of different lengths are
+# aligned on their last column and padded with NaN at the front.
+
+import numpy as np
+
+
+def as_rows(values, *params):
+    # Broadcasts a series (or stack of series) against per-row parameters
+    values = np.atleast_2d(np.asarray(values, dtype='f8'))
+    params = [np.atleast_1d(np.asarray(param)) for param in params]
+    rows = max([values.shape[0]] + [len(param) for param in params])
+    return [np.broadcast_to(values, (rows, values.shape[1]))] + \
+        [np.broadcast_to(param, (rows,)) for param in params]
+
+
+def first_valid(values):
+    # Index of the first non-NaN value in each row (row length if none)
+    valid = ~np.isnan(values)
+    return np.where(valid.any(axis=1), valid.argmax(axis=1), values.shape[1])
+
+
+def ema_rows(values, periods):
+    """
+    EMA of each row of values with the matching entry of periods. Like
+    TA-Lib, each row is seeded with the simple average of its first period
+    values, counted from the row's first non-NaN value.
+    """
+    values, periods = as_rows(values, periods)
+    rows, length = values.shape
+    k = 2.0 / (periods + 1)
+
+    start = first_valid(values)
+    seed_at = start + periods - 1
+    totals = np.cumsum(np.where(np.isnan(values), 0.0, values), axis=1)
+    seeds = np.full(rows, np.nan)
+    for row in np.flatnonzero(seed_at < length):
+        before = totals[row, start[row] - 1] if start[row] > 0 else 0.0
+        seeds[row] = (totals[row, seed_at[row]] - before) / periods[row]
+
+    seeding = {}
+    for row in np.flatnonzero(seed_at < length):
+        seeding.setdefault(seed_at[row], []).append(row)
+
+    out = np.empty((rows, length))
+    prev = np.full(rows, np.nan)
+    for idx in range(length):
+        prev = prev + k * (values[:, idx] - prev)
+        if idx in seeding:
+            seeded = seeding[idx]
+            prev[seeded] = seeds[seeded]
+        out[:, idx] = prev
+    return out
+
+
+def macd_rows(closes, fastperiods, slowperiods, signalperiods):
+    """
+    MACD, signal and histogram for each parameter row over the same (or
+    row-matched) closing prices. Returns three (rows, time) arrays.
+    """
+    closes, fastperiods, slowperiods, signalperiods = as_rows(closes, fastperiods, slowperiods, signalperiods)
+
+    # TA-Lib starts the fast EMA late so both averages begin on the same candle
+    skip = slowperiods - fastperiods
+    start = first_valid(closes)
+    delayed = closes.copy()
+    for row in np.flatnonzero(skip > 0):
+        delayed[row, :start[row] + skip[row]] = np.nan
+    macd = ema_rows(delayed, fastperiods) - ema_rows(closes, slowperiods)
+    macd_sig = ema_rows(macd, signalperiods)
+    macd[np.isnan(macd_sig)] = np.nan
+    return macd, macd_sig, macd - macd_sig
+
+
+def mfi_rows(highs, lows, closes, volumes, periods):
+    """
+    Money Flow Index of each row of prices with the matching period, using
+    rolling sums instead of a loop over time.
+    """
+    highs, lows, closes, volumes = [np.atleast_2d(np.asarray(x, dtype='f8'))
+                                    for x in (highs, lows, closes, volumes)]
+    periods = np.atleast_1d(np.asarray(periods))
+    rows = max(len(periods), highs.shape[0])
+    periods = np.broadcast_to(periods, (rows,))
+    typical = (highs + lows + closes) / 3.0
+    money_flow = typical * volumes
+    change = np.diff(typical, axis=1)
+    with np.errstate(invalid='ignore'):
+        rising, falling = change > 0, change < 0
+    positive = np.concatenate((np.zeros((typical.shape[0], 1)),
+                               np.where(rising, money_flow[:, 1:], 0.0)), axis=1).cumsum(axis=1)
+    negative = np.concatenate((np.zeros((typical.shape[0], 1)),
+                               np.where(falling, money_flow[:, 1:], 0.0)), axis=1).cumsum(axis=1)
+    positive = np.broadcast_to(positive, (rows, positive.shape[1]))
+    negative = np.broadcast_to(negative, (rows, negative.shape[1]))
+
+    length = typical.shape[1]
+    out = np.full((rows, length), np.nan)
+    for period in np.unique(periods):
+        selected = np.flatnonzero(periods == period)
+        if period >= length:
+            continue
+        pos = positive[selected, period:] - positive[selected, :-period]
+        neg = negative[selected, period:] - negative[selected, :-period]
+        total = pos + neg
+        with np.errstate(divide='ignore', invalid='ignore'):
+            out[selected, period:] = np.where(total < 1.0, 0.0, 100.0 * pos / total)
+    # Windows reaching into the padding of a row are undefined
+    start = np.broadcast_to(first_valid(typical), (rows,))
+    out[np.arange(length) < (start + periods)[:, None]] = np.nan
+    return out
+
+
+def obv_rows(closes, volumes, ema_periods=21, skip=1):
+    """
+    On Balance Volume of each row and its EMA with the matching period.
+    Like incremental.OBV, the first skip candles of a row are left out.
+    Returns two (rows, time) arrays.
+    """
+    closes, ema_periods = as_rows(closes, ema_periods)
+    volumes = np.broadcast_to(np.atleast_2d(np.asarray(volumes, dtype='f8')), closes.shape)
+    rows, length = closes.shape
+    change = np.zeros((rows, length))
+    change[:, 1:] = np.sign(np.diff(closes, axis=1))
+    start = first_valid(closes) + skip
+    columns = np.arange(length)
+    # The first counted candle contributes its whole volume
+    flows = np.where(columns == start[:, None], volumes, change * volumes)
+    flows[columns < start[:, None]] = 0.0
+    obv = np.cumsum(flows, axis=1)
+    obv[columns < start[:, None]] = np.nan
+    return obv, ema_rows(obv, ema_periods)
+
+
+def bbands_rows(closes, timeperiods=20, nbdevup=2, nbdevdn=2):
+    """
+    Bollinger Bands of each row with the matching parameters, from the
+    population standard deviation of each window. Returns the upper,
+    middle and lower bands as (rows, time) arrays.
+    """
+    closes, timeperiods, nbdevup, nbdevdn = as_rows(closes, timeperiods, nbdevup, nbdevdn)
+    rows, length = closes.shape
+    middle = np.full((rows, length), np.nan)
+    stddev = np.full((rows, length), np.nan)
+    for period in np.unique(timeperiods):
+        if period > length:
+            continue
+        selected = np.flatnonzero(timeperiods == period)
+        values = np.ascontiguousarray(closes[selected])
+        # Every window as a view, (rows, windows, period)
+        windows = np.lib.stride_tricks.as_strided(values, (len(selected), length - period + 1, period),
+                                                  values.strides + values.strides[1:])
+        middle[selected, period - 1:] = windows.mean(axis=2)
+        stddev[selected, period - 1:] = windows.std(axis=2)
+    return middle + nbdevup[:, None] * stddev, middle, middle - nbdevdn[:, None] * stddev
+
+
+def sar_rows(highs, lows, accelerations=0.02, maximums=0.2):
+    """
+    Parabolic SAR of each row with the matching parameters, stepping
+    through time with every row updated at once as in incremental.SAR.
+    """
+    highs, accelerations, maximums = as_rows(highs, accelerations, maximums)
+    lows = np.broadcast_to(np.atleast_2d(np.asarray(lows, dtype='f8')), highs.shape)
+    rows, length = highs.shape
+    accelerations = np.minimum(accelerations, maximums)
+    start = first_valid(highs)
+    out = np.full((rows, length), np.nan)
+    is_long = np.zeros(rows, dtype=bool)
+    sar, ep, af = np.zeros(rows), np.zeros(rows), np.zeros(rows)
+    prev_high, prev_low = np.zeros(rows), np.zeros(rows)
+    with np.errstate(invalid='ignore'):
+        for idx in range(1, length):
+            high, low = highs[:, idx], lows[:, idx]
+            # TA-Lib picks the initial direction from the -DM of the first two bars
+            starting = start + 1 == idx
+            if starting.any():
+                up = high - highs[:, idx - 1]
+                down = lows[:, idx - 1] - low
+                first_long = ~((down > 0) & (up < down))
+                is_long = np.where(starting, first_long, is_long)
+                sar = np.where(starting, np.where(first_long, lows[:, idx - 1], highs[:, idx - 1]), sar)
+                ep = np.where(starting, np.where(first_long, high, low), ep)
+                af = np.where(starting, accelerations, af)
+                prev_high = np.where(starting, high, prev_high)
+                prev_low = np.where(starting, low, prev_low)
+            active = start + 1 <= idx
+            reverse = np.where(is_long, low <= sar, high >= sar)
+            # On a reversal the SAR jumps to the extreme point of the old trend
+            reversed_sar = np.where(is_long, np.maximum(np.maximum(ep, prev_high), high),
+                                    np.minimum(np.minimum(ep, prev_low), low))
+            value = np.where(reverse, reversed_sar, sar)
+            extends = np.where(is_long, high > ep, low < ep) & ~reverse
+            new_long = is_long != reverse
+            new_ep = np.where(reverse, np.where(is_long, low, high),
+                              np.where(extends, np.where(is_long, high, low), ep))
+            new_af = np.where(reverse, accelerations, np.where(extends, np.minimum(af + accelerations, maximums), af))
+            moved = value + new_af * (new_ep - value)
+            new_sar = np.where(new_long, np.minimum(np.minimum(moved, prev_low), low),
+                               np.maximum(np.maximum(moved, prev_high), high))
+            out[active, idx] = value[active]
+            is_long = np.where(active, new_long, is_long)
+            sar = np.where(active, new_sar, sar)
+            ep = np.where(active, new_ep, ep)
+            af = np.where(active, new_af, af)
+            prev_high = np.where(active, high, prev_high)
+            prev_low = np.where(active, low, prev_low)
+    return out
+
+
+# Fields of batch_indicators(), named as in IndicatorSubsystem.current_indicators
+INDICATOR_FIELDS = ('macd', 'macd_sig', 'macd_hist', 'macd_hist_diff', 'mfi', 'sar', 'bband_upper',
+                    'bband_middle', 'bband_lower', 'obv', 'obv_ema')
+INDICATOR_DTYPE = np.dtype([(name, 'f8') for name in INDICATOR_FIELDS])
+
+
+def batch_indicators(highs, lows, closes, volumes, quotes=None, macd_periods=(10, 26, 9), mfi_periods=14,
+                     obv_periods=21, bbands=(20, 2, 2), sar=(0.02, 0.2)):
+    """
+    The built-in indicators of IndicatorSubsystem for every row of stacked
+    (rows, time) candlestick columns, e.g. from stack_periods(), in one
+    pass. Each parameter may also be given per row, as a sequence of
+    arrays for the tuples. quotes, one price per row, replaces the last
+    close for MACD, OBV and the bands, the way IndicatorSubsystem evaluates
+    them at the bid or ask.
+
+    Returns a (rows, time) array of INDICATOR_DTYPE. Its last column holds
+    what IndicatorSubsystem publishes while the last candlestick is open.
+    """
+    highs, lows, closes, volumes = [np.atleast_2d(np.asarray(values, dtype='f8'))
+                                    for values in (highs, lows, closes, volumes)]
+    quoted = closes
+    if quotes is not None:
+        quoted = closes.copy()
+        quoted[:, -1] = quotes
+    macd, macd_sig, macd_hist = macd_rows(quoted, *macd_periods)
+    # Against the histogram of the last closed candlestick
+    macd_hist_diff = np.full(macd_hist.shape, np.nan)
+    macd_hist_diff[:, 1:] = np.diff(macd_hist, axis=1)
+    upper, middle, lower = bbands_rows(quoted, *bbands)
+    obv, obv_ema = obv_rows(quoted, volumes, obv_periods)
+    values = {'macd': macd, 'macd_sig': macd_sig, 'macd_hist': macd_hist, 'macd_hist_diff': macd_hist_diff,
+              'mfi': mfi_rows(highs, lows, closes, volumes, mfi_periods), 'sar': sar_rows(highs, lows, *sar),
+              'bband_upper': upper, 'bband_middle': middle, 'bband_lower': lower, 'obv': obv, 'obv_ema': obv_ema}
+    shape = np.broadcast(*values.values()).shape
+    out = np.empty(shape, dtype=INDICATOR_DTYPE)
+    for name, value in values.items():
+        out[name] = value
+    return out
+
+
+def stack_periods(periods, length):
+    """
+    The last length candlesticks of each period, its open candlestick
+    last, as (len(periods), length) arrays of highs, lows, closes and
+    volumes for batch_indicators(). Rows of periods with less history are
+    padded with NaN at the front. An open candlestick without trades
+    repeats the last close, as it would be closed.
+    """
+    highs, lows, closes, volumes = np.full((4, len(periods), length), np.nan)
+    for row, cur_period in enumerate(periods):
+        # GDAX historic rates layout: time, low, high, open, close, volume
+        count = min(len(cur_period.candlesticks), length - 1)
+        candles = np.asarray(cur_period.candlesticks[len(cur_period.candlesticks) - count:],
+                             dtype='f8').reshape(-1, 6)
+        stick = cur_period.cur_candlestick
+        if stick is not None and stick.close is not None:
+            current = (stick.high, stick.low, stick.close, stick.volume)
+        elif len(candles):
+            current = (candles[-1, 4], candles[-1, 4], candles[-1, 4], 0.0)
+        else:
+            continue
+        highs[row, length - 1 - count:-1] = candles[:, 2]
+        lows[row, length - 1 - count:-1] = candles[:, 1]
+        closes[row, length - 1 - count:-1] = candles[:, 4]
+        volumes[row, length - 1 - count:-1] = candles[:, 5]
+        highs[row, -1], lows[row, -1], closes[row, -1], volumes[row, -1] = current
+    return highs, lows, closes, volumes
+